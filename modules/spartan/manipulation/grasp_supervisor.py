@@ -121,6 +121,8 @@ class GraspSupervisor(object):
         self.config['pick_up_distance'] = 0.25 # distance to move above the table after grabbing the object
 
         self.config["sleep_time_for_sensor_collect"] = 0.1
+        self.config['rgbd_max_skew_secs'] = 0.02 # max time difference between captured rgb and depth images
+        self.config['rgbd_capture_max_attempts'] = 5
         self.config['scan'] = dict()
         self.config['scan']['pose_list'] = ['scan_left_close', 'scan_above_table', 'scan_right']
         self.config['scan']['joint_speed'] = 45
@@ -294,10 +296,34 @@ class GraspSupervisor(object):
 
         msg.camera_pose = self.getRgbOpticalFrameToGraspFrameTransform()
 
-        msg.rgb_image   = self.rgbImageSubscriber.waitForNextMessage()
-        msg.depth_image = self.depthImageSubscriber.waitForNextMessage()
+        # match the depth image to the last rgb image received, or if that one
+        # is too far off, to the closer of it and the next rgb image
+        max_skew = self.config['rgbd_max_skew_secs'] * 1e9
+        max_attempts = self.config['rgbd_capture_max_attempts']
+        for attempt in xrange(max_attempts):
+            msg.depth_image = self.depthImageSubscriber.waitForNextMessage()
+            depth_stamp = msg.depth_image.header.stamp.to_nsec()
 
-        return msg
+            rgb_candidates = []
+            lastRgbMsg = self.rgbImageSubscriber.lastMsg
+            if lastRgbMsg is not None:
+                if abs(depth_stamp - lastRgbMsg.header.stamp.to_nsec()) <= max_skew:
+                    msg.rgb_image = lastRgbMsg
+                    return msg
+                rgb_candidates.append(lastRgbMsg)
+
+            rgb_candidates.append(self.rgbImageSubscriber.waitForNextMessage())
+
+            rgb_stamps = [x.header.stamp.to_nsec() for x in rgb_candidates]
+            indices, skews, valid = spartanUtils.synchronize_timestamps([depth_stamp], rgb_stamps, max_skew=max_skew)
+            if valid[0]:
+                msg.rgb_image = rgb_candidates[indices[0]]
+                return msg
+
+            rospy.logwarn("rgb and depth images are %.3f seconds apart, recapturing", abs(skews[0])*1e-9)
+
+        raise ValueError("Couldn't capture rgb and depth images within %.3f seconds of each other in %d attempts"
+                         %(self.config['rgbd_max_skew_secs'], max_attempts))
 
     def moveHome(self):
         rospy.loginfo("moving home")
@@ -362,7 +388,11 @@ class GraspSupervisor(object):
 
             rospy.sleep(self.config["sleep_time_for_sensor_collect"])
             # capture RGB
-            rgbdWithPoseMsg = self.captureRgbdAndCameraTransform()
+            try:
+                rgbdWithPoseMsg = self.captureRgbdAndCameraTransform()
+            except ValueError as e:
+                rospy.logerr("skipping pose %s: %s", poseName, e)
+                continue
 
             # capture Depth
             pointCloudWithTransformMsg = self.capturePointCloudAndCameraTransform()
@@ -376,7 +406,8 @@ class GraspSupervisor(object):
 
         print "return listOfRgbdWithPoseMsg"
         print len(listOfRgbdWithPoseMsg)
-        print type(listOfRgbdWithPoseMsg[0])
+        if len(listOfRgbdWithPoseMsg) > 0:
+            print type(listOfRgbdWithPoseMsg[0])
         return listOfRgbdWithPoseMsg
 
 
@@ -385,12 +416,17 @@ class GraspSupervisor(object):
         This function will:
         - collect a small handful of RGBDWithPose msgs
         - call the FindBestMatch service (a service of pdc-ros)
-        - return what was found from FindBestMatch
+        - return what was found from FindBestMatch, None if no rgbd data could be captured
         """
         self.moveHome()
         listOfRgbdWithPoseMsg = self.collectRgbdData()
         self.list_rgbd_with_pose_msg = listOfRgbdWithPoseMsg
 
+        if len(listOfRgbdWithPoseMsg) == 0:
+            rospy.logerr("couldn't capture rgbd data at any of the poses, not requesting a best match")
+            self.best_match_result = None
+            return None
+
         # request via a ROS Action
         rospy.loginfo("waiting for find best match server")
         self.find_best_match_client.wait_for_server()
@@ -463,7 +499,7 @@ class GraspSupervisor(object):
         # find best match
         result = self.findBestBatch()
         
-        if not result.match_found:
+        if (result is None) or (not result.match_found):
             return False
 
         # attempt grasp best match
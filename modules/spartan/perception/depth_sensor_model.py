@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+# Corrupts ideal (rendered) depth images the way a structured light
+# sensor like the carmine would see them:
+#   - projector shadowing: points the projector can't see, because
+#     something closer to the camera is in the way, get no return
+#   - normal limiting: surfaces seen at a grazing angle get no return
+#   - gaussian noise on the remaining returns
+#
+# Used by the pybullet simulation on every rendered depth image, but can
+# also be run offline on a directory of recorded depth images, e.g.
+#   depth_sensor_model.py <images_dir> <output_dir> --noise 0.001
+
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+import spartan.utils.utils as spartanUtils
+
+
+# Trades accuracy of the projector shadow for speed. The shadow test
+# compares each pixel against the pixels 10-50 px further along the
+# camera-projector axis, shadow_shift_step apart. shadow_downsample > 1
+# computes the shadow mask on a decimated image and upsamples it.
+DEPTH_SENSOR_FIDELITY = {
+    'high': {'shadow_shift_step': 5, 'shadow_downsample': 1},
+    'medium': {'shadow_shift_step': 10, 'shadow_downsample': 1},
+    'low': {'shadow_shift_step': 10, 'shadow_downsample': 2},
+}
+
+SHADOW_MIN_SHIFT = 10
+SHADOW_MAX_SHIFT = 50
+
+
+class DepthSensorModel(object):
+    '''
+    Applies projector shadowing, normal limiting and noise to depth
+    images in meters of a fixed size and intrinsics.
+
+    All of the full frame buffers and the per-intrinsics projection grid
+    are allocated once and reused, call getDepthSensorModel to reuse
+    a model across images with the same intrinsics.
+    '''
+
+    def __init__(self, K, width, height, noise=0.001, normal_limit=0.05, projector_baseline=0.1,
+                 fidelity='high', seed=None):
+        '''
+        :param K: 3x3 camera matrix (or the 9 entries of CameraInfo.K)
+        :param noise: std dev of the noise added to each return, in meters
+        :param normal_limit: threshold on the depth gradient above which returns
+        are dropped, smaller is more stringent, 0.0 to turn off
+        :param projector_baseline: distance from the camera to the projector along
+        the image x axis, 0.0 turns off shadowing
+        :param fidelity: key of DEPTH_SENSOR_FIDELITY
+        :param seed: seed for the noise, None for a random one
+        '''
+        self.K = np.reshape(np.array(K, dtype=np.float64), [3, 3])
+        self.width = int(width)
+        self.height = int(height)
+        self.noise = noise
+        self.normal_limit = normal_limit
+        self.projector_baseline = projector_baseline
+        self.random = np.random.RandomState(seed)
+        self.setFidelity(fidelity)
+
+    def setFidelity(self, fidelity):
+        if fidelity not in DEPTH_SENSOR_FIDELITY:
+            raise ValueError("Unknown depth sensor fidelity %s, options are %s"
+                             % (fidelity, DEPTH_SENSOR_FIDELITY.keys()))
+        self.fidelity = fidelity
+        settings = DEPTH_SENSOR_FIDELITY[fidelity]
+        self.shadow_downsample = settings['shadow_downsample']
+        self.shadow_shift_step = settings['shadow_shift_step']
+        self.allocateBuffers()
+
+    def allocateBuffers(self):
+        h, w = self.height, self.width
+        self.depth = np.empty((h, w), dtype=np.float32)
+        self.normal_dx = np.empty((h, w), dtype=np.float32)
+        self.normal_dy = np.empty((h, w), dtype=np.float32)
+        self.valid_mask = np.empty((h, w), dtype=bool)
+
+        # the shadow test runs at the decimated resolution, with the
+        # intrinsics and the shifts scaled to match
+        ds = self.shadow_downsample
+        sh, sw = (h + ds - 1) // ds, (w + ds - 1) // ds
+        fx, cx = self.K[0, 0] / ds, self.K[0, 2] / ds
+
+        min_shift = SHADOW_MIN_SHIFT // ds
+        shift_step = max(self.shadow_shift_step // ds, 1)
+        self.shadow_shifts = np.arange(min_shift, SHADOW_MAX_SHIFT // ds + 1, shift_step)
+        max_shift = self.shadow_shifts[-1]
+
+        # lateral projection of a unit depth point at each column, the
+        # lateral projection of the image is x_indices_im * depth
+        self.x_indices_im = ((np.arange(sw, dtype=np.float32) - cx) / fx)[np.newaxis, :]
+
+        self.shadow_depth = np.empty((sh, sw), dtype=np.float32)
+        self.shadow_x_projection = np.empty((sh, sw), dtype=np.float32)
+        self.shadow_x_to_projector = np.empty((sh, sw), dtype=np.float32)
+        self.shadow_threshold = np.empty((sh, sw), dtype=np.float32)
+        self.shadow_depth_padded = np.empty((sh, sw + max_shift), dtype=np.float32)
+        self.shadow_x_projection_padded = np.empty((sh, sw + max_shift), dtype=np.float32)
+        self.shadow_error = np.empty((len(self.shadow_shifts), sh, sw), dtype=np.float32)
+        self.shadow_error_term = np.empty((len(self.shadow_shifts), sh, sw), dtype=np.float32)
+        self.shadow_max_error = np.empty((sh, sw), dtype=np.float32)
+        self.shadow_mask = np.empty((sh, sw), dtype=bool)
+
+    def matches(self, K, width, height):
+        return (self.width == width and self.height == height and
+                np.array_equal(self.K, np.reshape(np.array(K, dtype=np.float64), [3, 3])))
+
+    def corrupt(self, depth_image, out=None):
+        '''
+        :param depth_image: height x width depth image in meters, pixels <= 0 are
+        treated as having no return
+        :param out: optional float32 array to write the result into, may be depth_image
+        :return: the corrupted depth image, float32 in meters, 0 where there is no return
+        '''
+        if depth_image.shape != (self.height, self.width):
+            raise ValueError("Expected a %dx%d depth image, got shape %s"
+                             % (self.height, self.width, str(depth_image.shape)))
+
+        if out is None:
+            out = np.empty((self.height, self.width), dtype=np.float32)
+
+        depth = self.depth
+        depth[:] = depth_image
+        np.greater(depth, 0., out=self.valid_mask)
+
+        # everything below is computed from the noise free depth
+        keep_mask = self.valid_mask
+        if self.normal_limit > 0.:
+            keep_mask &= self.computeNormalMask(depth)
+
+        if self.projector_baseline > 0.:
+            keep_mask &= self.computeShadowMask(depth)
+
+        out[:] = depth
+        if self.noise > 0.:
+            out += self.random.standard_normal(out.shape).astype(np.float32) * self.noise
+
+        out *= keep_mask
+        return out
+
+    def computeNormalMask(self, depth):
+        '''
+        :return: height x width bool array, True where the depth gradient is below normal_limit
+        '''
+        cv2.Scharr(depth, cv2.CV_32F, 1, 0, dst=self.normal_dx)
+        cv2.Scharr(depth, cv2.CV_32F, 0, 1, dst=self.normal_dy)
+        np.absolute(self.normal_dx, out=self.normal_dx)
+        np.absolute(self.normal_dy, out=self.normal_dy)
+        self.normal_dx += self.normal_dy
+        return self.normal_dx <= self.normal_limit
+
+    def computeShadowMask(self, depth):
+        '''
+        A pixel is shadowed if, for any of the shifts, the point shift pixels
+        further along the projector axis lies on the projector side of the line
+        from the projector to the pixel's point.
+
+        All of the shifts are evaluated at once on strided views into the padded
+        depth and lateral projection images.
+
+        :return: height x width bool array, True where the projector reaches the point
+        '''
+        ds = self.shadow_downsample
+        Z = self.shadow_depth
+        Z[:] = depth[::ds, ::ds]
+
+        X = self.shadow_x_projection
+        np.multiply(self.x_indices_im, Z, out=X)
+
+        # pixels shifted in from outside of the image see the far plane, the
+        # lateral projection is extended with its border value
+        sh, sw = Z.shape
+        Z_padded = self.shadow_depth_padded
+        X_padded = self.shadow_x_projection_padded
+        Z_padded[:, :sw] = Z
+        Z_padded[:, sw:] = np.max(Z)
+        X_padded[:, :sw] = X
+        X_padded[:, sw:] = X[:, -1:]
+
+        Z_shifted = self.shiftedViews(Z_padded)
+        X_shifted = self.shiftedViews(X_padded)
+
+        # (projected shifted point - projected point) dot the vector perpendicular
+        # to the point and the projector origin, expanded to
+        #   Z_s * (X - b) - X_s * Z + b * Z
+        # the last term doesn't depend on the shift
+        np.subtract(X, self.projector_baseline, out=self.shadow_x_to_projector)
+        np.multiply(Z_shifted, self.shadow_x_to_projector, out=self.shadow_error)
+        np.multiply(X_shifted, Z, out=self.shadow_error_term)
+        self.shadow_error -= self.shadow_error_term
+        np.max(self.shadow_error, axis=0, out=self.shadow_max_error)
+
+        np.multiply(Z, -self.projector_baseline, out=self.shadow_threshold)
+        np.less_equal(self.shadow_max_error, self.shadow_threshold, out=self.shadow_mask)
+
+        if ds == 1:
+            return self.shadow_mask
+
+        mask = np.repeat(np.repeat(self.shadow_mask, ds, axis=0), ds, axis=1)
+        return mask[:self.height, :self.width]
+
+    def shiftedViews(self, padded):
+        '''
+        :return: num_shifts x height x width view with view[i, v, u] = padded[v, u + shadow_shifts[i]]
+        '''
+        sh, sw = self.shadow_depth.shape
+        first = padded[:, self.shadow_shifts[0]:]
+        shift_stride = (self.shadow_shifts[1] - self.shadow_shifts[0]) if len(self.shadow_shifts) > 1 else 0
+        return np.lib.stride_tricks.as_strided(
+            first, shape=(len(self.shadow_shifts), sh, sw),
+            strides=(shift_stride * padded.strides[1], padded.strides[0], padded.strides[1]))
+
+
+def getDepthSensorModel(model, K, width, height, **kwargs):
+    '''
+    Returns model if it was built for these intrinsics, a new DepthSensorModel otherwise.
+    '''
+    if model is not None and model.matches(K, width, height):
+        return model
+    return DepthSensorModel(K, width, height, **kwargs)
+
+
+def corruptDepthImagesInFolder(images_dir, output_dir, **kwargs):
+    '''
+    Applies the sensor model to all of the *_depth.png images in images_dir,
+    using the intrinsics in images_dir/camera_info.yaml. The images are read
+    and written as uint16 in mm, like the ones extracted from a log.
+    '''
+    camera_info = spartanUtils.getDictFromYamlFilename(os.path.join(images_dir, 'camera_info.yaml'))
+    K = camera_info['camera_matrix']['data']
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    model = None
+    filenames = sorted(f for f in os.listdir(images_dir) if f.endswith('_depth.png'))
+    for filename in filenames:
+        depth_mm = cv2.imread(os.path.join(images_dir, filename), cv2.IMREAD_ANYDEPTH)
+        height, width = depth_mm.shape
+        model = getDepthSensorModel(model, K, width, height, **kwargs)
+
+        depth = model.corrupt(depth_mm.astype(np.float32) / 1000.)
+        cv2.imwrite(os.path.join(output_dir, filename), (depth * 1000.).astype(np.uint16))
+
+    print "corrupted %d depth images from %s into %s" % (len(filenames), images_dir, output_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images_dir", help="Folder with *_depth.png images and camera_info.yaml", type=str)
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--noise", help="Normal noise injected to depth returns", type=float, default=0.001)
+    parser.add_argument("--projector_baseline", help="Projector baseline used to calculate depth shadowing", type=float, default=0.1)
+    parser.add_argument("--normal_limit", help="Threshold for rejecting high-normal depth returns. (Smaller is more stringent, 0.0 to turn off.)", type=float, default=0.05)
+    parser.add_argument("--fidelity", type=str, default='high', choices=sorted(DEPTH_SENSOR_FIDELITY.keys()))
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    corruptDepthImagesInFolder(args.images_dir, args.output_dir, noise=args.noise,
+                               normal_limit=args.normal_limit, projector_baseline=args.projector_baseline,
+                               fidelity=args.fidelity, seed=args.seed)
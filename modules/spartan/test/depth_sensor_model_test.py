@@ -0,0 +1,115 @@
+import unittest
+import numpy as np
+
+# the depth sensor model imports cv2 and director,
+# the tests are skipped where that isn't available
+try:
+    from spartan.perception.depth_sensor_model import DepthSensorModel, getDepthSensorModel
+    SKIP_REASON = None
+except ImportError as e:
+    SKIP_REASON = "needs the spartan environment: %s" %(e)
+
+
+WIDTH = 160
+HEIGHT = 120
+K = [130., 0., 80., 0., 130., 60., 0., 0., 1.]
+
+
+def make_depth_image():
+    """
+    Back wall at 2m, a sloped floor in the bottom rows and a box at 1m in
+    front of the wall that casts a projector shadow on it
+    """
+    depth = 2.0*np.ones((HEIGHT, WIDTH), dtype=np.float32)
+    rows = np.arange(90, HEIGHT)
+    depth[90:, :] = np.linspace(1.9, 1.5, len(rows))[:, np.newaxis]
+    depth[40:80, 60:90] = 1.0
+    return depth
+
+
+def compute_shadow_mask_per_shift(depth, K, projector_baseline, shifts):
+    """
+    The shadow test one shift at a time, as the pybullet simulation used to
+    do it with cv2.warpAffine: the lateral projection is shifted in with its
+    border value, the depth with the max depth of the image.
+    """
+    K = np.reshape(np.array(K, dtype=np.float64), [3, 3])
+    depth = depth.astype(np.float64)
+    height, width = depth.shape
+
+    x_indices_im = np.tile(np.arange(width), [height, 1])
+    x_projection = (x_indices_im - K[0, 2]) * depth / K[0, 0]
+
+    mask = np.ones((height, width), dtype=bool)
+    for shift in shifts:
+        shifted_x_projection = np.concatenate([x_projection[:, shift:], np.tile(x_projection[:, -1:], [1, shift])], axis=1)
+        shifted_depth = np.concatenate([depth[:, shift:], np.max(depth)*np.ones((height, shift))], axis=1)
+
+        error_im = (shifted_x_projection - x_projection)*(-depth) + \
+                   (shifted_depth - depth)*(x_projection - projector_baseline)
+        mask &= error_im <= 0.
+
+    return mask
+
+
+@unittest.skipIf(SKIP_REASON is not None, SKIP_REASON)
+class DepthSensorModelTest(unittest.TestCase):
+
+    def test_shadow_mask_matches_per_shift_loop(self):
+        depth = make_depth_image()
+        for fidelity, shifts in [('high', range(10, 51, 5)), ('medium', range(10, 51, 10))]:
+            model = DepthSensorModel(K, WIDTH, HEIGHT, fidelity=fidelity)
+            mask = model.computeShadowMask(depth)
+            expected = compute_shadow_mask_per_shift(depth, K, model.projector_baseline, shifts)
+
+            # the box shadows the wall next to it
+            self.assertGreater(np.sum(~expected), 0)
+            np.testing.assert_array_equal(mask, expected, err_msg="fidelity %s" %(fidelity))
+
+    def test_downsampled_shadow_mask(self):
+        depth = make_depth_image()
+        model = DepthSensorModel(K, WIDTH, HEIGHT, fidelity='low')
+        mask = model.computeShadowMask(depth)
+
+        K_decimated = np.array(K)/2
+        K_decimated[8] = 1.
+        expected = compute_shadow_mask_per_shift(depth[::2, ::2], K_decimated, model.projector_baseline, range(5, 26, 5))
+
+        self.assertEqual(mask.shape, (HEIGHT, WIDTH))
+        np.testing.assert_array_equal(mask, np.repeat(np.repeat(expected, 2, axis=0), 2, axis=1))
+
+    def test_corrupt_without_noise_applies_the_shadow_mask(self):
+        depth = make_depth_image()
+        depth[0:5, 0:5] = 0.
+        model = DepthSensorModel(K, WIDTH, HEIGHT, noise=0., normal_limit=0.)
+
+        expected = depth*compute_shadow_mask_per_shift(depth, K, model.projector_baseline, range(10, 51, 5))
+        np.testing.assert_array_equal(model.corrupt(depth), expected)
+
+        # the buffers are reused, and the result can be written in place
+        np.testing.assert_array_equal(model.corrupt(depth), expected)
+        out = depth.copy()
+        model.corrupt(out, out=out)
+        np.testing.assert_array_equal(out, expected)
+
+    def test_noise_is_seeded(self):
+        depth = make_depth_image()
+        a = DepthSensorModel(K, WIDTH, HEIGHT, noise=0.01, normal_limit=0., seed=1).corrupt(depth)
+        b = DepthSensorModel(K, WIDTH, HEIGHT, noise=0.01, normal_limit=0., seed=1).corrupt(depth)
+        np.testing.assert_array_equal(a, b)
+
+        kept = a > 0
+        self.assertGreater(np.std(a[kept] - depth[kept]), 0.005)
+
+    def test_get_depth_sensor_model_reuses_matching_model(self):
+        model = DepthSensorModel(K, WIDTH, HEIGHT)
+        self.assertIs(getDepthSensorModel(model, K, WIDTH, HEIGHT), model)
+        self.assertIsNot(getDepthSensorModel(model, K, WIDTH*2, HEIGHT*2), model)
+        self.assertIsNotNone(getDepthSensorModel(None, K, WIDTH, HEIGHT))
+
+        with self.assertRaises(ValueError):
+            model.corrupt(np.ones((HEIGHT*2, WIDTH*2), dtype=np.float32))
+
+
+if __name__ == '__main__':
+    unittest.main()
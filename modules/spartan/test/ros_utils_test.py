@@ -0,0 +1,135 @@
+import unittest
+import numpy as np
+
+# spartan.utils.ros_utils imports ROS (rospy, tf, cv_bridge), cv2 and director,
+# the tests are skipped where that isn't available
+try:
+    import rospy
+    import geometry_msgs.msg
+    import tf
+
+    from spartan.utils.ros_utils import TFBagIndex
+    SKIP_REASON = None
+except ImportError as e:
+    SKIP_REASON = "needs the spartan environment: %s" %(e)
+
+
+SEC = 10**9
+
+
+def quaternion_about_z(angle):
+    """
+    (x,y,z,w) quaternion of a rotation by angle about the z axis
+    """
+    return np.array([0., 0., np.sin(angle/2.), np.cos(angle/2.)])
+
+def transform_matrix(trans, quat):
+    """
+    4 x 4 homogeneous transform from a translation and a (x,y,z,w) quaternion
+    """
+    x, y, z, w = quat
+    T = np.eye(4)
+    T[0:3, 0:3] = [[1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)],
+                   [2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)],
+                   [2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)]]
+    T[0:3, 3] = trans
+    return T
+
+def make_transform_msg(parent, child, stamp, trans, quat):
+    """
+    :param stamp: in nanoseconds
+    """
+    msg = geometry_msgs.msg.TransformStamped()
+    msg.header.frame_id = parent
+    msg.header.stamp = rospy.Time(stamp // SEC, stamp % SEC)
+    msg.child_frame_id = child
+    msg.transform.translation.x, msg.transform.translation.y, msg.transform.translation.z = trans
+    msg.transform.rotation.x, msg.transform.rotation.y, msg.transform.rotation.z, msg.transform.rotation.w = quat
+    return msg
+
+
+@unittest.skipIf(SKIP_REASON is not None, SKIP_REASON)
+class TFBagIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        # world -> base is static, base -> camera and base -> gripper move
+        self.tf_index = TFBagIndex()
+        self.world_to_base = ([1., 0., 0.5], quaternion_about_z(np.pi/2))
+        self.tf_index.addTransformMsg(make_transform_msg('world', 'base', 0, *self.world_to_base), static=True)
+
+        # added out of order on purpose
+        self.tf_index.addTransformMsg(make_transform_msg('base', 'camera', 2*SEC, [1., 2., 0.], quaternion_about_z(np.pi/2)))
+        self.tf_index.addTransformMsg(make_transform_msg('/base', '/camera', 1*SEC, [0., 0., 0.], quaternion_about_z(0.)))
+        self.tf_index.addTransformMsg(make_transform_msg('base', 'gripper', 1*SEC, [0., 0., 1.], quaternion_about_z(0.)))
+        self.tf_index.addTransformMsg(make_transform_msg('base', 'gripper', 3*SEC, [0., 0., 1.], quaternion_about_z(0.)))
+
+    def assertTransformsEqual(self, trans, quat, expected_trans, expected_quat):
+        np.testing.assert_allclose(transform_matrix(trans, quat), transform_matrix(expected_trans, expected_quat), atol=1e-9)
+
+    def test_interpolates_a_single_edge(self):
+        stamps = [1*SEC, 1*SEC + SEC/4, 1*SEC + SEC/2, 2*SEC]
+        trans, quat, valid = self.tf_index.lookupTransforms('base', 'camera', stamps)
+
+        self.assertTrue(np.all(valid))
+        for i, fraction in enumerate([0., 0.25, 0.5, 1.]):
+            # lerp of the translation, slerp of the rotation
+            self.assertTransformsEqual(trans[i], quat[i], [fraction, 2*fraction, 0.],
+                                       quaternion_about_z(fraction*np.pi/2))
+
+    def test_composes_chains(self):
+        stamp = 1*SEC + SEC/2
+        base_to_camera = transform_matrix([0.5, 1., 0.], quaternion_about_z(np.pi/4))
+        world_to_base = transform_matrix(*self.world_to_base)
+        base_to_gripper = transform_matrix([0., 0., 1.], quaternion_about_z(0.))
+
+        expected = {('world', 'camera'): np.dot(world_to_base, base_to_camera),
+                    ('camera', 'world'): np.linalg.inv(np.dot(world_to_base, base_to_camera)),
+                    ('camera', 'gripper'): np.dot(np.linalg.inv(base_to_camera), base_to_gripper),
+                    ('world', 'world'): np.eye(4)}
+
+        for (target_frame, source_frame), T in expected.iteritems():
+            trans, quat, valid = self.tf_index.lookupTransforms(target_frame, source_frame, [stamp])
+            self.assertTrue(valid[0])
+            np.testing.assert_allclose(transform_matrix(trans[0], quat[0]), T, atol=1e-9)
+
+    def test_matches_lookup_transform(self):
+        stamp = 1*SEC + SEC/3
+        trans, quat, _ = self.tf_index.lookupTransforms('world', 'camera', [stamp])
+        single_trans, single_quat = self.tf_index.lookupTransform('world', 'camera', rospy.Time(1, SEC/3))
+
+        np.testing.assert_allclose(single_trans, trans[0])
+        np.testing.assert_allclose(single_quat, quat[0])
+
+    def test_extrapolation_is_invalid(self):
+        _, _, valid = self.tf_index.lookupTransforms('world', 'camera', [0, 1*SEC, 2*SEC, 3*SEC])
+        np.testing.assert_array_equal(valid, [False, True, True, False])
+
+        # static transforms are valid at any time
+        _, _, valid = self.tf_index.lookupTransforms('world', 'base', [0, 10*SEC])
+        np.testing.assert_array_equal(valid, [True, True])
+
+        with self.assertRaises(tf.ExtrapolationException):
+            self.tf_index.lookupTransform('world', 'camera', rospy.Time(5, 0))
+
+    def test_unknown_and_disconnected_frames(self):
+        with self.assertRaises(tf.LookupException):
+            self.tf_index.lookupTransforms('world', 'no_such_frame', [1*SEC])
+
+        self.tf_index.addTransformMsg(make_transform_msg('other_world', 'other_base', 1*SEC, [0., 0., 0.], quaternion_about_z(0.)))
+        with self.assertRaises(tf.ConnectivityException):
+            self.tf_index.lookupTransforms('world', 'other_base', [1*SEC])
+
+    def test_duplicate_stamps_keep_the_last_transform(self):
+        self.tf_index.addTransformMsg(make_transform_msg('base', 'camera', 2*SEC, [3., 0., 0.], quaternion_about_z(0.)))
+        # only the first copy of a static transform is kept
+        self.tf_index.addTransformMsg(make_transform_msg('world', 'base', 1*SEC, [5., 5., 5.], quaternion_about_z(0.)), static=True)
+
+        trans, quat, _ = self.tf_index.lookupTransforms('base', 'camera', [2*SEC])
+        self.assertTransformsEqual(trans[0], quat[0], [3., 0., 0.], quaternion_about_z(0.))
+
+        trans, quat, _ = self.tf_index.lookupTransforms('world', 'base', [2*SEC])
+        self.assertTransformsEqual(trans[0], quat[0], *self.world_to_base)
+
+
+if __name__ == '__main__':
+    unittest.main()
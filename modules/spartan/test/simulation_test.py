@@ -26,6 +26,10 @@ import spartan.utils.utils as spartan_utils
 import robot_msgs.msg
 
 
+# procman script (in apps/iiwa/iiwa_hardware.pmd) that starts the simulator
+# under test, e.g. "4b.sim_pybullet_lockstep_startup_for_ci" to run against
+# the pybullet sim in lockstep mode
+SIMULATOR_STARTUP_SCRIPT = os.getenv("SPARTAN_SIMULATION_TEST_SCRIPT", "6.start_drake_iiwa_sim")
 
 def make_cartesian_trajectory_goal_world_frame():
 
@@ -146,7 +150,7 @@ class IiwaSimulationTest(unittest.TestCase):
         sheriff = self._launch_process_and_test(["/usr/bin/env", "bot-procman-sheriff",
                                            "--no-gui", "--on-script-complete", "exit",
                                            os.path.expandvars("${SPARTAN_SOURCE_DIR}/apps/iiwa/iiwa_hardware.pmd"),
-                                           "6.start_drake_iiwa_sim"])
+                                           SIMULATOR_STARTUP_SCRIPT])
 
         sheriff.wait()
         print "Sheriff returned code %d" % (sheriff.returncode)
@@ -0,0 +1,69 @@
+import unittest
+import numpy as np
+
+# spartan.utils.utils imports director,
+# the tests are skipped where that isn't available
+try:
+    import spartan.utils.utils as spartan_utils
+    SKIP_REASON = None
+except ImportError as e:
+    SKIP_REASON = "needs the spartan environment: %s" %(e)
+
+
+def synchronize_timestamps_brute_force(query_stamps, reference_stamps):
+    """
+    Closest reference stamp for each query, ties go to the earlier reference stamp
+    """
+    indices = []
+    for q in query_stamps:
+        best = None
+        for i, r in enumerate(reference_stamps):
+            if (best is None) or (abs(q - r) < abs(q - reference_stamps[best])) or \
+                    (abs(q - r) == abs(q - reference_stamps[best]) and r < reference_stamps[best]):
+                best = i
+        indices.append(best)
+    return np.array(indices)
+
+
+@unittest.skipIf(SKIP_REASON is not None, SKIP_REASON)
+class SynchronizeTimestampsTest(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        np.random.seed(0)
+        # nanosecond stamps of a 30Hz rgb stream with jitter, in random order
+        reference_stamps = (np.arange(100)*33333333 + np.random.randint(-2000000, 2000000, size=100)).astype(np.int64)
+        np.random.shuffle(reference_stamps)
+        query_stamps = np.random.randint(-50000000, 3400000000, size=500).astype(np.int64)
+
+        indices, skews, valid = spartan_utils.synchronize_timestamps(query_stamps, reference_stamps)
+
+        np.testing.assert_array_equal(indices, synchronize_timestamps_brute_force(query_stamps, reference_stamps))
+        np.testing.assert_array_equal(skews, query_stamps - reference_stamps[indices])
+        self.assertTrue(np.all(valid))
+
+    def test_ties_and_out_of_range(self):
+        reference_stamps = np.array([300, 100, 200])
+        query_stamps = np.array([150, 250, 0, 1000, 200])
+
+        indices, skews, valid = spartan_utils.synchronize_timestamps(query_stamps, reference_stamps)
+
+        # ties go to the earlier stamp, stamps outside the range match the first/last one
+        np.testing.assert_array_equal(reference_stamps[indices], [100, 200, 100, 300, 200])
+        np.testing.assert_array_equal(skews, [50, 50, -100, 700, 0])
+
+    def test_max_skew(self):
+        reference_stamps = np.array([0, 100, 200])
+        query_stamps = np.array([10, 40, 60, 250])
+
+        _, skews, valid = spartan_utils.synchronize_timestamps(query_stamps, reference_stamps, max_skew=40)
+
+        np.testing.assert_array_equal(skews, [10, 40, -40, 50])
+        np.testing.assert_array_equal(valid, [True, True, True, False])
+
+    def test_empty_reference_raises(self):
+        with self.assertRaises(ValueError):
+            spartan_utils.synchronize_timestamps([0, 1], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -278,6 +278,295 @@ def setup_tf_transformer_from_ros_bag(bag, cache_time_secs=3600, verbose=False):
     return tf_t
 
 
+def setup_tf_index_from_ros_bag(bag, verbose=False):
+    """
+    Creates a TFBagIndex with all the /tf and /tf_static messages in a log.
+    This is much faster to build than setup_tf_transformer_from_ros_bag and
+    supports batched lookups.
+    """
+    tf_index = TFBagIndex()
+
+    for topic, msg, t in bag.read_messages(topics=['/tf_static']):
+        for msg_tf in msg.transforms:
+            tf_index.addTransformMsg(msg_tf, static=True)
+
+    counter = 0
+    for topic, msg, t in bag.read_messages(topics=['/tf']):
+        counter += 1
+        if verbose and (counter % 1000 == 0):
+            print "processing tf message %d" %(counter)
+
+        for msg_tf in msg.transforms:
+            tf_index.addTransformMsg(msg_tf)
+
+    tf_index.finalize()
+    return tf_index
+
+
+class TFBagIndex(object):
+    """
+    Stores the transforms from a log as timestamped NumPy arrays, one set of
+    arrays per (parent, child) edge of the tf tree. Supports batched
+    lookups with linear interpolation of translations and slerp of
+    rotations, like tf.Transformer.
+
+    Usage:
+        tf_index = setup_tf_index_from_ros_bag(bag)
+        trans, quat, valid = tf_index.lookupTransforms(world_frame, camera_frame, stamps_nsec)
+
+    Quaternions are (x,y,z,w) to match tf.
+    """
+
+    def __init__(self):
+        # child_frame_id -> dict with parent, static and lists of stamps/translations/quaternions
+        self._edges = dict()
+        self._chain_cache = dict()
+        self._finalized = False
+
+    def addTransformMsg(self, msg_tf, static=False):
+        """
+        Adds a geometry_msgs/TransformStamped
+        """
+        child = msg_tf.child_frame_id.lstrip('/')
+        parent = msg_tf.header.frame_id.lstrip('/')
+
+        if child not in self._edges:
+            self._edges[child] = {'parent': parent, 'static': static, 'stamps': [],
+                                  'translations': [], 'quaternions': []}
+
+        edge = self._edges[child]
+        if edge['parent'] != parent:
+            print "TFBagIndex: ignoring transform %s -> %s, %s already has parent %s" %(parent, child, child, edge['parent'])
+            return
+
+        # like setup_tf_transformer_from_ros_bag only keep the first copy of a static transform
+        if edge['static'] and len(edge['stamps']) > 0:
+            return
+
+        t = msg_tf.transform.translation
+        q = msg_tf.transform.rotation
+        edge['stamps'].append(msg_tf.header.stamp.to_nsec())
+        edge['translations'].append([t.x, t.y, t.z])
+        edge['quaternions'].append([q.x, q.y, q.z, q.w])
+        self._finalized = False
+
+    def finalize(self):
+        """
+        Converts the per edge lists to sorted NumPy arrays. Called automatically
+        before the first lookup.
+        """
+        for child, edge in self._edges.iteritems():
+            stamps = np.asarray(edge['stamps'], dtype=np.int64)
+            sort_idx = np.argsort(stamps, kind='mergesort')
+            stamps = stamps[sort_idx]
+
+            # for duplicate stamps keep the last transform received
+            keep = np.append(stamps[1:] != stamps[:-1], True)
+            sort_idx = sort_idx[keep]
+
+            edge['stamps'] = stamps[keep]
+            edge['translations'] = np.asarray(edge['translations'], dtype=np.float64).reshape(-1, 3)[sort_idx]
+            edge['quaternions'] = np.asarray(edge['quaternions'], dtype=np.float64).reshape(-1, 4)[sort_idx]
+
+        self._chain_cache = dict()
+        self._finalized = True
+
+    def getFrames(self):
+        frames = set(self._edges.keys())
+        for edge in self._edges.values():
+            frames.add(edge['parent'])
+        return frames
+
+    def _pathToRoot(self, frame):
+        path = [frame]
+        while path[-1] in self._edges:
+            path.append(self._edges[path[-1]]['parent'])
+            if len(path) > len(self._edges) + 1:
+                raise tf.LookupException("tf tree has a cycle containing frame %s" %(frame))
+        return path
+
+    def _getChain(self, target_frame, source_frame):
+        """
+        Returns the lists of edges (child frames) going from the common ancestor
+        of the two frames down to target_frame and to source_frame
+        """
+        key = (target_frame, source_frame)
+        if key in self._chain_cache:
+            return self._chain_cache[key]
+
+        frames = self.getFrames()
+        for frame in (target_frame, source_frame):
+            if frame not in frames:
+                raise tf.LookupException("frame %s doesn't exist in the tf index" %(frame))
+
+        target_path = self._pathToRoot(target_frame)
+        source_path = self._pathToRoot(source_frame)
+
+        source_path_set = set(source_path)
+        ancestor = None
+        for frame in target_path:
+            if frame in source_path_set:
+                ancestor = frame
+                break
+
+        if ancestor is None:
+            raise tf.ConnectivityException("frames %s and %s are not connected" %(target_frame, source_frame))
+
+        # edges are named by their child frame, ordered from the ancestor down
+        target_chain = target_path[:target_path.index(ancestor)][::-1]
+        source_chain = source_path[:source_path.index(ancestor)][::-1]
+
+        chain = (target_chain, source_chain)
+        self._chain_cache[key] = chain
+        return chain
+
+    def _interpolateEdge(self, child, stamps):
+        """
+        Returns the parent to child transform at each of the stamps, along with
+        a bool array that is False for stamps outside the range of the data
+        """
+        edge = self._edges[child]
+        edge_stamps = edge['stamps']
+        num_stamps = stamps.size
+
+        if edge['static']:
+            trans = np.tile(edge['translations'][0], (num_stamps, 1))
+            quat = np.tile(edge['quaternions'][0], (num_stamps, 1))
+            return trans, quat, np.ones(num_stamps, dtype=bool)
+
+        valid = (stamps >= edge_stamps[0]) & (stamps <= edge_stamps[-1])
+
+        if edge_stamps.size == 1:
+            trans = np.tile(edge['translations'][0], (num_stamps, 1))
+            quat = np.tile(edge['quaternions'][0], (num_stamps, 1))
+            return trans, quat, valid
+
+        idx_0 = np.clip(np.searchsorted(edge_stamps, stamps, side='right') - 1, 0, edge_stamps.size - 2)
+        idx_1 = idx_0 + 1
+
+        alpha = (stamps - edge_stamps[idx_0]).astype(np.float64) / (edge_stamps[idx_1] - edge_stamps[idx_0])
+        alpha = np.clip(alpha, 0.0, 1.0)
+
+        trans_0 = edge['translations'][idx_0]
+        trans_1 = edge['translations'][idx_1]
+        trans = trans_0 + alpha[:, np.newaxis] * (trans_1 - trans_0)
+
+        quat = quaternion_slerp_batch(edge['quaternions'][idx_0], edge['quaternions'][idx_1], alpha)
+        return trans, quat, valid
+
+    def lookupTransforms(self, target_frame, source_frame, stamps):
+        """
+        Batched version of tf.Transformer.lookupTransform
+
+        :param stamps: timestamps in nanoseconds
+        :type stamps: array of int
+        :return: trans, quat, valid. trans is N x 3, quat is N x 4 (x,y,z,w) and
+        valid is an N bool array, False where the transform would have required
+        extrapolation
+        """
+        if not self._finalized:
+            self.finalize()
+
+        stamps = np.atleast_1d(np.asarray(stamps, dtype=np.int64))
+        num_stamps = stamps.size
+
+        target_chain, source_chain = self._getChain(target_frame.lstrip('/'), source_frame.lstrip('/'))
+
+        valid = np.ones(num_stamps, dtype=bool)
+
+        def compose_chain(chain):
+            trans = np.zeros((num_stamps, 3))
+            quat = np.zeros((num_stamps, 4))
+            quat[:, 3] = 1.0
+            for child in chain:
+                edge_trans, edge_quat, edge_valid = self._interpolateEdge(child, stamps)
+                trans, quat = compose_transforms_batch(trans, quat, edge_trans, edge_quat)
+                valid[:] &= edge_valid
+            return trans, quat
+
+        # ancestor_to_target^-1 * ancestor_to_source
+        target_trans, target_quat = compose_chain(target_chain)
+        source_trans, source_quat = compose_chain(source_chain)
+
+        inv_trans, inv_quat = invert_transforms_batch(target_trans, target_quat)
+        trans, quat = compose_transforms_batch(inv_trans, inv_quat, source_trans, source_quat)
+
+        return trans, quat, valid
+
+    def lookupTransform(self, target_frame, source_frame, time):
+        """
+        Same interface as tf.Transformer.lookupTransform
+
+        :param time: rospy.Time
+        :return: (trans, rot), rot is (x,y,z,w)
+        """
+        trans, quat, valid = self.lookupTransforms(target_frame, source_frame, [time.to_nsec()])
+        if not valid[0]:
+            raise tf.ExtrapolationException("lookup of %s -> %s at time %.6f requires extrapolation" %(target_frame, source_frame, time.to_sec()))
+
+        return trans[0].tolist(), quat[0].tolist()
+
+
+def quaternion_multiply_batch(q, r):
+    """
+    Multiplies N x 4 arrays of (x,y,z,w) quaternions row-wise
+    """
+    x1, y1, z1, w1 = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    x2, y2, z2, w2 = r[:, 0], r[:, 1], r[:, 2], r[:, 3]
+
+    return np.stack([w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                     w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                     w1*z2 + x1*y2 - y1*x2 + z1*w2,
+                     w1*w2 - x1*x2 - y1*y2 - z1*z2], axis=1)
+
+def quaternion_rotate_batch(q, v):
+    """
+    Rotates the rows of the N x 3 array v by the N x 4 (x,y,z,w) quaternions q
+    """
+    q_vec = q[:, 0:3]
+    t = 2.0 * np.cross(q_vec, v)
+    return v + q[:, 3:4] * t + np.cross(q_vec, t)
+
+def quaternion_slerp_batch(q0, q1, alpha):
+    """
+    Spherical linear interpolation between the rows of the N x 4 quaternion
+    arrays q0 and q1, alpha is an array of N fractions in [0,1]
+    """
+    dot = np.sum(q0 * q1, axis=1)
+
+    # take the shorter path
+    q1 = np.where((dot < 0)[:, np.newaxis], -q1, q1)
+    dot = np.abs(dot)
+
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+
+    # fall back to linear interpolation when the quaternions are very close
+    close = sin_theta < 1e-6
+    safe_sin_theta = np.where(close, 1.0, sin_theta)
+    w0 = np.where(close, 1.0 - alpha, np.sin((1.0 - alpha) * theta) / safe_sin_theta)
+    w1 = np.where(close, alpha, np.sin(alpha * theta) / safe_sin_theta)
+
+    q = w0[:, np.newaxis] * q0 + w1[:, np.newaxis] * q1
+    return q / np.linalg.norm(q, axis=1)[:, np.newaxis]
+
+def compose_transforms_batch(trans_a, quat_a, trans_b, quat_b):
+    """
+    Computes a * b for N transforms stored as N x 3 translations and N x 4 (x,y,z,w) quaternions
+    """
+    trans = trans_a + quaternion_rotate_batch(quat_a, trans_b)
+    quat = quaternion_multiply_batch(quat_a, quat_b)
+    return trans, quat
+
+def invert_transforms_batch(trans, quat):
+    """
+    Inverts N transforms stored as N x 3 translations and N x 4 (x,y,z,w) quaternions
+    """
+    quat_inv = quat * np.array([-1.0, -1.0, -1.0, 1.0])
+    trans_inv = -quaternion_rotate_batch(quat_inv, trans)
+    return trans_inv, quat_inv
+
+
 class SimpleSubscriber(object):
     def __init__(self, topic, messageType, externalCallback=None):
         self.topic = topic
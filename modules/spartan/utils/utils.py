@@ -166,15 +166,17 @@ def compute_angle_between_quaternions(q, r):
     theta = arccos(2 * <q1, q2>^2 - 1)
 
     See https://math.stackexchange.com/questions/90081/quaternion-distance
-    :param q: numpy array in form [w,x,y,z]. As long as both q,r are consistent it doesn't matter
+    :param q: numpy array in form [w,x,y,z]. As long as both q,r are consistent it doesn't matter.
+    Can also be an N x 4 array, in which case N angles are returned
     :type q:
-    :param r:
+    :param r: numpy array in form [w,x,y,z] or N x 4 array, broadcast against q
     :type r:
     :return: angle between the quaternions, in radians
     :rtype:
     """
 
-    theta = 2*np.arccos(2 * np.dot(q,r)**2 - 1)
+    dot = np.sum(np.asarray(q) * np.asarray(r), axis=-1)
+    theta = 2*np.arccos(2 * dot**2 - 1)
     return theta
 
 def compute_translation_distance_between_poses(pose_a, pose_b):
@@ -209,6 +211,241 @@ def compute_angle_between_poses(pose_a, pose_b):
 
     return compute_angle_between_quaternions(quat_a, quat_b)
 
+def synchronize_timestamps(query_stamps, reference_stamps, max_skew=None):
+    """
+    Matches every query timestamp to the nearest reference timestamp in a
+    single vectorized pass. The reference timestamps don't need to be sorted.
+
+    :param query_stamps: array of N timestamps, e.g. depth image stamps in nanoseconds
+    :type query_stamps: numpy array or list
+    :param reference_stamps: array of M timestamps, e.g. rgb image stamps in nanoseconds
+    :type reference_stamps: numpy array or list
+    :param max_skew: matches with |skew| > max_skew are marked as invalid,
+    same units as the timestamps. None accepts all matches
+    :type max_skew:
+    :return: indices, skews, valid. indices[i] is the index into reference_stamps of the
+    match for query_stamps[i], skews[i] = query_stamps[i] - reference_stamps[indices[i]]
+    and valid[i] is a bool
+    :rtype: tuple of numpy arrays of length N
+    """
+
+    query_stamps = np.asarray(query_stamps)
+    reference_stamps = np.asarray(reference_stamps)
+
+    if reference_stamps.size == 0:
+        raise ValueError("can't synchronize against an empty list of reference timestamps")
+
+    sort_idx = np.argsort(reference_stamps, kind='mergesort')
+    sorted_stamps = reference_stamps[sort_idx]
+    max_idx = sorted_stamps.size - 1
+
+    # candidates are the reference stamps immediately before and after each query
+    after = np.clip(np.searchsorted(sorted_stamps, query_stamps), 0, max_idx)
+    before = np.clip(after - 1, 0, max_idx)
+
+    use_before = np.abs(query_stamps - sorted_stamps[before]) <= np.abs(sorted_stamps[after] - query_stamps)
+    indices = sort_idx[np.where(use_before, before, after)]
+    skews = query_stamps - reference_stamps[indices]
+
+    if max_skew is None:
+        valid = np.ones(query_stamps.shape, dtype=bool)
+    else:
+        valid = np.abs(skews) <= max_skew
+
+    return indices, skews, valid
+
+def compute_skew_statistics(skews):
+    """
+    Summary statistics of the absolute skew between synchronized timestamps,
+    see synchronize_timestamps
+
+    :param skews: array of skews
+    :type skews: numpy array or list
+    :return: dict with keys num_pairs, mean, median, p95, max
+    :rtype: dict
+    """
+
+    abs_skews = np.abs(np.asarray(skews, dtype=np.float64))
+
+    d = dict()
+    d['num_pairs'] = int(abs_skews.size)
+    if abs_skews.size == 0:
+        return d
+
+    d['mean'] = float(np.mean(abs_skews))
+    d['median'] = float(np.median(abs_skews))
+    d['p95'] = float(np.percentile(abs_skews, 95))
+    d['max'] = float(np.max(abs_skews))
+    return d
+
+"""
+Columnar pose data
+
+Replaces the nested per-frame dicts of pose_data.yaml with one array per field,
+stored in pose_data.npz next to the images. The columns are
+
+    index: (N,) int64, frame index
+    timestamp: (N,) int64, nanoseconds
+    pose: (N,7) float64, camera_to_world as [x,y,z,qw,qx,qy,qz]
+    rgb_image_filename: (N,) str
+    depth_image_filename: (N,) str
+
+pose_data.yaml can still be written as an export for humans.
+"""
+POSE_DATA_NPZ_FILENAME = "pose_data.npz"
+POSE_DATA_YAML_FILENAME = "pose_data.yaml"
+POSE_DATA_COLUMNS = ['index', 'timestamp', 'pose', 'rgb_image_filename', 'depth_image_filename']
+
+def make_pose_data_columns(indices, timestamps, poses, rgb_image_filenames, depth_image_filenames):
+    """
+    Builds the pose data columns from lists
+
+    :param poses: list of [x,y,z,qw,qx,qy,qz]
+    :return: dict of numpy arrays
+    :rtype: dict
+    """
+    columns = dict()
+    columns['index'] = np.asarray(indices, dtype=np.int64).reshape(-1)
+    columns['timestamp'] = np.asarray(timestamps, dtype=np.int64).reshape(-1)
+    columns['pose'] = np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+    columns['rgb_image_filename'] = np.asarray(rgb_image_filenames, dtype=np.str_).reshape(-1)
+    columns['depth_image_filename'] = np.asarray(depth_image_filenames, dtype=np.str_).reshape(-1)
+    return columns
+
+def pose_data_columns_from_dict(pose_data):
+    """
+    Converts the pose_data.yaml dict format to columns
+    """
+    indices = sorted(pose_data.keys())
+    poses = []
+    for i in indices:
+        d = pose_data[i]['camera_to_world']
+        quat = getQuaternionFromDict(d)
+        poses.append([d['translation']['x'], d['translation']['y'], d['translation']['z'],
+                      quat['w'], quat['x'], quat['y'], quat['z']])
+
+    return make_pose_data_columns(indices,
+                                  [pose_data[i]['timestamp'] for i in indices],
+                                  poses,
+                                  [pose_data[i]['rgb_image_filename'] for i in indices],
+                                  [pose_data[i]['depth_image_filename'] for i in indices])
+
+def pose_data_dict_from_columns(columns):
+    """
+    Converts columns back to the pose_data.yaml dict format
+    """
+    pose_data = dict()
+    for j in xrange(len(columns['index'])):
+        pose = columns['pose'][j].tolist()
+        d = dict()
+        d['camera_to_world'] = dictFromPosQuat(pose[0:3], pose[3:7])
+        d['timestamp'] = int(columns['timestamp'][j])
+        d['rgb_image_filename'] = str(columns['rgb_image_filename'][j])
+        d['depth_image_filename'] = str(columns['depth_image_filename'][j])
+        pose_data[int(columns['index'][j])] = d
+
+    return pose_data
+
+def select_pose_data(columns, rows):
+    """
+    Subset of the pose data
+
+    :param rows: boolean mask or integer array of rows (not frame indices) to keep
+    :return: dict of numpy arrays
+    """
+    selected = dict()
+    for key in POSE_DATA_COLUMNS:
+        selected[key] = columns[key][rows]
+    return selected
+
+def save_pose_data_npz(columns, filename):
+    """
+    Writes the columns to an uncompressed npz file. The file is written to a
+    temporary name first and renamed, so readers never see a partial file.
+    """
+    # np.savez appends .npz to filenames that don't already end in it
+    tmp_filename = filename + ".tmp.npz"
+    np.savez(tmp_filename, **dict((key, columns[key]) for key in POSE_DATA_COLUMNS))
+    os.rename(tmp_filename, filename)
+
+def load_pose_data_npz(filename):
+    """
+    :return: dict of numpy arrays, see POSE_DATA_COLUMNS
+    :rtype: dict
+    """
+    data = np.load(filename)
+    try:
+        columns = dict()
+        for key in POSE_DATA_COLUMNS:
+            columns[key] = data[key]
+    finally:
+        data.close()
+
+    return columns
+
+def export_pose_data_to_yaml(columns, filename):
+    saveToYaml(pose_data_dict_from_columns(columns), filename)
+
+def get_pose_data_filename(images_dir):
+    """
+    pose_data.npz if it exists (or neither file exists), otherwise pose_data.yaml
+    for scenes extracted before the columnar format
+    """
+    npz_filename = os.path.join(images_dir, POSE_DATA_NPZ_FILENAME)
+    yaml_filename = os.path.join(images_dir, POSE_DATA_YAML_FILENAME)
+    if os.path.exists(yaml_filename) and not os.path.exists(npz_filename):
+        return yaml_filename
+
+    return npz_filename
+
+def load_pose_data(images_dir):
+    """
+    Loads the pose data of a folder of images, falling back to pose_data.yaml
+    if there is no pose_data.npz
+
+    :return: dict of numpy arrays, see POSE_DATA_COLUMNS
+    :rtype: dict
+    """
+    filename = get_pose_data_filename(images_dir)
+    if filename.endswith(".yaml"):
+        return pose_data_columns_from_dict(getDictFromYamlFilename(filename))
+
+    return load_pose_data_npz(filename)
+
+def save_pose_data(columns, images_dir, export_yaml=True):
+    """
+    Writes pose_data.npz, and pose_data.yaml if export_yaml is True
+    """
+    save_pose_data_npz(columns, os.path.join(images_dir, POSE_DATA_NPZ_FILENAME))
+    if export_yaml:
+        export_pose_data_to_yaml(columns, os.path.join(images_dir, POSE_DATA_YAML_FILENAME))
+
+def homogenous_transforms_from_poses(poses):
+    """
+    Vectorized homogenous_transform_from_dict
+
+    :param poses: N x 7 array of [x,y,z,qw,qx,qy,qz]
+    :return: N x 4 x 4 array of homogeneous transforms
+    """
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+    q = poses[:, 3:7]
+    q = q / np.linalg.norm(q, axis=1)[:, np.newaxis]
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+
+    T = np.zeros((poses.shape[0], 4, 4))
+    T[:, 0, 0] = 1.0 - 2.0*(y*y + z*z)
+    T[:, 0, 1] = 2.0*(x*y - z*w)
+    T[:, 0, 2] = 2.0*(x*z + y*w)
+    T[:, 1, 0] = 2.0*(x*y + z*w)
+    T[:, 1, 1] = 1.0 - 2.0*(x*x + z*z)
+    T[:, 1, 2] = 2.0*(y*z - x*w)
+    T[:, 2, 0] = 2.0*(x*z - y*w)
+    T[:, 2, 1] = 2.0*(y*z + x*w)
+    T[:, 2, 2] = 1.0 - 2.0*(x*x + y*y)
+    T[:, 0:3, 3] = poses[:, 0:3]
+    T[:, 3, 3] = 1.0
+    return T
+
 def get_kuka_joint_names():
     return [
      'iiwa_joint_1', 'iiwa_joint_2', 'iiwa_joint_3',
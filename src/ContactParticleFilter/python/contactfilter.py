@@ -10,6 +10,7 @@ import csv
 import copy
 import time
 import itertools
+import weakref
 import scipy.stats
 import sys
 import yaml
@@ -35,6 +36,8 @@ import cpf_lcmtypes
 import contactpointlocator
 import contactfilterutils as cfUtils
 import qpsolver
+import multicontactevaluator
+import contactfilterengine
 from pythondrakemodel import PythonDrakeModel
 
 
@@ -47,14 +50,32 @@ MU = 0.4
 
 class ContactFilter(object):
 
-    def __init__(self, robotStateModel, robotStateJointController, configFilename="contact_particle_filter_config.yaml"):
+    def __init__(self, robotStateModel, robotStateJointController, configFilename="contact_particle_filter_config.yaml",
+                 drakeModel=None):
+        """
+        :param drakeModel: optional PythonDrakeModel to share (along with its jacobian cache)
+        with e.g. ExternalForce, if None a new one is loaded. It can't be shared when the
+        filter runs on the async engine, see initializeEngine, a new one is loaded then
+        """
 
         print "initializing the contact filter"
 
         self.robotStateJointController = robotStateJointController
         self.robotStateModel = robotStateModel
         self.options = cfUtils.loadConfig(configFilename)
-        self.loadDrakeModelFromFilename()
+
+        # the engine worker thread sets the joint positions of the drake model and reads its
+        # link jacobians, so it can't share the model with anything running on the GUI thread
+        if (drakeModel is not None) and self.options['engine']['async']:
+            print "WARNING: the contact filter runs on the async engine, so it can't share the drake model " \
+                  "and its jacobian cache with the GUI thread. Loading a separate one."
+            drakeModel = None
+
+        if drakeModel is None:
+            self.loadDrakeModelFromFilename()
+        else:
+            self.drakeModel = drakeModel
+        self.initializeJacobianCache()
         self.initializeRobotPoseTranslator()
         self.initializeConstants()
         self.initializeDebugInfo()
@@ -77,6 +98,7 @@ class ContactFilter(object):
 
         self.setupMotionModelData()
         self.setCurrentUtime(0)
+        self.lastVisualizationDataPublishTime = None
 
         self.residual = None
         self.particleSetList = []
@@ -88,6 +110,7 @@ class ContactFilter(object):
 
         self.initializeTestTimers()
         self.initializeContactFilterState()
+        self.initializeEngine()
 
         #only initialize gurobi model if option to load all solvers is set
         if self.options['solver']['loadAllSolvers']:
@@ -99,9 +122,28 @@ class ContactFilter(object):
 
     def start(self):
         self.running = True
+        if self.engine is not None:
+            self.engine.start()
 
     def stop(self):
         self.running = False
+        if self.engine is not None:
+            self.engine.stop()
+        self.poseSnapshot = None
+
+    def initializeEngine(self):
+        """
+        If enabled the filter steps run on a ContactFilterEngine worker thread,
+        otherwise they run directly in the residual subscriber callback
+        """
+        # director pose captured together with the residual, see getCurrentPose
+        self.poseSnapshot = None
+        self.engine = None
+        if self.options['engine']['async']:
+            drawRate = None
+            if self.options['vis']['draw']:
+                drawRate = self.options['engine']['drawRate']
+            self.engine = contactfilterengine.ContactFilterEngine(self, drawRate=drawRate)
 
 
     def addSubscribers(self):
@@ -143,17 +185,46 @@ class ContactFilter(object):
         self.debugInfo = {}
         self.debugInfo['forceThreshold'] = 1.0
         self.debugInfo['numQPSolves'] = 0
+        self.debugInfo['numWarmStartedQPSolves'] = 0
+        self.debugInfo['numColdStartedQPSolves'] = 0
         self.debugInfo['totalQPSolveTime'] = 0.0
+        self.debugInfo['warmStartedQPSolveTime'] = 0.0
+        self.debugInfo['coldStartedQPSolveTime'] = 0.0
+        self.debugInfo['avgWarmStartedQPSolveTime'] = None
+        self.debugInfo['avgColdStartedQPSolveTime'] = None
         self.debugInfo['jacobianTime'] = 0.0
         self.debugInfo['measurementUpdateTime'] = 0.0
         self.debugInfo['avgQPSolveTime'] = 0.0
         self.debugInfo['haveShownLikelihoodPlot'] = False
 
+    def initializeJacobianCache(self):
+        # H = J^T * J_alpha for each ContactFilterPoint at the pose with
+        # self.frictionConeJacobianCacheVersion. Weak keys so that entries for
+        # cfp's that are no longer referenced by any particle are dropped
+        self.frictionConeJacobianCache = weakref.WeakKeyDictionary()
+        self.frictionConeJacobianCacheVersion = None
+
     def printDebugInfo(self):
         print ""
         print "avg QP Solve Time: ", self.debugInfo['avgQPSolveTime']
+        print "warm started QP solves: ", self.debugInfo['numWarmStartedQPSolves'], "/", self.debugInfo['numQPSolves']
+        print "avg batched QP solve time (warm started, cold started): ", \
+            (self.debugInfo['avgWarmStartedQPSolveTime'], self.debugInfo['avgColdStartedQPSolveTime'])
         print "total QP Solve Time ", self.debugInfo['totalQPSolveTime']
         print "measurement update time: ", self.debugInfo['measurementUpdateTime']
+        print "jacobian time: ", self.debugInfo['jacobianTime']
+        print "link jacobian cache (hits, misses): ", (self.drakeModel.jacobianCacheStats['hits'],
+                                                      self.drakeModel.jacobianCacheStats['misses'])
+        if self.engine is not None:
+            self.engine.printStats()
+        if 'multiContactHypotheses' in self.debugInfo:
+            print "multi contact hypotheses (total, evaluated, pruned): ", \
+                (self.debugInfo['multiContactHypotheses']['numHypotheses'],
+                 self.debugInfo['multiContactHypotheses']['numEvaluated'],
+                 self.debugInfo['multiContactHypotheses']['numPruned'])
+        if self.contactPointLocator.options['mode'] == 'kdtree':
+            print "contact point locator kdtree (builds, queries): ", (self.contactPointLocator.kdTreeStats['builds'],
+                                                                      self.contactPointLocator.kdTreeStats['queries'])
         print ""
 
 
@@ -166,7 +237,8 @@ class ContactFilter(object):
     def initializeContactPointLocator(self):
         self.contactPointLocator = contactpointlocator.ContactPointLocator(self.robotStateModel,
                                                                            self.linkFrameContainer,
-                                                                           self.options['data']['contactCells'])
+                                                                           self.options['data']['contactCells'],
+                                                                           options=self.options['contactPointLocator'])
 
     def initializeRobotPoseTranslator(self):
         self.robotPoseTranslator = cfUtils.RobotPoseTranslator(self.robotStateModel.model, self.drakeModel.model)
@@ -201,13 +273,13 @@ class ContactFilter(object):
 
 
     def squaredErrorNoContacts(self, verbose=True, residual=None):
-        if self.residual is None:
-            "don't have a residual, returning"
-            return
-
         if residual is None:
             residual = self.residual
 
+        if residual is None:
+            "don't have a residual, returning"
+            return
+
         squaredError =np.dot(np.dot((residual).transpose(), self.weightMatrix),
                                     (residual))
 
@@ -262,18 +334,19 @@ class ContactFilter(object):
 
             self.contactFilterPointListAll.append(contactFilterPoint)
 
+        # stacked J_alpha's of the contact filter points on each link, used to compute H
+        # for all of them at once, see precomputeJacobiansToFrictionConeForLinks
+        self.contactFilterPointJAlphaStack = dict()
+        for linkName, cfpList in self.contactFilterPointDict.iteritems():
+            self.contactFilterPointJAlphaStack[linkName] = np.array([cfp.J_alpha for cfp in cfpList])
+
     def initializeSeedParticleSet(self):
         """
         Sets up the seed particle set. Just copies from self.contactFilterPointListAll
         :return: None
         """
-        particleListCopy = []
-        for contactFilterPoint in self.contactFilterPointListAll:
-            particle = ContactFilterParticle(cfp=contactFilterPoint)
-            particleListCopy.append(particle)
-
         self.seedParticleSet = SingleContactParticleSetWithRandomSampling()
-        self.seedParticleSet.particleList = particleListCopy
+        self.seedParticleSet.addContactFilterPoints(self.contactFilterPointListAll)
         self.seedParticleSet.setupRandomSampling()
 
 
@@ -281,70 +354,82 @@ class ContactFilter(object):
 
     # TODO (manuelli): DEPRECATED, remove this
     def setupMotionModelData(self, withinLinkOnly=False):
-        # need to make sure you call loadContactFilterPointsFromFile before you get here
+        """
+        Sets up the discrete motion model over self.contactFilterPointListAll.
+        The probability of moving between two contact filter points is proportional
+        to exp(-d^2/(2*var)), where d is their distance in world frame at the zero
+        pose q = zeros. Transitions further than transitionTableNumStdDev standard
+        deviations are dropped, and the resulting sparse table is cached on disk.
 
-        self.motionModelData = {}
+        :param withinLinkOnly: only allow transitions to points on the same link
+        """
+        # need to make sure you call loadContactFilterPointsFromFile before you get here
         var = self.options['motionModel']['var']
+        numStdDev = self.options['motionModel']['transitionTableNumStdDev']
+
+        self.motionModelCFPList = self.contactFilterPointListAll
+        self.motionModelCFPIndex = dict((cfp, idx) for idx, cfp in enumerate(self.motionModelCFPList))
+        worldPositions = self.getCFPLocationsAtZeroPose(self.motionModelCFPList)
+
+        cacheFilename = self.getMotionModelCacheFilename(var, numStdDev, withinLinkOnly)
+        if os.path.exists(cacheFilename):
+            table, data = cfUtils.SparseTransitionTable.load(cacheFilename)
+            # guards against the robot model changing under the same contact points file
+            if (data['worldPositions'].shape == worldPositions.shape) and np.allclose(data['worldPositions'],
+                                                                                       worldPositions):
+                self.motionModelTransitionTable = table
+                return
 
+        groups = None
         if withinLinkOnly:
-            # only allows motion modle to put positive probability on other particles in the
-            # same link
-            for linkName, cfpList in self.contactFilterPointDict.iteritems():
-                for cfp in cfpList:
-                    numCFP = len(cfpList)
-                    xk = np.arange(0,numCFP)
-                    pk = np.zeros(numCFP)
-
-                    for idx, cfpNext in enumerate(cfpList):
-                        distance = np.linalg.norm(cfp.contactLocation - cfpNext.contactLocation)
-                        prob = np.exp(-1.0/(2*var)*distance**2) # note that this is not properly normalized
-                        pk[idx] = prob
-
-                    pk = pk/np.sum(pk) #normalize the distribution so it is really a probability
-                    rv = scipy.stats.rv_discrete(values=(xk,pk))
-                    d = {'cfpList': cfpList, 'randomVar': rv}
-                    self.motionModelData[cfp] = d
-
-
-        else: # in this case we allow motion model to move any particle to any other with a given
-            # probability. The probability depends only on the cartesian distance between particles
-            # in the world frame evaluated at the zero pose of the robot q = zeros.
-
-            # default pose of zeros where we can run doKinematics to figure out
-            # the distances between the different cfp's for use in the motion model
-            q = np.zeros(self.drakeModel.numJoints)
-            self.drakeModel.model.setJointPositions(q)
-
-            # compute location, in world frame of all
-            worldPosition = {}
-            for linkName, cfpList in self.contactFilterPointDict.iteritems():
-                linkToWorld = vtk.vtkTransform()
-                self.drakeModel.model.getLinkToWorld(linkName, linkToWorld)
-
-                for cfp in cfpList:
-                    contactPointInWorld = linkToWorld.TransformPoint(cfp.contactLocation)
-                    worldPosition[cfp] = np.array(contactPointInWorld)
-
-
-            numCFP = len(self.contactFilterPointListAll)
-            for cfp in self.contactFilterPointListAll:
-
-                cfpList = self.contactFilterPointListAll
-                xk = np.arange(0,numCFP)
-                pk = np.zeros(numCFP)
-
-                # compute distance to all other cfp's in the list. This is the distance between
-                # them in world frame evaluated at the zero pose. This is just a rough approximation for
-                # now
-                for idx, cfpNext in enumerate(cfpList):
-                    distance = np.linalg.norm(worldPosition[cfp] - worldPosition[cfpNext])
-                    prob = np.exp(-1.0/(2*var)*distance**2) # note that this is not properly normalized
-                    pk[idx] = prob
-
-                pk = pk/np.sum(pk)
-                rv = scipy.stats.rv_discrete(values=(xk,pk))
-                d = {'cfpList': cfpList, 'randomVar': rv}
-                self.motionModelData[cfp] = d
+            linkNames = [cfp.linkName for cfp in self.motionModelCFPList]
+            linkIdx = dict((linkName, idx) for idx, linkName in enumerate(sorted(set(linkNames))))
+            groups = np.array([linkIdx[linkName] for linkName in linkNames])
+
+        self.motionModelTransitionTable = cfUtils.SparseTransitionTable.fromPoints(worldPositions, var,
+                                                                                   numStdDev=numStdDev,
+                                                                                   groups=groups)
+        self.motionModelTransitionTable.save(cacheFilename, worldPositions=worldPositions)
+
+    def getCFPLocationsAtZeroPose(self, cfpList):
+        """
+        :return: N x 3 array of the world frame locations of the cfp's at q = zeros
+        """
+        # default pose of zeros where we can run doKinematics to figure out
+        # the distances between the different cfp's for use in the motion model
+        q = np.zeros(self.drakeModel.numJoints)
+        self.drakeModel.setJointPositions(q)
+
+        contactLocations = np.array([cfp.contactLocation for cfp in cfpList], dtype=np.float64).reshape(-1, 3)
+        worldPositions = np.zeros_like(contactLocations)
+
+        idxByLinkName = dict()
+        for idx, cfp in enumerate(cfpList):
+            idxByLinkName.setdefault(cfp.linkName, []).append(idx)
+
+        for linkName, idx in idxByLinkName.iteritems():
+            linkToWorld = vtk.vtkTransform()
+            self.drakeModel.model.getLinkToWorld(linkName, linkToWorld)
+            linkToWorld = transformUtils.getNumpyFromTransform(linkToWorld)
+            worldPositions[idx] = np.dot(contactLocations[idx], linkToWorld[0:3, 0:3].transpose()) + linkToWorld[0:3, 3]
+
+        return worldPositions
+
+    def getMotionModelCacheFilename(self, var, numStdDev, withinLinkOnly):
+        """
+        The cache is keyed by the contents of the contact points file and the motion model parameters
+        """
+        particleLocationsFilename = os.getenv('SPARTAN_SOURCE_DIR') + self.options['data']['initialParticleLocations']
+        key = "%s_var_%g_std_%g_%s" %(cfUtils.computeFileHash(particleLocationsFilename), var, numStdDev,
+                                      'link' if withinLinkOnly else 'all')
+
+        cacheDir = self.options['motionModel']['transitionTableCacheDir']
+        if cacheDir is None:
+            cacheDir = os.path.join(os.path.expanduser('~'), '.cache', 'contact_particle_filter')
+        else:
+            cacheDir = os.getenv('SPARTAN_SOURCE_DIR') + cacheDir
+
+        return os.path.join(cacheDir, 'motion_model_' + key + '.npz')
 
 
     def initializeGurobiModel(self):
@@ -359,14 +444,27 @@ class ContactFilter(object):
         numContactsList = [1,2,3,4]
         self.qpSolver = qpsolver.QPSolver(numContactsList, self.options)
 
+        # without topK every hypothesis goes through computeLikelihoodBatch and the
+        # evaluator isn't used, don't start worker processes for it
+        multiContactOptions = self.options['multiContactEstimate']
+        numWorkers = multiContactOptions['numWorkers']
+        if multiContactOptions['topK'] is None:
+            if numWorkers > 1:
+                print "WARNING: multiContactEstimate numWorkers, prune and chunkSize only apply when topK is set, " \
+                      "evaluating all multi contact hypotheses in the filter's process"
+            numWorkers = 1
+
+        self.multiContactEvaluator = multicontactevaluator.MultiContactHypothesisEvaluator(
+            numContactsList, self.options, numWorkers=numWorkers,
+            topK=multiContactOptions['topK'], prune=multiContactOptions['prune'],
+            chunkSize=multiContactOptions['chunkSize'])
+
     def initializeTestParticleSet(self):
         # creates a particle set with all particles
         self.testParticleSet = SingleContactParticleSet(color=self.colorForParticleSets.next())
 
         for linkName, cfpList in self.contactFilterPointDict.iteritems():
-            for cfp in cfpList:
-                particle = ContactFilterParticle(cfp)
-                self.testParticleSet.addParticle(particle)
+            self.testParticleSet.addContactFilterPoints(cfpList)
 
     def createParticleSet(self, onlyUseLinks=[], dontUseLinks=[]):
         linkNames = set(self.contactFilterPointDict.keys())
@@ -383,20 +481,75 @@ class ContactFilter(object):
         particleSet = SingleContactParticleSet(color=self.colorForParticleSets.next())
 
         for link in linkNames:
-            cfpList = self.contactFilterPointDict[link]
-            for cfp in cfpList:
-                particle = ContactFilterParticle(cfp)
-                particleSet.addParticle(particle)
+            particleSet.addContactFilterPoints(self.contactFilterPointDict[link])
 
         return particleSet
 
-    # make sure you call doKinematics before getting here
+    def getFrictionConeJacobianCache(self):
+        """
+        Returns the H cache, clearing it first if the drake model pose has changed
+        """
+        if self.frictionConeJacobianCacheVersion != self.drakeModel.jointPositionsVersion:
+            self.frictionConeJacobianCache = weakref.WeakKeyDictionary()
+            self.frictionConeJacobianCacheVersion = self.drakeModel.jointPositionsVersion
+
+        return self.frictionConeJacobianCache
+
+    # make sure you call self.drakeModel.setJointPositions before getting here
     def computeJacobianToFrictionCone(self, contactPoint):
-        linkJacobian = self.drakeModel.geometricJacobian(0, contactPoint.bodyId, contactPoint.bodyId,
-                                                         0, False)
+        return self.computeJacobiansToFrictionCone([contactPoint])[0]
+
+    def computeJacobiansToFrictionCone(self, cfpList):
+        """
+        Computes H = J^T * J_alpha for each cfp in cfpList. The link jacobian is
+        computed once per body, and H for all the cfp's on that body is computed
+        in a single vectorized pass. Results are cached until the joint positions
+        of the drake model change.
+
+        :return: list of H, one for each cfp
+        """
+        startTime = time.time()
+        cache = self.getFrictionConeJacobianCache()
+
+        cfpToComputeByBodyId = dict()
+        seen = set()
+        for cfp in cfpList:
+            if (cfp in cache) or (cfp in seen):
+                continue
+            seen.add(cfp)
+            cfpToComputeByBodyId.setdefault(cfp.bodyId, []).append(cfp)
 
-        H = np.dot(linkJacobian.transpose(), contactPoint.J_alpha)
-        return H
+        for bodyId, cfpToCompute in cfpToComputeByBodyId.iteritems():
+            J_alpha = np.array([cfp.J_alpha for cfp in cfpToCompute])
+            H = self.computeJacobiansToFrictionConeSingleBody(bodyId, J_alpha)
+            for idx, cfp in enumerate(cfpToCompute):
+                cache[cfp] = H[idx]
+
+        self.debugInfo['jacobianTime'] += time.time() - startTime
+        return [cache[cfp] for cfp in cfpList]
+
+    def computeJacobiansToFrictionConeSingleBody(self, bodyId, J_alpha):
+        """
+        :param J_alpha: k x 6 x 4 stack of J_alpha's for contact points on body bodyId
+        :return: k x numJoints x 4 stack of H's
+        """
+        linkJacobian = self.drakeModel.getLinkJacobian(bodyId)
+        return np.einsum('wn,kwa->kna', linkJacobian, J_alpha)
+
+    def precomputeJacobiansToFrictionConeForLinks(self, linkNames):
+        """
+        Fills the H cache for all the contact filter points on the given links
+        """
+        cache = self.getFrictionConeJacobianCache()
+        for linkName in linkNames:
+            cfpList = self.contactFilterPointDict[linkName]
+            if cfpList[0] in cache:
+                continue
+
+            H = self.computeJacobiansToFrictionConeSingleBody(cfpList[0].bodyId,
+                                                              self.contactFilterPointJAlphaStack[linkName])
+            for idx, cfp in enumerate(cfpList):
+                cache[cfp] = H[idx]
 
 
     # inside this need to setup and solve the QP . . .
@@ -405,12 +558,7 @@ class ContactFilter(object):
     def computeSingleLikelihood(self, residual, cfpList):
 
 
-        # this section could be slow
-        H_list = []
-        for cfp in cfpList:
-            H_list.append(self.computeJacobianToFrictionCone(cfp))
-
-        # self.debugInfo['jacobianTime'] += time.time() - startTime
+        H_list = self.computeJacobiansToFrictionCone(cfpList)
 
         # this is where the solve is really happening
         numContacts = len(cfpList)
@@ -427,6 +575,77 @@ class ContactFilter(object):
             for j in xrange(0, FRICTION_CONE_APPROX_SIZE):
                 alphaVals[i,j] = qpSolnData['alphaVals'][i,j]
 
+        return self.computeSolnDataFromAlphaVals(residual, cfpList, H_list, alphaVals, qpSolnData['objectiveValue'])
+
+    def computeLikelihoodBatch(self, residual, cfpListBatch, initialPassive=None):
+        """
+        Same as calling computeSingleLikelihood for each cfpList in cfpListBatch,
+        but all the QPs are handed to the solver at once. With the nnls solver
+        they are solved together in a single vectorized pass.
+
+        :param cfpListBatch: list of cfpList's, all with the same number of contact points
+        :param initialPassive: optional warm start for the nnls solver, see QPSolver.solveBatch.
+        The problems with and without a warm start are solved as separate batches, so
+        that their solve times can be compared in debugInfo
+        :return: list of solnData
+        """
+        if len(cfpListBatch) == 0:
+            return []
+
+        numContacts = len(cfpListBatch[0])
+        for cfpList in cfpListBatch:
+            if len(cfpList) != numContacts:
+                raise ValueError("all cfpList's in a batch must have the same number of contact points")
+
+        # compute all the H's in one pass, then split them back up
+        H_all = self.computeJacobiansToFrictionCone([cfp for cfpList in cfpListBatch for cfp in cfpList])
+        H_list_batch = [H_all[idx*numContacts:(idx+1)*numContacts] for idx in xrange(len(cfpListBatch))]
+
+        H = np.array([np.concatenate(H_list, axis=1) for H_list in H_list_batch])
+
+        warmStarted = np.zeros(len(cfpListBatch), dtype=bool)
+        if initialPassive is not None:
+            warmStarted = np.any(initialPassive, axis=1)
+
+        alpha = np.zeros((len(cfpListBatch), numContacts*FRICTION_CONE_APPROX_SIZE))
+        objectiveValue = np.zeros(len(cfpListBatch))
+        for isWarmStarted in [True, False]:
+            batchIdx = np.flatnonzero(warmStarted == isWarmStarted)
+            if len(batchIdx) == 0:
+                continue
+
+            startTime = time.time()
+            qpSolnData = self.qpSolver.solveBatch(numContacts, residual, H[batchIdx], self.weightMatrix,
+                                                  solverType=self.options['solver']['solverType'],
+                                                  initialPassive=initialPassive[batchIdx] if isWarmStarted else None)
+            elapsedTime = time.time() - startTime
+
+            alpha[batchIdx] = qpSolnData['alpha']
+            objectiveValue[batchIdx] = qpSolnData['objectiveValue']
+
+            self.debugInfo['totalQPSolveTime'] += elapsedTime
+            self.debugInfo['numQPSolves'] += 1.0*len(batchIdx)
+            if isWarmStarted:
+                self.debugInfo['warmStartedQPSolveTime'] += elapsedTime
+                self.debugInfo['numWarmStartedQPSolves'] += 1.0*len(batchIdx)
+            else:
+                self.debugInfo['coldStartedQPSolveTime'] += elapsedTime
+                self.debugInfo['numColdStartedQPSolves'] += 1.0*len(batchIdx)
+
+        alphaValsBatch = alpha.reshape(len(cfpListBatch), numContacts, FRICTION_CONE_APPROX_SIZE)
+        solnDataList = []
+        for idx, cfpList in enumerate(cfpListBatch):
+            solnDataList.append(self.computeSolnDataFromAlphaVals(residual, cfpList, H_list_batch[idx],
+                                                                  alphaValsBatch[idx], objectiveValue[idx]))
+
+        return solnDataList
+
+    def computeSolnDataFromAlphaVals(self, residual, cfpList, H_list, alphaVals, qpObjValue):
+        """
+        Computes the implied residual, squared error and likelihood given the QP solution
+
+        :param alphaVals: numContacts x FRICTION_CONE_APPROX_SIZE array
+        """
         cfpData = []
         impliedResidual = 0*residual
         for idx, cfp in enumerate(cfpList):
@@ -448,24 +667,52 @@ class ContactFilter(object):
 
         # record the data somehow . . .
         solnData = {'cfpData': cfpData, 'impliedResidual': impliedResidual, 'squaredError': squaredError,
-                    "numContactPoints": len(cfpList), 'qpObjValue': qpSolnData['objectiveValue'],
+                    "numContactPoints": len(cfpList), 'qpObjValue': qpObjValue,
                     'likelihood': likelihood, 'likelihoodExponent': likelihoodExponent, 'time': self.currentTime}
         return solnData
 
+    def computeLikelihoodMultiContactTopK(self, residual, activeLinkContactPointList):
+        """
+        Evaluates all the combinations of one contact point per active link, but
+        only the best hypotheses, by QP objective, get full solnData.
+        See MultiContactHypothesisEvaluator.
+
+        :param activeLinkContactPointList: list of cfpList's, one per active link
+        :return: list of solnData sorted by QP objective, smallest first
+        """
+        H_list_per_link = [self.computeJacobiansToFrictionCone(cfpList) for cfpList in activeLinkContactPointList]
+        H_stacks = [np.array(H_list) for H_list in H_list_per_link]
+
+        startTime = time.time()
+        hypotheses = self.multiContactEvaluator.evaluate(self.qpSolver, residual, self.weightMatrix, H_stacks,
+                                                         self.options['solver']['solverType'])
+
+        stats = self.multiContactEvaluator.stats
+        self.debugInfo['totalQPSolveTime'] += time.time() - startTime
+        self.debugInfo['numQPSolves'] += 1.0*stats['numEvaluated']
+        self.debugInfo['multiContactHypotheses'] = stats
+
+        solnDataList = []
+        for qpObjValue, indexTuple, alphaVals in hypotheses:
+            cfpList = [activeLinkContactPointList[i][idx] for i, idx in enumerate(indexTuple)]
+            H_list = [H_list_per_link[i][idx] for i, idx in enumerate(indexTuple)]
+            solnDataList.append(self.computeSolnDataFromAlphaVals(residual, cfpList, H_list, alphaVals, qpObjValue))
+
+        return solnDataList
+
     def computeLikelihoodFull(self, residual, publish=True, verbose=False):
 
 
         q = self.getCurrentPose()
-        self.drakeModel.model.setJointPositions(q)
+        self.drakeModel.setJointPositions(q)
 
         startTime = time.time()
         # this stores the current measurement update information
         self.measurementUpdateSolnDataList = []
 
         if not self.doMultiContactEstimate:
-            for linkName, cfpList in self.contactFilterPointDict.iteritems():
-                for cfp in cfpList:
-                    self.measurementUpdateSolnDataList.append(self.computeSingleLikelihood(residual, [cfp]))
+            cfpListBatch = [[cfp] for cfp in self.contactFilterPointListAll]
+            self.measurementUpdateSolnDataList.extend(self.computeLikelihoodBatch(residual, cfpListBatch))
 
 
         if self.doMultiContactEstimate:
@@ -476,9 +723,14 @@ class ContactFilter(object):
             for linkName in self.linksWithExternalForce:
                 activeLinkContactPointList.append(self.contactFilterPointDict[linkName])
 
-            for cfpList in itertools.product(*activeLinkContactPointList):
-                solnData = self.computeSingleLikelihood(residual, cfpList)
-                self.measurementUpdateSolnDataList.append(solnData)
+            self.precomputeJacobiansToFrictionConeForLinks(self.linksWithExternalForce)
+
+            if self.options['multiContactEstimate']['topK'] is None:
+                cfpListBatch = list(itertools.product(*activeLinkContactPointList))
+                self.measurementUpdateSolnDataList.extend(self.computeLikelihoodBatch(residual, cfpListBatch))
+            else:
+                self.measurementUpdateSolnDataList.extend(
+                    self.computeLikelihoodMultiContactTopK(residual, activeLinkContactPointList))
 
         elapsedTime = time.time() - startTime
         if verbose:
@@ -492,49 +744,80 @@ class ContactFilter(object):
     def measurementUpdateSingleParticleSet(self, residual, particleSet, externalParticles = []):
         q = self.getCurrentPose()
 
-        # be careful here, this doKinematics call could be the slow thing? But hopefully not because
-        # this call is ultimately getting pushed through to c++
-        self.drakeModel.model.setJointPositions(q)
-        # be smart about it, see if we have already computed the QP for a particle with the same cfp!!!
+        # this is a no-op if q hasn't changed, otherwise it invalidates the jacobian caches
+        self.drakeModel.setJointPositions(q)
 
-        alreadySolved = {} # should be a dict with ContactFilterPoint as key, solnData as key
-        externalCFPList = []
+        externalCFPList = [particle.cfp for particle in externalParticles]
 
-        for particle in externalParticles:
-            externalCFPList.append(particle.cfp)
+        # only solve one QP per distinct contact filter point, all the particles
+        # at that cfp share its soln data
+        cfpIdxToSolve, firstParticleIdx, solnIdx = np.unique(particleSet.cfpIdx, return_index=True,
+                                                             return_inverse=True)
+        cfpListToSolve = [particleSet.cfpList[idx] for idx in cfpIdxToSolve]
+        cfpListBatch = [[cfp] + externalCFPList for cfp in cfpListToSolve]
 
-        for particle in particleSet.particleList:
+        # only the nnls solver can make use of a warm start
+        initialPassive = None
+        if self.options['solver']['warmStart'] and (self.options['solver']['solverType'] == 'nnls'):
+            initialPassive = self.getQPWarmStart(particleSet, cfpListToSolve, firstParticleIdx, externalCFPList)
 
-            # check if we have already solved the problem for this particular contact filter point
-            if particle.cfp in alreadySolved:
+        solnDataList = self.computeLikelihoodBatch(residual, cfpListBatch, initialPassive=initialPassive)
 
-                # this deepcopy is what's killing us
-                # solnDataCopy = copy.deepcopy(alreadySolved[particle.cfp].solnData)
-                particle.solnData = alreadySolved[particle.cfp]
-            else:
-                cfpList = [particle.cfp]
-                cfpList.extend(externalCFPList)
+        # the cache only keeps the QPs of this update, entries for cfp's that no
+        # particle of the set is at anymore are dropped
+        particleSet.qpWarmStartCache = dict()
+        for cfp, solnData in zip(cfpListToSolve, solnDataList):
+            solnData['force'] = solnData['cfpData'][0]['force']
 
-                particleList = [particle]
-                particleList.extend(externalParticles)
+            # this just makes sure we record the particle in addition to the cfp in the soln data,
+            # the particle for this particle set is only built on demand, see SingleContactParticleSet.getParticle
+            solnData['cfpData'][0]['particle'] = None
+            for idx, particle in enumerate(externalParticles):
+                solnData['cfpData'][idx+1]['particle'] = particle
 
-                solnData = self.computeSingleLikelihood(residual, cfpList)
-                solnData['force'] = solnData['cfpData'][0]['force']
+            particleSet.qpWarmStartCache[cfp] = {'externalCFPs': tuple(externalCFPList),
+                                                 'passive': np.concatenate([d['alpha'] for d in solnData['cfpData']]) > 0}
 
-                # this just makes sure we record the particle in addition to the cfp in the soln data
-                for idx, d in enumerate(solnData['cfpData']):
-                    d['particle'] = particleList[idx]
-
-                particle.solnData = solnData
-                alreadySolved[particle.cfp] = solnData
+        particleSet.setSolnData(solnDataList, solnIdx)
 
         # note this doesn't update the most likely particle
         # only do that after doing importance resampling
 
+    def getQPWarmStart(self, particleSet, cfpList, particleIdx, externalCFPList):
+        """
+        Guess of the active set for the QP of each cfp in cfpList. Uses, in order
+        - the QP solved for the same cfp with the same external cfp's in the last
+          measurement update of the particle set
+        - the soln data from the previous step of the particle at particleIdx, the
+          particle may have moved to a nearby cfp since then
+        otherwise the QP is solved cold.
+
+        :param particleIdx: for each cfp, a particle of particleSet at it
+        :return: B x 4*numContacts boolean array
+        """
+        numContacts = 1 + len(externalCFPList)
+        externalCFPs = tuple(externalCFPList)
+        initialPassive = np.zeros((len(cfpList), numContacts*FRICTION_CONE_APPROX_SIZE), dtype=bool)
+
+        for idx, cfp in enumerate(cfpList):
+            cached = particleSet.qpWarmStartCache.get(cfp)
+            solnIdx = particleSet.solnIdx[particleIdx[idx]]
+            solnData = particleSet.solnDataList[solnIdx] if solnIdx >= 0 else None
+            if (cached is not None) and (cached['externalCFPs'] == externalCFPs):
+                initialPassive[idx] = cached['passive']
+            elif (solnData is not None) and (solnData.get('numContactPoints') == numContacts):
+                initialPassive[idx] = np.concatenate([d['alpha'] for d in solnData['cfpData']]) > 0
+
+        return initialPassive
+
     def computeMeasurementUpdate(self, residual, publish=True):
 
         self.debugInfo['numQPSolves'] = 0.0
+        self.debugInfo['numWarmStartedQPSolves'] = 0.0
+        self.debugInfo['numColdStartedQPSolves'] = 0.0
         self.debugInfo['totalQPSolveTime'] = 0.0
+        self.debugInfo['warmStartedQPSolveTime'] = 0.0
+        self.debugInfo['coldStartedQPSolveTime'] = 0.0
         self.debugInfo['jacobianTime'] = 0.0
 
         startTime = time.time()
@@ -559,6 +842,17 @@ class ContactFilter(object):
         else:
             self.debugInfo['avgQPSolveTime'] = None
 
+        # per QP solve time with and without a warm start, to see what the warm start buys
+        self.debugInfo['avgWarmStartedQPSolveTime'] = None
+        if self.debugInfo['numWarmStartedQPSolves'] > 0:
+            self.debugInfo['avgWarmStartedQPSolveTime'] = \
+                self.debugInfo['warmStartedQPSolveTime']/self.debugInfo['numWarmStartedQPSolves']
+
+        self.debugInfo['avgColdStartedQPSolveTime'] = None
+        if self.debugInfo['numColdStartedQPSolves'] > 0:
+            self.debugInfo['avgColdStartedQPSolveTime'] = \
+                self.debugInfo['coldStartedQPSolveTime']/self.debugInfo['numColdStartedQPSolves']
+
         if publish:
             self.publishMostLikelyEstimate()
 
@@ -625,10 +919,12 @@ class ContactFilter(object):
             self.state.lastTimeBelowAddContactPointThreshold = self.currentTime
 
 
-    def manageParticleSets(self, verbose=True):
+    def manageParticleSets(self, verbose=True, residual=None):
+        if residual is None:
+            residual = self.residual
 
         # solve the QP's that are necessary for particle set removal
-        self.measurementUpdateForParticleSetRemoval(self.residual)
+        self.measurementUpdateForParticleSetRemoval(residual)
         solnData = self.mostLikelySolnData
 
         newParticleSet = None
@@ -640,7 +936,8 @@ class ContactFilter(object):
         # this means there are no particle sets at the moment
         if solnData is None:
             # if we aren't below the threshold then reset the timer
-            if (self.squaredErrorNoContacts(verbose=False) > self.options['thresholds']['addContactPointSquaredError']):
+            if (self.squaredErrorNoContacts(verbose=False, residual=residual) >
+                    self.options['thresholds']['addContactPointSquaredError']):
                 wantToAddNewParticleSet = True
 
         # this means there is at least one particle set, so we can use solnData['squaredError']
@@ -674,7 +971,7 @@ class ContactFilter(object):
 
                 if self.options['addParticleSet']['multipleInitialSteps']:
                     print "performing multiple filter steps for new particle set"
-                    self.performFilterStepsForNewParticleSet(newParticleSet)
+                    self.performFilterStepsForNewParticleSet(newParticleSet, residual=residual)
                     # reset the other particle sets to their historical most likely
                     # because we just added a new particle set which messed everything up
                     # they will get fixed on next run of this step
@@ -722,22 +1019,21 @@ class ContactFilter(object):
 
 
 
-    def applyMotionModelSingleParticleSet(self, particleSet, useNewMotionModel=True, particleList=None):
+    def applyMotionModelSingleParticleSet(self, particleSet, useNewMotionModel=True, particleIdx=None):
 
-        if particleList is None:
-            particleList = particleSet.particleList
+        if particleIdx is None:
+            particleIdx = np.arange(particleSet.getNumberOfParticles())
 
-        for particle in particleList:
-            cfp = particle.cfp
-            if useNewMotionModel:
-                cfpNext = self.motionModelSingleCFP(cfp, visualize=False)
-            else:
-                motionData = self.motionModelData[cfp]
-                cfpNextIdx = motionData['randomVar'].rvs()
-                cfpNext = motionData['cfpList'][cfpNextIdx]
+        if useNewMotionModel:
+            cfpNextList = self.motionModelFromLocations(self.getParticleLocationsInWorld(particleSet, particleIdx))
+        else:
+            # look up the transition table row once per distinct cfp
+            cfpIdx, inverse = np.unique(particleSet.cfpIdx[particleIdx], return_inverse=True)
+            rows = np.array([self.motionModelCFPIndex[particleSet.cfpList[idx]] for idx in cfpIdx], dtype=np.int64)
+            cfpNextIdx = self.motionModelTransitionTable.sample(rows[inverse])
+            cfpNextList = [self.motionModelCFPList[idx] for idx in cfpNextIdx]
 
-            particle.cfp = cfpNext
-            particle.proposalData['weight'] = 1
+        particleSet.setContactFilterPoints(particleIdx, cfpNextList, weight=1.0)
 
     def sampleFromProposalDistributionSingleParticleSet(self, particleSet):
         # if no solution data found do standard thing
@@ -747,17 +1043,16 @@ class ContactFilter(object):
 
 
 
-        particleList = particleSet.particleList
-        numParticles = len(particleList)
+        numParticles = particleSet.getNumberOfParticles()
 
         # determine which particles will get sampled normally and which will get sampled from
         # historical most likely
         normalSampleMaxIdx = int(np.floor(numParticles*self.options['proposal']['normalFraction']))
-        normalSampleParticleList = particleList[0:normalSampleMaxIdx]
-        historicalSampleParticleList = particleList[normalSampleMaxIdx:]
+        normalSampleParticleIdx = np.arange(0, normalSampleMaxIdx)
+        historicalSampleParticleIdx = np.arange(normalSampleMaxIdx, numParticles)
 
-        self.applyMotionModelSingleParticleSet(particleSet, useNewMotionModel=True, particleList=normalSampleParticleList)
-        self.sampleFromHistoricalMostLikelyProposalDistribution(particleSet, historicalSampleParticleList)
+        self.applyMotionModelSingleParticleSet(particleSet, useNewMotionModel=True, particleIdx=normalSampleParticleIdx)
+        self.sampleFromHistoricalMostLikelyProposalDistribution(particleSet, historicalSampleParticleIdx)
 
 
         # only sample from seed distribution if squared error is above some threshold
@@ -774,56 +1069,45 @@ class ContactFilter(object):
         """
         print "squared error is large, drawing randomly from seed distribution"
         numRandomParticles = self.options['proposal']['seedDistribution']['numParticles']
-        newParticles = self.seedParticleSet.drawRandomParticles(numRandomParticles)
-
-        for particle in newParticles:
-            particleSet.addParticle(particle)
+        particleSet.addContactFilterPoints(self.seedParticleSet.drawRandomContactFilterPoints(numRandomParticles))
 
 
     # most likely particle and historical most likely have to be non-zero before getting here
     # i.e. you must have done at least one measurement step
-    def sampleFromHistoricalMostLikelyProposalDistribution(self, particleSet, particleList):
+    def sampleFromHistoricalMostLikelyProposalDistribution(self, particleSet, particleIdx):
         """
         Add samples around the historical most likely point
         :param particleSet: the particleList we are modifying
-        :param particleList:
+        :param particleIdx: indices of the particles to move
         :return:
         """
 
         # this is all a bit of a hack
 
 
-        historicalMostLikelyPositionInWorld = self.getCFPLocationInWorld(particleSet.historicalMostLikely['particle'].cfp)
-        mostLikelyPositionInWorld = self.getCFPLocationInWorld(particleSet.mostLikelyParticle.cfp)
-        motionModelRV = scipy.stats.multivariate_normal(mean=mostLikelyPositionInWorld,
-                                                        cov=self.options['motionModel']['var'])
-
+        historicalMostLikelyPositionInWorld = np.array(self.getCFPLocationInWorld(particleSet.historicalMostLikely['particle'].cfp))
+        mostLikelyPositionInWorld = np.array(self.getCFPLocationInWorld(particleSet.mostLikelyParticle.cfp))
 
         proposalFraction = 1-self.options['proposal']['normalFraction']
 
+        # draw all the samples at once, both distributions are isotropic gaussians
         variance = self.options['proposal']['historical']['variance']
-        rv = scipy.stats.multivariate_normal(mean=historicalMostLikelyPositionInWorld,
-                                             cov=variance*np.eye(3))
-        for particle in particleList:
-            newLocation = rv.rvs()
-            proposalLikelihood = rv.pdf(newLocation)*proposalFraction
-            closestPointData = self.contactPointLocator.findClosestPoint(newLocation)
-            newCFP = self.createContactFilterPointFromClosestPointData(closestPointData)
-            particle.setContactFilterPoint(newCFP)
+        newLocations = historicalMostLikelyPositionInWorld + np.random.normal(scale=np.sqrt(variance),
+                                                                              size=(len(particleIdx), 3))
+        proposalLikelihood = cfUtils.isotropicGaussianPdf(newLocations, historicalMostLikelyPositionInWorld,
+                                                          variance)*proposalFraction
+        motionModelLikelihood = cfUtils.isotropicGaussianPdf(newLocations, mostLikelyPositionInWorld,
+                                                             self.options['motionModel']['var'])
 
-            # compute the weight
-            motionModelLikelihood = motionModelRV.pdf(newLocation)
-
-            particle.proposalData['proposalLikelihood'] = proposalLikelihood
-            particle.proposalData['motionModelLikelihood'] = motionModelLikelihood
-            particle.proposalData['weight'] = motionModelLikelihood/proposalLikelihood
+        closestPointDataList = self.contactPointLocator.findClosestPoints(newLocations)
+        newCFPList = [self.createContactFilterPointFromClosestPointData(d) for d in closestPointDataList]
+        particleSet.setContactFilterPoints(particleIdx, newCFPList, weight=motionModelLikelihood/proposalLikelihood)
 
 
         #add some particles exactly at the historicalMostLikely location
         historicalMostlikelyParticle = particleSet.historicalMostLikely['particle']
-        for i in xrange(self.options['proposal']['historical']['numParticlesAtActual']):
-            newParticle = historicalMostlikelyParticle.deepCopy()
-            particleSet.addParticle(newParticle)
+        numParticlesAtActual = self.options['proposal']['historical']['numParticlesAtActual']
+        particleSet.addContactFilterPoints([historicalMostlikelyParticle.cfp]*numParticlesAtActual)
 
     #TODO (manuelli): Is this used anywhere? If not should deprecate
     def sampleFromHistoricalMostLikelyProposalDistributionSingleParticle(self, particle, historicalMostLikelyPositionInWorld):
@@ -843,15 +1127,11 @@ class ContactFilter(object):
         if numParticles is None:
             # numParticles = len(particleSet.particleList)
             numParticles = self.options['numParticles']
-        newParticleList = []
-        numExistingParticles = len(particleSet.particleList)
-        xk = np.arange(0,numExistingParticles)
-        pk = np.zeros(numExistingParticles)
-        pkHack = np.zeros(numExistingParticles)
+        numExistingParticles = particleSet.getNumberOfParticles()
 
-        for idx, particle in enumerate(particleSet.particleList):
-            pk[idx] = particle.solnData['likelihood']*particle.proposalData['weight']
-            pkHack[idx] = 1/particle.solnData['squaredError']*particle.proposalData['weight']
+        proposalWeight = particleSet.weight
+        pk = particleSet.getLikelihoods()*proposalWeight
+        pkHack = 1/particleSet.getSquaredErrors()*proposalWeight
 
         # normalize the probabilities
         # having some numerical issues here, I think it is because we essentially dividing by zero or something
@@ -865,20 +1145,15 @@ class ContactFilter(object):
             pk = pkHack/np.sum(pkHack)
         else:
             pk = pk/np.sum(pk)
-        rv = scipy.stats.rv_discrete(values=(xk,pk)) # the random variable with importance weights
-
-        for i in xrange(0,numParticles):
-            # draw new particle
-            randomIdx = rv.rvs()
-            newParticle = particleSet.particleList[randomIdx].deepCopy(keepSolnData=True)
-            newParticleList.append(newParticle)
 
-        particleSet.particleList = newParticleList
+        # draw all the new particles in a single pass over the cumulative weights
+        randomIdx = cfUtils.resampleIndices(pk, numParticles, method=self.options['resampling']['method'])
+        particleSet.resample(randomIdx)
 
 
     # when we add a new particle set want to do several measurement updates until we
     # sufficiently well localize the new contact location
-    def performFilterStepsForNewParticleSet(self, newParticleSet, numSteps = 4):
+    def performFilterStepsForNewParticleSet(self, newParticleSet, numSteps = 4, residual=None):
         # do like 3 or 4 measurement udpates + motion models for this particle set . . .
         # make sure we update mostLikelySolnData for this particle at the end
 
@@ -893,20 +1168,25 @@ class ContactFilter(object):
             if False:
                 raw_input("press enter to continue filter step for new particle set")
 
-            self.performSingleFilterStepForNewParticleSet(newParticleSet, externalParticles=externalParticles)
+            self.performSingleFilterStepForNewParticleSet(newParticleSet, externalParticles=externalParticles,
+                                                          residual=residual)
             self.testParticleSetDrawAll(drawMostLikely=False, drawHistoricalMostLikely=False)
 
 
-        self.updateSingleParticleSetMostLikelyData(newParticleSet)
+        self.updateSingleParticleSetMostLikelyData(newParticleSet, residual=residual)
+
+    def performSingleFilterStepForNewParticleSet(self, newParticleSet, externalParticles=None, applyMotionModel=True,
+                                                 residual=None):
+        if residual is None:
+            residual = self.residual
 
-    def performSingleFilterStepForNewParticleSet(self, newParticleSet, externalParticles=None, applyMotionModel=True):
         if externalParticles is None:
             externalParticles = self.getExternalMostLikelyParticles(newParticleSet)
 
         if applyMotionModel:
             self.applyMotionModelSingleParticleSet(newParticleSet, useNewMotionModel=True)
 
-        self.measurementUpdateSingleParticleSet(self.residual, particleSet=newParticleSet,
+        self.measurementUpdateSingleParticleSet(residual, particleSet=newParticleSet,
                                                 externalParticles=externalParticles)
         self.importanceResamplingSingleParticleSet(newParticleSet)
 
@@ -918,40 +1198,31 @@ class ContactFilter(object):
 
 
     # takes avg of particles below some threshold
-    def updateSingleParticleSetMostLikelyData(self, particleSet, verbose=False):
-        smallestSquaredErrorParticle = None
-        particlesBelowThreshold = []
-
-
-        for particle in particleSet.particleList:
-            if (smallestSquaredErrorParticle is None or
-                    (particle.solnData['squaredError'] < smallestSquaredErrorParticle.solnData['squaredError'])):
-                smallestSquaredErrorParticle = particle
+    def updateSingleParticleSetMostLikelyData(self, particleSet, verbose=False, residual=None):
+        if residual is None:
+            residual = self.residual
 
-            if particle.solnData['squaredError'] < self.options['thresholds']['squaredErrorBoundForMostLikelyParticleAveraging']:
-                particlesBelowThreshold.append(particle)
+        squaredError = particleSet.getSquaredErrors()
+        particlesBelowThreshold = np.flatnonzero(
+            squaredError < self.options['thresholds']['squaredErrorBoundForMostLikelyParticleAveraging'])
 
 
         if len(particlesBelowThreshold) > 0:
             # find particle that is at the average
-            numParticles = len(particlesBelowThreshold)
-            particleLocationsInWorld = np.zeros((3,numParticles))
-            for idx, particle in enumerate(particlesBelowThreshold):
-                linkFrame = self.linkFrameContainer.getLinkFrame(particle.cfp.linkName)
-                particleLocationsInWorld[:,idx] = np.array(linkFrame.TransformPoint(particle.cfp.contactLocation))
-
-            particleLocationAvg = np.mean(particleLocationsInWorld, axis=1)
+            particleLocationsInWorld = self.getParticleLocationsInWorld(particleSet, particlesBelowThreshold)
+            particleLocationAvg = np.mean(particleLocationsInWorld, axis=0)
 
             closestPointData = self.contactPointLocator.findClosestPoint(particleLocationAvg)
             mostLikelyParticle = self.createContactFilterParticleFromClosestPointData(closestPointData,
                                                                                       containingParticleSet = particleSet)
             externalParticleList = self.getExternalMostLikelyParticles(particleSet)
-            self.computeSingleLikelihoodForParticle(self.residual, mostLikelyParticle, externalParticleList)
+            self.computeSingleLikelihoodForParticle(residual, mostLikelyParticle, externalParticleList)
             particleSet.setMostLikelyParticle(self.currentTime, mostLikelyParticle)
 
             if verbose:
                 print "doing average"
         else:
+            smallestSquaredErrorParticle = particleSet.getParticle(np.argmin(squaredError))
             particleSet.setMostLikelyParticle(self.currentTime, smallestSquaredErrorParticle)
             if verbose:
                 print "doing smallest squared error"
@@ -1002,11 +1273,11 @@ class ContactFilter(object):
         return externalParticles
 
 
-    def updateAllParticleSetsMostLikelyParticle(self, useAvg=True):
+    def updateAllParticleSetsMostLikelyParticle(self, useAvg=True, residual=None):
 
         for particleSet in self.particleSetList:
             if useAvg:
-                self.updateSingleParticleSetMostLikelyData(particleSet)
+                self.updateSingleParticleSetMostLikelyData(particleSet, residual=residual)
             else:
                 particleSet.updateMostLikelyParticleUsingMode(self.currentTime)
 
@@ -1077,10 +1348,10 @@ class ContactFilter(object):
         self.currentTime = 1.0*utime/1e6
 
 
-    def publishMostLikelyEstimate(self):
+    def publishMostLikelyEstimate(self, residual=None):
         # if self.mostLikelySolnData is None:
         #     return
-        self.publishEstimate(self.mostLikelySolnData)
+        self.publishEstimate(self.mostLikelySolnData, residual=residual)
 
     def getCFPLocationInWorld(self, cfp):
         linkFrame = self.linkFrameContainer.getLinkFrame(cfp.linkName)
@@ -1088,13 +1359,40 @@ class ContactFilter(object):
 
         return contactLocationInWorld
 
-    def publishEstimate(self, solnData):
+    def getCFPLocationsInWorld(self, cfpList):
+        """
+        Vectorized getCFPLocationInWorld, transforms the contact locations
+        link by link using the cached link frame matrices
+        :return: N x 3 numpy array
+        """
+        contactLocations = np.array([cfp.contactLocation for cfp in cfpList], dtype=np.float64).reshape(-1, 3)
+        contactLocationsInWorld = np.zeros_like(contactLocations)
+
+        idxByLinkName = dict()
+        for idx, cfp in enumerate(cfpList):
+            idxByLinkName.setdefault(cfp.linkName, []).append(idx)
+
+        for linkName, idx in idxByLinkName.iteritems():
+            linkToWorld = self.linkFrameContainer.getLinkFrameMatrix(linkName)
+            contactLocationsInWorld[idx] = np.dot(contactLocations[idx], linkToWorld[0:3, 0:3].transpose()) + linkToWorld[0:3, 3]
+
+        return contactLocationsInWorld
+
+    def getParticleLocationsInWorld(self, particleSet, particleIdx):
+        """
+        World locations of the particles at particleIdx, each distinct cfp is only transformed once
+        :return: N x 3 numpy array
+        """
+        cfpIdx, inverse = np.unique(particleSet.cfpIdx[particleIdx], return_inverse=True)
+        return self.getCFPLocationsInWorld([particleSet.cfpList[idx] for idx in cfpIdx])[inverse]
+
+    def publishEstimate(self, solnData, residual=None):
 
         if solnData is None:
             msg = cpf_lcmtypes.contact_filter_estimate_t()
             msg.utime = self.currentUtime
             msg.num_contact_points = 0
-            msg.logLikelihood = self.squaredErrorNoContacts(verbose=False)
+            msg.logLikelihood = self.squaredErrorNoContacts(verbose=False, residual=residual)
             lcmUtils.publish(self.contactEstimatePublishChannel, msg)
             return
 
@@ -1150,40 +1448,64 @@ class ContactFilter(object):
     # for example if we are FIXED base and director has ROLLPITCHYAW
     def getCurrentPose(self):
         q_director = self.robotStateJointController.q
+        if self.poseSnapshot is not None:
+            q_director = self.poseSnapshot
         q = self.robotPoseTranslator.translateDirectorPoseToRobotPose(q_director)
         return q
 
     def onResidualObserverState(self, msg):
-        self.setCurrentUtime(msg.utime)
         msgJointNames = msg.joint_name
         msgData = msg.residual
 
         residual = self.drakeModel.extractDataFromMessage(msgJointNames, msgData)
-        self.residual = residual
 
         if self.options['noise']['addNoise']:
-            residualSize = np.size(self.residual)
-            self.residual = self.residual + np.random.normal(scale=self.options['noise']['stddev'], size=residualSize)
+            residualSize = np.size(residual)
+            residual = residual + np.random.normal(scale=self.options['noise']['stddev'], size=residualSize)
+
+        # while the async engine runs the filter state belongs to the worker thread, it
+        # sets the utime and residual from the snapshot when it processes it. When the
+        # filter is stopped the worker is too, and steps are driven by the caller
+        # (e.g. cpfbenchmark.py) from self.residual
+        if (self.engine is not None) and self.running:
+            self.engine.addResidual(msg.utime, residual)
+            return
+
+        self.setCurrentUtime(msg.utime)
+        self.residual = residual
 
-        if self.running:
-            self.contactParticleFilterStep(self.residual, drawParticleSets=self.options['vis']['draw'],
-                                           applyMotionModel=True)
+        if not self.running:
+            return
 
+        self.contactParticleFilterStep(self.residual, drawParticleSets=self.options['vis']['draw'],
+                                       applyMotionModel=True)
 
-    def contactParticleFilterStep(self, residual=None, drawParticleSets=True, applyMotionModel=True):
+
+    def contactParticleFilterStep(self, residual=None, drawParticleSets=True, applyMotionModel=True,
+                                  updateLinkFrames=True):
 
         # this is to facilitate testing
         if residual is None:
             residual = self.residual
 
 
+        # wall clock time of each stage of this step, see cpfbenchmark.py
+        stageTimes = dict()
+        self.debugInfo['stageTimes'] = stageTimes
+        startTime = time.time()
+
         # update the frames
-        # doing this for performance, basically just caching frames
-        self.linkFrameContainer.updateLinkFrames()
+        # doing this for performance, basically just caching frames.
+        # the async engine sets them from the snapshot taken with the residual instead
+        if updateLinkFrames:
+            self.linkFrameContainer.updateLinkFrames()
 
         if applyMotionModel:
             self.applyMotionModel()
 
+        stageTimes['motionModel'] = time.time() - startTime
+        startTime = time.time()
+
         # publish just after motion model step
         # DEBUGGING
         # if self.options['vis']['publishVisualizationData']:
@@ -1192,16 +1514,28 @@ class ContactFilter(object):
         # if len(self.particleSetList) == 0:
         #     self.manageParticleSets(verbose=True)
 
-        self.computeMeasurementUpdate(self.residual, publish=False)
+        self.computeMeasurementUpdate(residual, publish=False)
+        stageTimes['measurementUpdate'] = time.time() - startTime
+        startTime = time.time()
+
         self.applyImportanceResampling()
-        self.updateAllParticleSetsMostLikelyParticle()
+        stageTimes['importanceResampling'] = time.time() - startTime
+        startTime = time.time()
+
+        self.updateAllParticleSetsMostLikelyParticle(residual=residual)
         self.updateMostLikelySolnData()
-        self.publishMostLikelyEstimate()
+        stageTimes['mostLikely'] = time.time() - startTime
+        startTime = time.time()
+
+        self.publishMostLikelyEstimate(residual=residual)
         if self.options['vis']['publishVisualizationData']:
             self.publishVisualizationData()
+        stageTimes['publish'] = time.time() - startTime
+        startTime = time.time()
 
         # this is where we add/remove particle sets . . .
-        self.manageParticleSets(verbose=True) # there are timeouts inside of this
+        self.manageParticleSets(verbose=True, residual=residual) # there are timeouts inside of this
+        stageTimes['manageParticleSets'] = time.time() - startTime
 
         if drawParticleSets:
             self.testParticleSetDrawAll(drawMostLikely=True, drawHistoricalMostLikely=True)
@@ -1233,15 +1567,8 @@ class ContactFilter(object):
         if color is not None:
             defaultColor = color
 
-        numParticlesAtCFP = {}
-        numTotalParticles = len(particleSet.particleList)
-
-        for particle in particleSet.particleList:
-            cfp = particle.cfp
-            if numParticlesAtCFP.has_key(cfp):
-                numParticlesAtCFP[cfp] += 1
-            else:
-                numParticlesAtCFP[cfp] = 1
+        cfpList, numParticlesAtCFP = particleSet.getParticleCounts()
+        numTotalParticles = particleSet.getNumberOfParticles()
 
         # now we need to draw this
         plungerMaxLength = 0.4
@@ -1249,7 +1576,7 @@ class ContactFilter(object):
 
         d = DebugData()
         q = self.getCurrentPose()
-        for cfp, numParticles in numParticlesAtCFP.iteritems():
+        for cfp, numParticles in zip(cfpList, numParticlesAtCFP):
             color = defaultColor
 
             # if particleSet.mostLikelyParticle is not None:
@@ -1317,7 +1644,7 @@ class ContactFilter(object):
     def testParticleSetDraw(self):
         self.drawParticleSet(self.testParticleSet, drawMostLikely=False, drawHistoricalMostLikely=False)
 
-    def testParticleSetDrawAll(self, drawMostLikely=False, drawHistoricalMostLikely=True):
+    def testParticleSetDrawAll(self, drawMostLikely=False, drawHistoricalMostLikely=True, particleSetList=None):
         # colorList = []
         #
         # colorList.append([0.5, 0, 0.5]) # purple
@@ -1325,14 +1652,17 @@ class ContactFilter(object):
         # colorList.append([1,1,0]) # yellow
         # colorList.append([0.13,0.7,0.66]) # blue-green
 
-        numParticleSets = len(self.particleSetList)
+        if particleSetList is None:
+            particleSetList = self.particleSetList
+
+        numParticleSets = len(particleSetList)
         maxNumParticleSets = 4
         for i in xrange(0,maxNumParticleSets):
             name = "particle set " + str(i+1)
             om.removeFromObjectModel(om.findObjectByName(name))
 
             if i < numParticleSets:
-                self.drawParticleSet(self.particleSetList[i], name=name, color=self.particleSetList[i].color,
+                self.drawParticleSet(particleSetList[i], name=name, color=particleSetList[i].color,
                                      drawMostLikely=drawMostLikely, drawHistoricalMostLikely=drawHistoricalMostLikely)
 
 
@@ -1433,7 +1763,7 @@ class ContactFilter(object):
         residual = np.zeros(self.drakeModel.numJoints)
         # since we aren't calling it via computeLikelihoodFull we need to manually call doKinematics
         q = self.getCurrentPose()
-        self.drakeModel.model.setJointPositions(q)
+        self.drakeModel.setJointPositions(q)
         solnData = self.computeSingleLikelihood(residual, cfpList)
 
         return solnData
@@ -1583,26 +1913,9 @@ class ContactFilter(object):
         if particleSet is None:
             particleSet = self.testParticleSet
 
-        cfpPlotted = set()
-        likelihood = []
-        squaredError = []
-        # importanceWeights = []
-
-        for particle in particleSet.particleList:
-            cfp = particle.cfp
-
-            # skip if we have already logged the data for this particular cfp
-            if cfp in cfpPlotted:
-                continue
-
-            cfpPlotted.add(cfp)
-
-            likelihood.append(particle.solnData['likelihood'])
-            squaredError.append(particle.solnData['squaredError'])
-
-        # bookkeeping
-        likelihood = np.array(likelihood)
-        squaredError = np.array(squaredError)
+        # the measurement update solves one QP per distinct cfp
+        likelihood = particleSet.solnLikelihood
+        squaredError = particleSet.solnSquaredError
         importanceWeights = likelihood/np.sum(likelihood)
 
         plt.clf()
@@ -1665,26 +1978,57 @@ class ContactFilter(object):
         self.testCFP = self.contactFilterPointDict['l_uarm'][0]
 
 
+    def getMotionModelVariance(self):
+        """
+        Motion model variance, interpolated between varMin and varMax based on the
+        squared error of the current most likely estimate
+        """
+        variance = self.options['motionModel']['varMax']
+        if self.mostLikelySolnData is not None:
+            squaredError = self.mostLikelySolnData['squaredError']
+            alpha = min(squaredError/self.options['motionModel']['varMaxSquaredErrorCutoff'], 1.0)
+            variance = alpha*self.options['motionModel']['varMax'] + (1-alpha)*self.options['motionModel']['varMin']
+
+        return variance
+
+    def motionModelBatch(self, cfpList):
+        """
+        Applies the motion model to each cfp in cfpList. The perturbations for
+        all of them are drawn at once.
+
+        :return: list of new ContactFilterPoints
+        """
+        return self.motionModelFromLocations(self.getCFPLocationsInWorld(cfpList))
+
+    def motionModelFromLocations(self, contactLocationsWorldFrame):
+        """
+        motionModelBatch for cfp's at the given N x 3 world locations
+        """
+        if len(contactLocationsWorldFrame) == 0:
+            return []
+
+        variance = self.getMotionModelVariance()
+        deltaToNewContactLocation = np.random.normal(scale=np.sqrt(variance), size=contactLocationsWorldFrame.shape)
+        closestPointLookupLocations = contactLocationsWorldFrame + deltaToNewContactLocation
+
+        closestPointDataList = self.contactPointLocator.findClosestPoints(closestPointLookupLocations)
+        return [self.createContactFilterPointFromClosestPointData(d) for d in closestPointDataList]
+
     def motionModelSingleCFP(self, cfp, visualize=False, tangentSampling=False):
 
         linkToWorld = self.linkFrameContainer.getLinkFrame(cfp.linkName)
         contactLocationWorldFrame = linkToWorld.TransformPoint(cfp.contactLocation)
         contactNormalWorldFrame = linkToWorld.TransformVector(cfp.contactNormal)
 
-
-        variance = self.options['motionModel']['varMax']
-        if self.mostLikelySolnData is not None:
-            squaredError = self.mostLikelySolnData['squaredError']
-            alpha = min(squaredError/self.options['motionModel']['varMaxSquaredErrorCutoff'], 1.0)
-            variance = alpha*self.options['motionModel']['varMax'] + (1-alpha)*self.options['motionModel']['varMin']
+        variance = self.getMotionModelVariance()
 
         if tangentSampling:
             # the tangent vector should just be something orthogonal to it
             tangentVector = cfUtils.getPerpendicularVector(contactNormalWorldFrame)
             deltaToNewContactLocation = tangentVector*np.random.normal(scale=variance, size=1)
         else:
-            # deltaToNewContactLocation = np.random.normal(scale=variance, size=3)
-            deltaToNewContactLocation = scipy.stats.multivariate_normal(cov=variance*np.eye(3)).rvs()
+            # same distribution as scipy.stats.multivariate_normal(cov=variance*np.eye(3)).rvs()
+            deltaToNewContactLocation = np.random.normal(scale=np.sqrt(variance), size=3)
 
         closestPointLookupLocation = contactLocationWorldFrame + deltaToNewContactLocation
 
@@ -1769,12 +2113,9 @@ class ContactFilter(object):
     def resampleParticleSetFromHistoricalMostLikely(self, particleSet):
         # create a bunch of particles at historical most likely, then apply motion model
         historicalMostLikelyParticle = particleSet.historicalMostLikely['particle']
-        newParticleList = []
-        for idx in xrange(0,self.options['numParticles']):
-            newParticle = historicalMostLikelyParticle.deepCopy(keepSolnData=True)
-            newParticleList.append(newParticle)
-
-        particleSet.particleList = newParticleList
+        particleSet.clearParticles()
+        particleSet.addContactFilterPoints([historicalMostLikelyParticle.cfp]*self.options['numParticles'],
+                                           solnData=historicalMostLikelyParticle.solnData)
 
         # don't need to apply the motion model yet, that happens in the next filter step
         # apply the motion model around the historical most likely
@@ -1865,8 +2206,7 @@ class ContactFilter(object):
         particleSet.mostLikelyParticle = ContactFilter.decodeParticle(msg.most_likely_particle)
         particleSet.historicalMostLikely = {'particle': ContactFilter.decodeParticle(msg.historical_most_likely_particle)}
 
-        for particleMsg in msg.particle_list:
-            particleSet.addParticle(ContactFilter.decodeParticle(particleMsg))
+        particleSet.addParticles([ContactFilter.decodeParticle(particleMsg) for particleMsg in msg.particle_list])
 
         return particleSet
 
@@ -1879,9 +2219,193 @@ class ContactFilter(object):
         particle.solnData = {'force':np.array(msg.contact_force)}
         return particle
 
+    @staticmethod
+    def encodePackedCPFData(utime, particleSetList):
+        """
+        Same content as encodeCPFData, but as a CPF_packed_data_t. The link names
+        go in a table and all the particles in flat arrays, which are gathered
+        straight from the particle set arrays.
+        """
+        linkNames = []
+        linkIndexDict = dict()
+
+        def getLinkIndex(linkName):
+            if linkName not in linkIndexDict:
+                linkIndexDict[linkName] = len(linkNames)
+                linkNames.append(linkName)
+            return linkIndexDict[linkName]
+
+        linkIndexList = []
+        contactLocationList = []
+        contactNormalList = []
+        contactForceList = []
+        numParticles = []
+        for particleSet in particleSetList:
+            cfpArrays = particleSet.getContactFilterPointArrays()
+            cfpLinkIndex = np.array([getLinkIndex(linkName) for linkName in cfpArrays['linkName']], dtype=np.int16)
+            cfpIdx = particleSet.cfpIdx
+
+            linkIndexList.append(cfpLinkIndex[cfpIdx])
+            contactLocationList.append(cfpArrays['contactLocation'][cfpIdx])
+            contactNormalList.append(cfpArrays['contactNormal'][cfpIdx])
+            contactForceList.append(particleSet.getForces())
+            numParticles.append(particleSet.getNumberOfParticles())
+
+        # the most likely particles go after all the particle sets
+        mostLikelyValid = []
+        historicalMostLikelyValid = []
+        specialLinkIndex = np.zeros(2*len(particleSetList), dtype=np.int16)
+        specialArrays = np.zeros((3, 2*len(particleSetList), 3))
+        for i, particleSet in enumerate(particleSetList):
+            historicalMostLikely = None
+            if particleSet.historicalMostLikely is not None:
+                historicalMostLikely = particleSet.historicalMostLikely['particle']
+            mostLikelyValid.append(int(particleSet.mostLikelyParticle is not None))
+            historicalMostLikelyValid.append(int(historicalMostLikely is not None))
+
+            for idx, particle in [(2*i, particleSet.mostLikelyParticle), (2*i + 1, historicalMostLikely)]:
+                if particle is None:
+                    continue
+
+                cfp = particle.cfp
+                specialLinkIndex[idx] = getLinkIndex(cfp.linkName)
+                specialArrays[0, idx] = cfp.contactLocation
+                specialArrays[1, idx] = cfp.contactNormal
+                if particle.solnData is not None:
+                    specialArrays[2, idx] = particle.solnData['force']
+                else:
+                    specialArrays[2, idx] = cfp.contactNormal
+
+        linkIndex = np.concatenate(linkIndexList + [specialLinkIndex])
+        contactLocation = np.concatenate(contactLocationList + [specialArrays[0]])
+        contactNormal = np.concatenate(contactNormalList + [specialArrays[1]])
+        contactForce = np.concatenate(contactForceList + [specialArrays[2]])
+        numEntries = len(linkIndex)
+
+        msg = cpf_lcmtypes.CPF_packed_data_t()
+        msg.utime = utime
+        msg.num_link_names = len(linkNames)
+        msg.link_names = linkNames
+        msg.num_particle_sets = len(particleSetList)
+        msg.num_particles = numParticles
+        msg.color = np.array([particleSet.color for particleSet in particleSetList], dtype=np.float64).ravel().tolist()
+        msg.num_color_values = len(msg.color)
+        msg.most_likely_valid = mostLikelyValid
+        msg.historical_most_likely_valid = historicalMostLikelyValid
+        msg.num_entries = numEntries
+        msg.link_index = linkIndex.tolist()
+        msg.num_values = 3*numEntries
+        msg.contact_location = contactLocation.ravel().tolist()
+        msg.contact_normal = contactNormal.ravel().tolist()
+        msg.contact_force = contactForce.ravel().tolist()
+        return msg
+
+    @staticmethod
+    def decodePackedCPFDataToArrays(msg):
+        """
+        :return: list of dicts, one per particle set, with color, linkNames, contactLocation,
+        contactNormal, contactForce (N x 3) and mostLikely, historicalMostLikely
+        (dicts with the same keys, or None)
+        """
+        # the trailing entry covers empty most likely entries when there are no link names
+        linkNames = np.array(list(msg.link_names) + [''], dtype=object)
+        linkIndex = np.array(msg.link_index, dtype=np.int64)
+        contactLocation = np.array(msg.contact_location, dtype=np.float64).reshape(-1, 3)
+        contactNormal = np.array(msg.contact_normal, dtype=np.float64).reshape(-1, 3)
+        contactForce = np.array(msg.contact_force, dtype=np.float64).reshape(-1, 3)
+        color = np.array(msg.color, dtype=np.float64).reshape(-1, 3)
+
+        def entries(start, stop):
+            return {'linkNames': linkNames[linkIndex[start:stop]], 'contactLocation': contactLocation[start:stop],
+                    'contactNormal': contactNormal[start:stop], 'contactForce': contactForce[start:stop]}
+
+        particleSetArrays = []
+        start = 0
+        specialStart = int(np.sum(msg.num_particles))
+        for i in xrange(msg.num_particle_sets):
+            d = entries(start, start + msg.num_particles[i])
+            d['color'] = color[i].tolist()
+
+            mostLikelyIdx = specialStart + 2*i
+            d['mostLikely'] = entries(mostLikelyIdx, mostLikelyIdx + 1) if msg.most_likely_valid[i] else None
+            d['historicalMostLikely'] = None
+            if msg.historical_most_likely_valid[i]:
+                d['historicalMostLikely'] = entries(mostLikelyIdx + 1, mostLikelyIdx + 2)
+
+            particleSetArrays.append(d)
+            start += msg.num_particles[i]
+
+        return particleSetArrays
+
+    @staticmethod
+    def decodePackedCPFData(msg):
+        """
+        Same output as decodeCPFData. Particles at the same location share a single
+        ContactFilterPoint, so the visualizer draws each location once, and particles
+        that also have the same force share their soln data.
+        """
+        particleSetList = []
+        for d in ContactFilter.decodePackedCPFDataToArrays(msg):
+            particleSet = SingleContactParticleSet()
+            particleSet.color = d['color']
+
+            numParticles = len(d['linkNames'])
+            linkNames, linkIndex = np.unique(d['linkNames'], return_inverse=True)
+            particleData = np.column_stack((linkIndex, d['contactLocation'], d['contactForce']))
+
+            # distinct (link, location, force) rows, then distinct (link, location) among those
+            solnFirstIdx, solnIdx = cfUtils.uniqueRows(particleData)
+            cfpFirstIdx, solnCFPIdx = cfUtils.uniqueRows(particleData[solnFirstIdx, :4])
+            cfpFirstIdx = solnFirstIdx[cfpFirstIdx]
+
+            cfpList = [ContactFilter.decodeContactFilterPoint(d['linkNames'][idx], d['contactLocation'][idx],
+                                                              d['contactNormal'][idx]) for idx in cfpFirstIdx]
+            particleSet.setSolnData([{'force': d['contactForce'][idx]} for idx in solnFirstIdx],
+                                    np.zeros(0, dtype=np.int64))
+            particleSet.appendParticles(particleSet.getContactFilterPointIndices(cfpList)[solnCFPIdx[solnIdx]],
+                                        np.ones(numParticles), solnIdx)
+
+            particleSet.mostLikelyParticle = None
+            if d['mostLikely'] is not None:
+                particleSet.mostLikelyParticle = ContactFilter.decodeParticleFromArrays(d['mostLikely'])
+
+            particleSet.historicalMostLikely = {'particle': None}
+            if d['historicalMostLikely'] is not None:
+                particleSet.historicalMostLikely['particle'] = ContactFilter.decodeParticleFromArrays(d['historicalMostLikely'])
+
+            particleSetList.append(particleSet)
+
+        return particleSetList
+
+    @staticmethod
+    def decodeContactFilterPoint(linkName, contactLocation, contactNormal):
+        return ContactFilterPoint(linkName=linkName, contactLocation=contactLocation, contactNormal=contactNormal,
+                                  bodyId=1, forceMomentTransform=1, rotatedFrictionCone=1, J_alpha=1)
+
+    @staticmethod
+    def decodeParticleFromArrays(d, idx=0):
+        cfp = ContactFilter.decodeContactFilterPoint(d['linkNames'][idx], d['contactLocation'][idx],
+                                                     d['contactNormal'][idx])
+        particle = ContactFilterParticle(cfp=cfp)
+        particle.solnData = {'force': d['contactForce'][idx]}
+        return particle
+
     def publishVisualizationData(self):
-        msg = ContactFilter.encodeCPFData(self.currentUtime, self.particleSetList)
-        lcmUtils.publish("CONTACT_PARTICLE_FILTER_DATA", msg)
+        # decimate to at most publishVisualizationDataMaxRate, in filter time
+        maxRate = self.options['vis']['publishVisualizationDataMaxRate']
+        if (maxRate is not None) and (self.lastVisualizationDataPublishTime is not None):
+            if (self.currentTime >= self.lastVisualizationDataPublishTime) and \
+                    (self.currentTime - self.lastVisualizationDataPublishTime < 1.0/maxRate):
+                return
+
+        self.lastVisualizationDataPublishTime = self.currentTime
+
+        if self.options['vis']['packedVisualizationData']:
+            msg = ContactFilter.encodePackedCPFData(self.currentUtime, self.particleSetList)
+            lcmUtils.publish("CONTACT_PARTICLE_FILTER_DATA_PACKED", msg)
+        else:
+            msg = ContactFilter.encodeCPFData(self.currentUtime, self.particleSetList)
+            lcmUtils.publish("CONTACT_PARTICLE_FILTER_DATA", msg)
 
     def testDecodeCFPData(self):
         msg = ContactFilter.encodeCPFData(self.currentUtime, self.particleSetList)
@@ -1896,7 +2420,8 @@ class ContactFilterPoint(object):
                  rotatedFrictionCone=None, J_alpha = None):
 
         optionalArgsList = [linkName, contactLocation, contactNormal, bodyId, forceMomentTransform, rotatedFrictionCone, J_alpha]
-        if None in optionalArgsList:
+        # identity check, `None in optionalArgsList` compares numpy arrays elementwise
+        if any(arg is None for arg in optionalArgsList):
             raise ValueError("must specify all the optional input arguments")
 
         self.linkName = linkName
@@ -1966,9 +2491,18 @@ class ContactFilterParticle(object):
 
 
 class SingleContactParticleSet(object):
+    """
+    The particles are stored as arrays over a table of the distinct
+    ContactFilterPoints in the set
+    - cfpIdx: index into cfpList of the ContactFilterPoint of each particle
+    - weight: proposal weight of each particle
+    - solnIdx: index into solnDataList of the soln data of each particle, -1 if it has none
+
+    ContactFilterParticle objects are only built on demand, for the most likely
+    particles and for visualization, see getParticle.
+    """
 
     def __init__(self, solnDataQueueTimeout=1.0, color=[0,0,1]):
-        self.particleList = []
         self.mostLikelyParticle = None
         self.historicalMostLikely = {'solnData': None, 'particle': None}
         self.solnDataTimeout = solnDataQueueTimeout
@@ -1976,52 +2510,171 @@ class SingleContactParticleSet(object):
         self.squaredErrorWithoutParticle = {}
         self.color = color
 
+        # active set of the QP solved for each ContactFilterPoint in the last measurement
+        # update, used to warm start the next one, see ContactFilter.getQPWarmStart
+        self.qpWarmStartCache = dict()
+        self.clearParticles()
+
+    def clearParticles(self):
+        self.cfpList = []
+        self.cfpTableIndex = dict()
+        self.cfpArrays = None
+        self.cfpIdx = np.zeros(0, dtype=np.int64)
+        self.weight = np.zeros(0)
+        self.setSolnData([], np.zeros(0, dtype=np.int64))
+
+    def getContactFilterPointIndices(self, cfpList):
+        """
+        :return: indices of the cfp's into cfpList, cfp's that aren't in the table yet are added
+        """
+        cfpIdx = np.zeros(len(cfpList), dtype=np.int64)
+        for idx, cfp in enumerate(cfpList):
+            tableIdx = self.cfpTableIndex.get(cfp)
+            if tableIdx is None:
+                tableIdx = len(self.cfpList)
+                self.cfpTableIndex[cfp] = tableIdx
+                self.cfpList.append(cfp)
+                self.cfpArrays = None
+            cfpIdx[idx] = tableIdx
+
+        return cfpIdx
+
+    def setSolnData(self, solnDataList, solnIdx):
+        """
+        :param solnDataList: list of solnData
+        :param solnIdx: index into solnDataList for each particle, -1 for no soln data
+        """
+        self.solnDataList = list(solnDataList)
+        self.solnIdx = np.asarray(solnIdx, dtype=np.int64)
+        self.solnLikelihood = np.array([solnData.get('likelihood', np.nan) for solnData in self.solnDataList],
+                                       dtype=np.float64)
+        self.solnSquaredError = np.array([solnData.get('squaredError', np.nan) for solnData in self.solnDataList],
+                                         dtype=np.float64)
+        self.solnForce = np.array([solnData.get('force', np.nan*np.ones(3)) for solnData in self.solnDataList],
+                                  dtype=np.float64).reshape(-1, 3)
+
+    def appendSolnData(self, solnData):
+        """
+        :return: index of solnData in solnDataList, -1 if solnData is None
+        """
+        if solnData is None:
+            return -1
+
+        self.solnDataList.append(solnData)
+        self.solnLikelihood = np.append(self.solnLikelihood, solnData.get('likelihood', np.nan))
+        self.solnSquaredError = np.append(self.solnSquaredError, solnData.get('squaredError', np.nan))
+        self.solnForce = np.vstack((self.solnForce, solnData.get('force', np.nan*np.ones(3))))
+        return len(self.solnDataList) - 1
+
+    def addContactFilterPoints(self, cfpList, weight=None, solnData=None):
+        """
+        Adds a particle for each cfp in cfpList
+        :param weight: proposal weights of the new particles, 1 by default
+        :param solnData: soln data shared by the new particles
+        """
+        numParticles = len(cfpList)
+        if weight is None:
+            weight = np.ones(numParticles)
+
+        solnIdx = self.appendSolnData(solnData)*np.ones(numParticles, dtype=np.int64)
+        self.appendParticles(self.getContactFilterPointIndices(cfpList), weight, solnIdx)
+
+    def addParticles(self, particleList):
+        """
+        Adds copies of the given ContactFilterParticles, keeping their soln data
+        """
+        solnIdx = np.array([self.appendSolnData(particle.solnData) for particle in particleList], dtype=np.int64)
+        weight = np.array([particle.proposalData['weight'] for particle in particleList], dtype=np.float64)
+        self.appendParticles(self.getContactFilterPointIndices([particle.cfp for particle in particleList]),
+                             weight, solnIdx)
 
     def addParticle(self, particle):
-        self.particleList.append(particle)
+        self.addParticles([particle])
+
+    def appendParticles(self, cfpIdx, weight, solnIdx):
+        self.cfpIdx = np.concatenate((self.cfpIdx, cfpIdx))
+        self.weight = np.concatenate((self.weight, weight))
+        self.solnIdx = np.concatenate((self.solnIdx, solnIdx))
+
+    def setContactFilterPoints(self, particleIdx, cfpList, weight=1.0):
+        """
+        Moves the particles at particleIdx to the cfp's in cfpList, their soln data
+        is kept until the next measurement update
+        """
+        self.cfpIdx[particleIdx] = self.getContactFilterPointIndices(cfpList)
+        self.weight[particleIdx] = weight
+
+    def resample(self, particleIdx):
+        """
+        Replaces the particles with copies of the particles at particleIdx. The copies
+        keep their soln data and have a proposal weight of 1.
+        """
+        particleIdx = np.asarray(particleIdx, dtype=np.int64)
+        self.cfpIdx = self.cfpIdx[particleIdx]
+        self.solnIdx = self.solnIdx[particleIdx]
+        self.weight = np.ones(len(particleIdx))
+        self.removeUnusedEntries()
+
+    def removeUnusedEntries(self):
+        """
+        Drops the ContactFilterPoints and soln data that no particle refers to anymore
+        """
+        usedCFPIdx, self.cfpIdx = np.unique(self.cfpIdx, return_inverse=True)
+        self.cfpList = [self.cfpList[idx] for idx in usedCFPIdx]
+        self.cfpTableIndex = dict((cfp, idx) for idx, cfp in enumerate(self.cfpList))
+        self.cfpArrays = None
+
+        hasSolnData = self.solnIdx >= 0
+        usedSolnIdx, solnIdx = np.unique(self.solnIdx[hasSolnData], return_inverse=True)
+        self.solnDataList = [self.solnDataList[idx] for idx in usedSolnIdx]
+        self.solnLikelihood = self.solnLikelihood[usedSolnIdx]
+        self.solnSquaredError = self.solnSquaredError[usedSolnIdx]
+        self.solnForce = self.solnForce[usedSolnIdx]
+        self.solnIdx[hasSolnData] = solnIdx
+
+    def getParticle(self, idx):
+        """
+        Builds a ContactFilterParticle for the particle at idx
+        """
+        particle = ContactFilterParticle(cfp=self.cfpList[self.cfpIdx[idx]])
         particle.setContainingParticleSet(self)
+        particle.proposalData['weight'] = self.weight[idx]
 
-    # will need to update this when we go to the continuous version. For right now let it be the
-    # mode of the distribution
-    def updateMostLikelyParticle(self, currentTime):
-        bestSquaredError = None
+        if self.solnIdx[idx] >= 0:
+            particle.solnData = self.solnDataList[self.solnIdx[idx]]
 
-        for particle in self.particleList:
+            # the first particle built for a measurement update soln data becomes the
+            # one it records, see ContactFilter.measurementUpdateSingleParticleSet
+            cfpData = particle.solnData.get('cfpData')
+            if cfpData and ('particle' in cfpData[0]) and (cfpData[0]['particle'] is None):
+                cfpData[0]['particle'] = particle
 
-            squaredError = particle.solnData['squaredError']
-            if (bestSquaredError is None) or (squaredError < bestSquaredError):
-                bestSquaredError = squaredError
-                self.mostLikelyParticle = particle
+        return particle
 
+    @property
+    def particleList(self):
+        """
+        ContactFilterParticles for all the particles, these are rebuilt on every
+        call so only use this for debugging
+        """
+        return [self.getParticle(idx) for idx in xrange(self.getNumberOfParticles())]
+
+    # will need to update this when we go to the continuous version. For right now let it be the
+    # mode of the distribution
+    def updateMostLikelyParticle(self, currentTime):
+        self.mostLikelyParticle = self.getParticle(np.argmin(self.getSquaredErrors()))
         self.updateSolnDataSet(currentTime, solnData=self.mostLikelyParticle.solnData)
 
 
     # choose the most likely particle to be the mode of the particle set
     # make sure that you perform importance resampling before you get here
     def updateMostLikelyParticleUsingMode(self, currentTime):
-        bestCFP = None
-        bestParticle = None
-
-        cfpCounterDict = {}
-
-        for particle in self.particleList:
-            cfp = particle.cfp
-            if cfpCounterDict.has_key(cfp):
-                cfpCounterDict[cfp]['numParticles'] += 1
-            else:
-                cfpCounterDict[cfp] = {'numParticles': 1, 'particle': particle}
-
-        maxNumParticles = 0
-        mostLikelyParticle = None
-        for cfp, d in cfpCounterDict.iteritems():
-            if d['numParticles'] > maxNumParticles:
-                maxNumParticles = d['numParticles']
-                mostLikelyParticle = d['particle']
-
+        numParticlesAtCFP = np.bincount(self.cfpIdx, minlength=len(self.cfpList))
+        modeCFPIdx = np.argmax(numParticlesAtCFP)
 
         # bookkeeping
-        self.cfpCounterDict  = cfpCounterDict # this is for debugging purposes
-        self.mostLikelyParticle = mostLikelyParticle
+        self.numParticlesAtCFP = numParticlesAtCFP # this is for debugging purposes
+        self.mostLikelyParticle = self.getParticle(np.flatnonzero(self.cfpIdx == modeCFPIdx)[0])
         self.updateSolnDataSet(currentTime, solnData=self.mostLikelyParticle.solnData)
 
     def setMostLikelyParticle(self, currentTime, mostLikelyParticle):
@@ -2061,13 +2714,73 @@ class SingleContactParticleSet(object):
                 bestSquaredError = squaredError
 
     def getNumberOfParticles(self):
-        return len(self.particleList)
+        return len(self.cfpIdx)
 
-    @staticmethod
-    def copyParticleList(particleList):
-        particleListCopy = [None]*len(particleList)
-        for idx, particle in enumerate(particleList):
-            particleListCopy[idx] = particle.deepCopy()
+    def getLikelihoods(self):
+        """
+        :return: likelihood of each particle, nan for particles without soln data
+        """
+        # solnIdx -1 picks the trailing nan
+        return np.append(self.solnLikelihood, np.nan)[self.solnIdx]
+
+    def getSquaredErrors(self):
+        """
+        :return: squared error of each particle, nan for particles without soln data
+        """
+        return np.append(self.solnSquaredError, np.nan)[self.solnIdx]
+
+    def getForces(self):
+        """
+        :return: N x 3 contact force of each particle, the contact normal for particles without soln data
+        """
+        forces = np.vstack((self.solnForce, np.nan*np.ones(3)))[self.solnIdx]
+        noForce = ~np.all(np.isfinite(forces), axis=1)
+        forces[noForce] = self.getContactFilterPointArrays()['contactNormal'][self.cfpIdx[noForce]]
+        return forces
+
+    def getContactFilterPointArrays(self):
+        """
+        :return: dict with linkName (list), contactLocation and contactNormal (K x 3) for
+        the entries of cfpList
+        """
+        if self.cfpArrays is None:
+            numCFP = len(self.cfpList)
+            self.cfpArrays = dict()
+            self.cfpArrays['linkName'] = [cfp.linkName for cfp in self.cfpList]
+            self.cfpArrays['contactLocation'] = np.array([cfp.contactLocation for cfp in self.cfpList],
+                                                         dtype=np.float64).reshape(numCFP, 3)
+            self.cfpArrays['contactNormal'] = np.array([cfp.contactNormal for cfp in self.cfpList],
+                                                       dtype=np.float64).reshape(numCFP, 3)
+
+        return self.cfpArrays
+
+    def getParticleCounts(self):
+        """
+        :return: list of the distinct ContactFilterPoints of the particles, number of particles at each of them
+        """
+        numParticlesAtCFP = np.bincount(self.cfpIdx, minlength=len(self.cfpList))
+        usedCFPIdx = np.flatnonzero(numParticlesAtCFP)
+        return [self.cfpList[idx] for idx in usedCFPIdx], numParticlesAtCFP[usedCFPIdx]
+
+    def getParticleArrays(self):
+        """
+        Array view of the particle set
+
+        :return: dict with linkName (list), contactLocation (N x 3), contactNormal (N x 3),
+        weight (N,) and, if all the particles have soln data, likelihood and squaredError (N,)
+        """
+        cfpArrays = self.getContactFilterPointArrays()
+        d = dict()
+        d['linkName'] = [cfpArrays['linkName'][idx] for idx in self.cfpIdx]
+        d['contactLocation'] = cfpArrays['contactLocation'][self.cfpIdx]
+        d['contactNormal'] = cfpArrays['contactNormal'][self.cfpIdx]
+        d['weight'] = self.weight.copy()
+
+        if np.all(self.solnIdx >= 0):
+            d['likelihood'] = self.getLikelihoods()
+            d['squaredError'] = self.getSquaredErrors()
+
+        return d
 
 
 class SingleContactParticleSetWithRandomSampling(SingleContactParticleSet):
@@ -2080,23 +2793,16 @@ class SingleContactParticleSetWithRandomSampling(SingleContactParticleSet):
         Creates a random variable that will allow you sample from this set of particles
         :return:
         """
-        numParticles = len(self.particleList)
-        xk = np.arange(numParticles)
-        pk = 1.0/numParticles*np.ones(numParticles)
-        self.samplingRandomVariable = scipy.stats.rv_discrete(values=(xk, pk))
+        self.numParticlesForSampling = self.getNumberOfParticles()
 
-    def drawRandomParticles(self, numRandomSamples):
+    def drawRandomContactFilterPoints(self, numRandomSamples):
         """
         Draws the specified number of random particles
         :param numRandomSamples:
-        :return: list of partilces
+        :return: list of the ContactFilterPoints of the drawn particles
         """
-        randomIdx = self.samplingRandomVariable.rvs(size=numRandomSamples)
-        randomParticleList = []
-        for idx in randomIdx:
-            randomParticleList.append(self.particleList[idx].deepCopy())
-
-        return randomParticleList
+        randomIdx = np.random.randint(self.numParticlesForSampling, size=numRandomSamples)
+        return [self.cfpList[idx] for idx in self.cfpIdx[randomIdx]]
 
 
 
@@ -2108,13 +2814,39 @@ class LinkFrameContainer:
         self.robotStateModel = robotStateModel
         self.linkNames = self.robotStateModel.model.getLinkNames()
         self.linkFrames = dict()
+        self.linkFrameMatrices = dict()
         self.updateLinkFrames()
 
     def updateLinkFrames(self):
         for linkName in self.linkNames:
             self.linkFrames[linkName] = self.robotStateModel.getLinkFrame(linkName)
 
+        # numpy versions are computed lazily, see getLinkFrameMatrix
+        self.linkFrameMatrices = dict()
+
     def getLinkFrame(self, linkName):
         return self.linkFrames[linkName]
 
+    def copyLinkFrames(self):
+        """
+        Copies of the current link frames of the robot state model, safe to use from another thread
+        """
+        return dict((linkName, transformUtils.copyFrame(self.robotStateModel.getLinkFrame(linkName)))
+                    for linkName in self.linkNames)
+
+    def setLinkFrames(self, linkFrames):
+        self.linkFrames = linkFrames
+        self.linkFrameMatrices = dict()
+
+    def getLinkFrameMatrix(self, linkName):
+        """
+        Link to world transform as a 4 x 4 numpy array
+        """
+        linkToWorld = self.linkFrameMatrices.get(linkName)
+        if linkToWorld is None:
+            linkToWorld = transformUtils.getNumpyFromTransform(self.linkFrames[linkName])
+            self.linkFrameMatrices[linkName] = linkToWorld
+
+        return linkToWorld
+
 
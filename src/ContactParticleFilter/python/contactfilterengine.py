@@ -0,0 +1,162 @@
+__author__ = 'manuelli'
+
+import collections
+import threading
+import time
+import traceback
+import numpy as np
+
+from director.timercallback import TimerCallback
+
+import contactfilterutils as cfUtils
+
+# everything the filter step needs from the GUI thread, captured when the residual arrives
+ResidualSnapshot = collections.namedtuple('ResidualSnapshot', ['utime', 'residual', 'q', 'linkFrames',
+                                                               'receiveTime'])
+
+
+class ContactFilterEngine(object):
+    """
+    Runs the contact filter steps on a worker thread instead of inside the lcm
+    subscriber callback.
+
+    The callback only snapshots the residual, the robot pose and the link frames
+    and puts them in a latest-value queue. If the filter is still busy with the
+    previous residual when a new one arrives, the older one is dropped, so the
+    filter always works on the most recent data. The estimates are published from
+    the worker thread, the particle sets are drawn by a timer on the GUI thread
+    at drawRate.
+
+    Stats
+    - numReceived, numProcessed, numSkipped (dropped from the queue)
+    - latency from receiving the residual to publishing its estimate, and from
+      the residual utime to publishing (only meaningful if the clocks agree)
+    """
+
+    def __init__(self, contactFilter, drawRate=None, numLatencySamples=1000):
+        self.contactFilter = contactFilter
+        self.queue = cfUtils.LatestValueQueue()
+        self.thread = None
+        self.stopEvent = threading.Event()
+
+        self.statsLock = threading.Lock()
+        self.numLatencySamples = numLatencySamples
+        self.resetStats()
+
+        # packed particle sets from the last step, drawn by the GUI thread
+        self.latestDrawData = None
+        self.drawTimer = None
+        if drawRate is not None:
+            self.drawTimer = TimerCallback(targetFps=drawRate)
+            self.drawTimer.callback = self.drawLatestParticleSets
+
+    def resetStats(self):
+        with self.statsLock:
+            self.stats = {'numReceived': 0, 'numProcessed': 0, 'numErrors': 0}
+            self.receiveToPublishLatency = collections.deque(maxlen=self.numLatencySamples)
+            self.utimeToPublishLatency = collections.deque(maxlen=self.numLatencySamples)
+            self.queue.numDropped = 0
+
+    def isRunning(self):
+        return (self.thread is not None) and self.thread.is_alive()
+
+    def start(self):
+        if self.isRunning():
+            return
+
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, name='ContactFilterEngine')
+        self.thread.daemon = True
+        self.thread.start()
+
+        if self.drawTimer is not None:
+            self.drawTimer.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.drawTimer is not None:
+            self.drawTimer.stop()
+
+    def addResidual(self, utime, residual):
+        """
+        Called from the lcm subscriber, on the GUI thread
+        """
+        snapshot = ResidualSnapshot(utime=utime, residual=residual,
+                                    q=np.array(self.contactFilter.robotStateJointController.q),
+                                    linkFrames=self.contactFilter.linkFrameContainer.copyLinkFrames(),
+                                    receiveTime=time.time())
+        with self.statsLock:
+            self.stats['numReceived'] += 1
+        self.queue.put(snapshot)
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            snapshot = self.queue.get(timeout=0.1)
+            if snapshot is None:
+                continue
+
+            try:
+                self.processResidual(snapshot)
+            except Exception:
+                traceback.print_exc()
+                with self.statsLock:
+                    self.stats['numErrors'] += 1
+
+    def processResidual(self, snapshot):
+        contactFilter = self.contactFilter
+        contactFilter.setCurrentUtime(snapshot.utime)
+        contactFilter.residual = snapshot.residual
+        contactFilter.poseSnapshot = snapshot.q
+        contactFilter.linkFrameContainer.setLinkFrames(snapshot.linkFrames)
+
+        contactFilter.contactParticleFilterStep(snapshot.residual, drawParticleSets=False, applyMotionModel=True,
+                                                updateLinkFrames=False)
+
+        publishTime = time.time()
+        with self.statsLock:
+            self.stats['numProcessed'] += 1
+            self.receiveToPublishLatency.append(publishTime - snapshot.receiveTime)
+            self.utimeToPublishLatency.append(publishTime - snapshot.utime*1e-6)
+
+        if self.drawTimer is not None:
+            self.latestDrawData = contactFilter.encodePackedCPFData(snapshot.utime, contactFilter.particleSetList)
+
+    def drawLatestParticleSets(self):
+        drawData = self.latestDrawData
+        if drawData is None:
+            return
+
+        self.latestDrawData = None
+        particleSetList = self.contactFilter.decodePackedCPFData(drawData)
+        self.contactFilter.testParticleSetDrawAll(drawMostLikely=True, drawHistoricalMostLikely=True,
+                                                  particleSetList=particleSetList)
+
+    def getStats(self):
+        """
+        :return: dict with the counters and the p50/p90/max of the latencies in seconds
+        """
+        with self.statsLock:
+            stats = dict(self.stats)
+            stats['numSkipped'] = self.queue.numDropped
+            latencies = {'receiveToPublish': np.array(self.receiveToPublishLatency),
+                         'utimeToPublish': np.array(self.utimeToPublishLatency)}
+
+        for name, data in latencies.iteritems():
+            stats[name] = None
+            if len(data) > 0:
+                stats[name] = {'p50': np.percentile(data, 50), 'p90': np.percentile(data, 90), 'max': np.max(data)}
+
+        return stats
+
+    def printStats(self):
+        stats = self.getStats()
+        print "residuals (received, processed, skipped, errors): ", (stats['numReceived'], stats['numProcessed'],
+                                                                    stats['numSkipped'], stats['numErrors'])
+        for name in ['receiveToPublish', 'utimeToPublish']:
+            if stats[name] is not None:
+                print "%s latency (p50, p90, max): (%.4f, %.4f, %.4f)" %(name, stats[name]['p50'], stats[name]['p90'],
+                                                                      stats[name]['max'])
@@ -3,6 +3,9 @@ import numpy as np
 import collections
 import yaml
 import os
+import hashlib
+import threading
+import scipy.spatial
 
 from collections import namedtuple
 
@@ -39,6 +42,67 @@ def getPerpendicularVector(vec):
     perpendicularVector = perpendicularVector/np.linalg.norm(perpendicularVector)
     return perpendicularVector
 
+def resampleIndices(weights, numSamples, method='systematic'):
+    """
+    Draws numSamples indices with probability proportional to weights.
+
+    systematic and stratified resampling use a single sorted pass over the
+    cumulative weights, and have lower variance than multinomial sampling.
+
+    :param weights: nonnegative weights, need not be normalized
+    :param method: one of systematic, stratified or multinomial
+    :return: integer numpy array of size numSamples
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    cumulativeWeights = np.cumsum(weights)
+    cumulativeWeights /= cumulativeWeights[-1]
+
+    if method == 'systematic':
+        u = (np.random.uniform() + np.arange(numSamples))/numSamples
+    elif method == 'stratified':
+        u = (np.random.uniform(size=numSamples) + np.arange(numSamples))/numSamples
+    elif method == 'multinomial':
+        u = np.random.uniform(size=numSamples)
+    else:
+        raise ValueError("resampling method must be one of systematic, stratified or multinomial")
+
+    indices = np.searchsorted(cumulativeWeights, u, side='right')
+    return np.minimum(indices, len(weights) - 1)
+
+
+def isotropicGaussianPdf(x, mean, variance):
+    """
+    pdf of N(mean, variance*I) evaluated at each row of x
+    :param x: N x d array
+    :param mean: d vector
+    :param variance: scalar
+    :return: numpy array of size N
+    """
+    x = np.atleast_2d(x)
+    d = x.shape[1]
+    squaredDistance = np.sum((x - mean)**2, axis=1)
+    return np.exp(-0.5*squaredDistance/variance)/((2*np.pi*variance)**(d/2.0))
+
+
+def uniqueRows(x):
+    """
+    np.unique over the rows of a 2D array, older numpy doesn't have the axis argument
+    :param x: N x d array
+    :return: index of the first occurrence of each distinct row (in order of first
+    occurrence), and for each row the index of its distinct row
+    """
+    # rows are compared bytewise, adding 0 turns -0.0 into 0.0
+    x = np.ascontiguousarray(x) + 0
+    rowView = x.view(np.dtype((np.void, x.dtype.itemsize*x.shape[1]))).ravel()
+    _, firstIdx, inverse = np.unique(rowView, return_index=True, return_inverse=True)
+
+    # reorder from sorted to first occurrence
+    order = np.argsort(firstIdx)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return firstIdx[order], rank[inverse]
+
+
 # d should be a dict. d.keys() will be the fields of
 def createNamedTupleFromDict(d, name='Default'):
     x = namedtuple(name, d.keys())
@@ -57,6 +121,183 @@ def loadConfig(config_filename="contact_particle_filter_config.yaml"):
     return config
 
 
+def computeFileHash(filename, chunkSize=2**20):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+class SparseTransitionTable(object):
+    """
+    Row stochastic transition matrix stored in CSR form, row i holds the
+    probabilities of moving from point i to each of its neighbours.
+
+    Each row also stores an alias table (Vose's method) so that a batch of
+    transitions can be sampled with a constant number of numpy operations.
+    """
+
+    def __init__(self, indptr, indices, probabilities, aliasProbability, alias):
+        self.indptr = indptr
+        self.indices = indices
+        self.probabilities = probabilities
+        self.aliasProbability = aliasProbability
+        self.alias = alias
+
+    @staticmethod
+    def fromPoints(points, variance, numStdDev=3.0, groups=None):
+        """
+        Transition probabilities proportional to exp(-d^2/(2*variance)), truncated
+        to the neighbours within numStdDev*sqrt(variance) of each point.
+
+        :param points: N x 3 array
+        :param groups: optional length N array, only allows transitions within the same group
+        """
+        points = np.asarray(points, dtype=np.float64)
+        tree = scipy.spatial.cKDTree(points)
+        neighbourLists = tree.query_ball_point(points, numStdDev*np.sqrt(variance))
+
+        indptr = np.zeros(len(points) + 1, dtype=np.int64)
+        indicesList = []
+        for i, neighbours in enumerate(neighbourLists):
+            neighbours = np.array(sorted(neighbours), dtype=np.int64)
+            if groups is not None:
+                neighbours = neighbours[groups[neighbours] == groups[i]]
+            indicesList.append(neighbours)
+            indptr[i+1] = indptr[i] + len(neighbours)
+
+        indices = np.concatenate(indicesList)
+        rows = np.repeat(np.arange(len(points)), np.diff(indptr))
+        squaredDistance = np.sum((points[rows] - points[indices])**2, axis=1)
+        weights = np.exp(-1.0/(2*variance)*squaredDistance)
+        probabilities = weights/np.add.reduceat(weights, indptr[:-1])[rows]
+
+        aliasProbability, alias = SparseTransitionTable.buildAliasTables(indptr, probabilities)
+        return SparseTransitionTable(indptr, indices, probabilities, aliasProbability, alias)
+
+    @staticmethod
+    def buildAliasTables(indptr, probabilities):
+        """
+        :return: aliasProbability, alias. Both have the same layout as probabilities,
+        alias holds the position within the row.
+        """
+        aliasProbability = np.ones(len(probabilities))
+        alias = np.zeros(len(probabilities), dtype=np.int64)
+
+        for i in xrange(len(indptr) - 1):
+            start, stop = indptr[i], indptr[i+1]
+            n = stop - start
+            scaled = list(probabilities[start:stop]*n)
+            small = [j for j in xrange(n) if scaled[j] < 1.0]
+            large = [j for j in xrange(n) if scaled[j] >= 1.0]
+
+            while small and large:
+                s = small.pop()
+                l = large.pop()
+                aliasProbability[start + s] = scaled[s]
+                alias[start + s] = l
+                scaled[l] = scaled[l] + scaled[s] - 1.0
+                if scaled[l] < 1.0:
+                    small.append(l)
+                else:
+                    large.append(l)
+
+            # whatever remains has probability 1 up to roundoff
+            for j in small + large:
+                aliasProbability[start + j] = 1.0
+                alias[start + j] = j
+
+        return aliasProbability, alias
+
+    def getRow(self, row):
+        """
+        :return: indices, probabilities of the nonzero entries of the row
+        """
+        start, stop = self.indptr[row], self.indptr[row+1]
+        return self.indices[start:stop], self.probabilities[start:stop]
+
+    def sample(self, rows):
+        """
+        Draws one transition for each entry of rows
+        :return: numpy array of column indices, same size as rows
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        start = self.indptr[rows]
+        rowLength = self.indptr[rows + 1] - start
+
+        k = start + (np.random.uniform(size=rows.shape)*rowLength).astype(np.int64)
+        k = np.minimum(k, start + rowLength - 1)
+        useAlias = np.random.uniform(size=rows.shape) >= self.aliasProbability[k]
+        k = np.where(useAlias, start + self.alias[k], k)
+        return self.indices[k]
+
+    def save(self, filename, **metadata):
+        """
+        Saves to a .npz file, the write is atomic so that a partially written
+        cache is never read
+        """
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tmpFilename = filename + '.tmp.npz'
+        np.savez(tmpFilename, indptr=self.indptr, indices=self.indices, probabilities=self.probabilities,
+                 aliasProbability=self.aliasProbability, alias=self.alias, **metadata)
+        os.rename(tmpFilename, filename)
+
+    @staticmethod
+    def load(filename):
+        """
+        :return: SparseTransitionTable, dict of the other arrays stored in the file
+        """
+        data = dict(np.load(filename))
+        table = SparseTransitionTable(data.pop('indptr'), data.pop('indices'), data.pop('probabilities'),
+                                      data.pop('aliasProbability'), data.pop('alias'))
+        return table, data
+
+
+class LatestValueQueue(object):
+    """
+    Thread safe queue that only holds the most recent value. Putting a value
+    while the previous one hasn't been consumed drops the previous one, the
+    number of dropped values is recorded in numDropped.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.value = None
+        self.hasValue = False
+        self.numDropped = 0
+
+    def put(self, value):
+        with self.condition:
+            if self.hasValue:
+                self.numDropped += 1
+            self.value = value
+            self.hasValue = True
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        :return: the latest value, None if there was none within timeout
+        """
+        with self.condition:
+            if not self.hasValue:
+                self.condition.wait(timeout)
+            if not self.hasValue:
+                return None
+
+            value = self.value
+            self.value = None
+            self.hasValue = False
+            return value
+
+
 class DequePeak(collections.deque):
 
     def __init__(self):
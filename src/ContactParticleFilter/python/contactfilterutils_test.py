@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+# contactfilterutils imports director and the drake lcm types,
+# the tests are skipped where that isn't available
+try:
+    from contactfilterutils import SparseTransitionTable
+    SKIP_REASON = None
+except ImportError as e:
+    SKIP_REASON = "needs the spartan environment: %s" %(e)
+
+
+def make_points():
+    # two parallel rows of points, 2cm apart along each row
+    x = np.arange(10)*0.02
+    row0 = np.column_stack([x, np.zeros(10), np.zeros(10)])
+    row1 = np.column_stack([x, 0.03*np.ones(10), np.zeros(10)])
+    return np.concatenate([row0, row1])
+
+
+@unittest.skipIf(SKIP_REASON is not None, SKIP_REASON)
+class SparseTransitionTableTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.points = make_points()
+        self.variance = 0.02**2
+        self.table = SparseTransitionTable.fromPoints(self.points, self.variance)
+
+    def test_rows_are_stochastic(self):
+        for row in xrange(len(self.points)):
+            indices, probabilities = self.table.getRow(row)
+            self.assertIn(row, indices)
+            self.assertTrue(np.all(probabilities > 0))
+            self.assertAlmostEqual(np.sum(probabilities), 1.0)
+
+    def test_sample_stays_within_row(self):
+        rows = np.repeat(np.arange(len(self.points)), 100)
+        samples = self.table.sample(rows)
+
+        self.assertEqual(samples.shape, rows.shape)
+        for row in xrange(len(self.points)):
+            indices, _ = self.table.getRow(row)
+            self.assertTrue(np.all(np.in1d(samples[rows == row], indices)))
+
+    def test_sample_frequencies_match_probabilities(self):
+        numSamples = 200000
+        for row in [0, 4, 15]:
+            samples = self.table.sample(row*np.ones(numSamples, dtype=np.int64))
+            indices, probabilities = self.table.getRow(row)
+
+            frequencies = np.array([np.mean(samples == i) for i in indices])
+            # 5 standard deviations of the binomial frequency estimate
+            tolerance = 5*np.sqrt(probabilities*(1 - probabilities)/numSamples)
+            self.assertTrue(np.all(np.abs(frequencies - probabilities) <= tolerance),
+                            "row %d: sampled %s, expected %s" %(row, frequencies, probabilities))
+
+    def test_groups_restrict_transitions(self):
+        groups = np.repeat([0, 1], 10)
+        table = SparseTransitionTable.fromPoints(self.points, self.variance, groups=groups)
+
+        rows = np.repeat(np.arange(len(self.points)), 50)
+        samples = table.sample(rows)
+        np.testing.assert_array_equal(groups[samples], groups[rows])
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'cache', 'transitions.npz')
+            self.table.save(filename, points=self.points)
+            table, metadata = SparseTransitionTable.load(filename)
+        finally:
+            shutil.rmtree(directory)
+
+        for key in ['indptr', 'indices', 'probabilities', 'aliasProbability', 'alias']:
+            np.testing.assert_array_equal(getattr(table, key), getattr(self.table, key))
+        np.testing.assert_array_equal(metadata['points'], self.points)
+
+
+if __name__ == '__main__':
+    unittest.main()
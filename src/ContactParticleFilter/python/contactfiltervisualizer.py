@@ -33,6 +33,10 @@ class ContactFilterVisualizer(object):
         subscriber = lcmUtils.addSubscriber("CONTACT_PARTICLE_FILTER_DATA", cpf_lcmtypes.CPF_data_t, self.onContactFilterMsg)
         subscriber.setSpeedLimit(10)
 
+        subscriber = lcmUtils.addSubscriber("CONTACT_PARTICLE_FILTER_DATA_PACKED", cpf_lcmtypes.CPF_packed_data_t,
+                                            self.onContactFilterPackedMsg)
+        subscriber.setSpeedLimit(10)
+
     def getCurrentPose(self):
         return self.robotSystem.robotStateJointController.q
 
@@ -56,15 +60,8 @@ class ContactFilterVisualizer(object):
         if False:
             defaultColor = [0,1,1]
 
-        numParticlesAtCFP = {}
-        numTotalParticles = len(particleSet.particleList)
-
-        for particle in particleSet.particleList:
-            cfp = particle.cfp
-            if numParticlesAtCFP.has_key(cfp):
-                numParticlesAtCFP[cfp] += 1
-            else:
-                numParticlesAtCFP[cfp] = 1
+        cfpList, numParticlesAtCFP = particleSet.getParticleCounts()
+        numTotalParticles = particleSet.getNumberOfParticles()
 
         # now we need to draw this
         plungerMaxLength = 0.4
@@ -75,7 +72,7 @@ class ContactFilterVisualizer(object):
         d = DebugData()
         q = self.getCurrentPose()
         if self.options['vis']['drawParticles']:
-            for cfp, numParticles in numParticlesAtCFP.iteritems():
+            for cfp, numParticles in zip(cfpList, numParticlesAtCFP):
                 color = defaultColor
 
                 # if particleSet.mostLikelyParticle is not None:
@@ -154,3 +151,8 @@ class ContactFilterVisualizer(object):
 
         self.drawParticleSetList(particleSetList)
 
+    def onContactFilterPackedMsg(self, msg):
+        particleSetList = ContactFilter.decodePackedCPFData(msg)
+
+        self.drawParticleSetList(particleSetList)
+
@@ -20,7 +20,10 @@ def startup(robotSystem, globalsDict=None):
     rs = robotSystem
 
     externalForce = externalforce.ExternalForce(rs)
-    contactFilter = contactfilter.ContactFilter(rs.robotStateModel, rs.robotStateJointController)
+    # share the drake model so that link jacobians are only computed once per pose,
+    # unless the filter runs on the async engine, which then loads its own (and says so)
+    contactFilter = contactfilter.ContactFilter(rs.robotStateModel, rs.robotStateJointController,
+                                                drakeModel=externalForce.drakeModel)
     contactFilterVisualizer = contactfiltervisualizer.ContactFilterVisualizer(rs, rs.robotStateModel)
     linkSelection = linkselection.LinkWidget(rs.view, rs.robotStateModel, externalForce)
     linkSelection.start()
@@ -1,6 +1,7 @@
 __author__ = 'manuelli'
 
 import numpy as np
+import scipy.spatial
 from director import vtkAll as vtk
 import os
 import os.path
@@ -20,12 +21,43 @@ except ImportError:
 
 
 class ContactPointLocator(object):
+    """
+    Finds the closest contact eligible point on the robot to a point in world frame.
 
-    def __init__(self, robotStateModel, linkFrameContainer, contact_cells_filename):
+    Two modes are supported
+    - exact: for each link, transform the query point and run a vtkCellLocator query
+    - kdtree: the contact cells are sampled once into a link frame point/normal table,
+      queries are answered in batch with a single world frame KD-tree over all links.
+      The tree is rebuilt only when a link frame moves by more than the rebuild tolerances.
+      The result is the closest sample point, so it is only as accurate as sampleSpacing.
+
+    The exact mode is always available through findClosestPointExact for verification.
+    """
+
+    def __init__(self, robotStateModel, linkFrameContainer, contact_cells_filename, options=None):
         self.robotStateModel = robotStateModel
         self.linkFrameContainer = linkFrameContainer
+        self.options = ContactPointLocator.getDefaultOptions()
+        if options is not None:
+            self.options.update(options)
+
         self.loadCellsFromFile(contact_cells_filename)
 
+        if self.options['mode'] not in ['exact', 'kdtree']:
+            raise ValueError("contact point locator mode must be one of exact or kdtree")
+
+        if self.options['mode'] == 'kdtree':
+            self.createSampleTables()
+
+    @staticmethod
+    def getDefaultOptions():
+        options = dict()
+        options['mode'] = 'exact'
+        options['sampleSpacing'] = 0.005 # approximate distance between samples on a cell, in meters
+        options['rebuildTranslationTolerance'] = 1e-4 # meters
+        options['rebuildRotationTolerance'] = 1e-3 # radians
+        return options
+
 
     # filename is relative path from SPARTAN_SOURCE_DIR
     def loadCellsFromFile(self, filename):
@@ -62,8 +94,147 @@ class ContactPointLocator(object):
                                           'worldToMesh': worldToMesh, 'cellData': cellData, 'normals': normals}
 
 
-     # should return a dict with linkName, contactLocation, contactNormal, etc.
+    def createSampleTables(self):
+        """
+        Samples the contact cells of each link into a table of points and normals
+        expressed in link frame. Every cell gets its centroid, larger cells get
+        additional samples on a barycentric grid so that the samples are roughly
+        sampleSpacing apart.
+        """
+        self.sampleTables = dict()
+        sampleSpacing = self.options['sampleSpacing']
+
+        for linkName, data in self.locatorData.iteritems():
+            polyData = data['polyData']
+            worldToMesh = data['worldToMesh']
+            points = []
+            normals = []
+            cellIds = []
+
+            for cellId in xrange(polyData.GetNumberOfCells()):
+                cellPoints = polyData.GetCell(cellId).GetPoints()
+                vertices = np.array([cellPoints.GetPoint(i) for i in xrange(cellPoints.GetNumberOfPoints())])
+                if len(vertices) == 0:
+                    continue
+
+                # same normal convention as findClosestPointSingleLink
+                normal = -np.array(data['normals'].GetTuple(cellId))
+                normalLinkFrame = worldToMesh.TransformVector(normal)
+
+                for sample in ContactPointLocator.sampleCell(vertices, sampleSpacing):
+                    points.append(worldToMesh.TransformPoint(sample))
+                    normals.append(normalLinkFrame)
+                    cellIds.append(cellId)
+
+            self.sampleTables[linkName] = {'points': np.array(points), 'normals': np.array(normals),
+                                           'cellIds': np.array(cellIds, dtype=np.int64)}
+
+        self.linkNamesInTree = sorted(self.sampleTables.keys())
+        self.sampleLinkIdx = np.concatenate([idx*np.ones(len(self.sampleTables[linkName]['points']), dtype=np.int64)
+                                             for idx, linkName in enumerate(self.linkNamesInTree)])
+        self.samplePointsLinkFrame = np.concatenate([self.sampleTables[linkName]['points']
+                                                     for linkName in self.linkNamesInTree])
+        self.sampleNormalsLinkFrame = np.concatenate([self.sampleTables[linkName]['normals']
+                                                      for linkName in self.linkNamesInTree])
+        self.sampleCellIds = np.concatenate([self.sampleTables[linkName]['cellIds']
+                                             for linkName in self.linkNamesInTree])
+
+        self.kdTree = None
+        self.kdTreeLinkFrames = None
+        self.kdTreeStats = {'builds': 0, 'queries': 0}
+
+    @staticmethod
+    def sampleCell(vertices, sampleSpacing):
+        """
+        Centroid of the cell, plus a barycentric grid of points for triangles
+        with edges longer than sampleSpacing
+        """
+        samples = [np.mean(vertices, axis=0)]
+        if len(vertices) != 3:
+            return samples
+
+        maxEdgeLength = max(np.linalg.norm(vertices[i] - vertices[(i+1) % 3]) for i in xrange(3))
+        numDivisions = int(np.ceil(maxEdgeLength/sampleSpacing))
+        if numDivisions < 2:
+            return samples
+
+        for i in xrange(numDivisions + 1):
+            for j in xrange(numDivisions + 1 - i):
+                k = numDivisions - i - j
+                samples.append((i*vertices[0] + j*vertices[1] + k*vertices[2])/float(numDivisions))
+
+        return samples
+
+    def getLinkFrameMatrices(self):
+        """
+        :return: L x 4 x 4 array of link to world transforms for the links in the tree
+        """
+        return np.array([self.linkFrameContainer.getLinkFrameMatrix(linkName) for linkName in self.linkNamesInTree])
+
+    def needsRebuild(self, linkFrames):
+        if self.kdTree is None:
+            return True
+
+        translationChange = np.linalg.norm(linkFrames[:, 0:3, 3] - self.kdTreeLinkFrames[:, 0:3, 3], axis=1)
+        if np.max(translationChange) > self.options['rebuildTranslationTolerance']:
+            return True
+
+        # angle of the relative rotation R_old^T R_new, computed from its trace
+        relativeRotationTrace = np.einsum('lji,lji->l', self.kdTreeLinkFrames[:, 0:3, 0:3], linkFrames[:, 0:3, 0:3])
+        angle = np.arccos(np.clip((relativeRotationTrace - 1)/2.0, -1.0, 1.0))
+        return np.max(angle) > self.options['rebuildRotationTolerance']
+
+    def updateKDTree(self):
+        """
+        Rebuilds the world frame KD-tree if the robot pose changed beyond the tolerances
+        """
+        linkFrames = self.getLinkFrameMatrices()
+        if not self.needsRebuild(linkFrames):
+            return
+
+        R = linkFrames[self.sampleLinkIdx, 0:3, 0:3]
+        t = linkFrames[self.sampleLinkIdx, 0:3, 3]
+        samplePointsWorldFrame = np.einsum('nij,nj->ni', R, self.samplePointsLinkFrame) + t
+
+        self.kdTree = scipy.spatial.cKDTree(samplePointsWorldFrame)
+        self.kdTreeLinkFrames = linkFrames
+        self.kdTreeStats['builds'] += 1
+
+    def findClosestPoints(self, pointsInWorldFrame):
+        """
+        Batched version of findClosestPoint
+
+        :param pointsInWorldFrame: N x 3 array
+        :return: list of closestPointData dicts, see findClosestPointSingleLink
+        """
+        pointsInWorldFrame = np.asarray(pointsInWorldFrame, dtype=np.float64).reshape(-1, 3)
+
+        if self.options['mode'] == 'exact':
+            return [self.findClosestPointExact(point) for point in pointsInWorldFrame]
+
+        self.updateKDTree()
+        dist, sampleIdx = self.kdTree.query(pointsInWorldFrame)
+        self.kdTreeStats['queries'] += len(pointsInWorldFrame)
+
+        closestPointDataList = []
+        for d, idx in zip(dist, sampleIdx):
+            closestPointData = {'linkName': self.linkNamesInTree[self.sampleLinkIdx[idx]],
+                                'closestPoint': self.samplePointsLinkFrame[idx].copy(),
+                                'cellId': self.sampleCellIds[idx],
+                                'normal': self.sampleNormalsLinkFrame[idx].copy(),
+                                'dist2': d**2}
+            closestPointDataList.append(closestPointData)
+
+        return closestPointDataList
+
+    # should return a dict with linkName, contactLocation, contactNormal, etc.
     def findClosestPoint(self, pointInWorldFrame):
+        if self.options['mode'] == 'exact':
+            return self.findClosestPointExact(pointInWorldFrame)
+
+        return self.findClosestPoints(pointInWorldFrame)[0]
+
+    def findClosestPointExact(self, pointInWorldFrame):
         closestPointData = None
 
         for linkName in self.locatorData:
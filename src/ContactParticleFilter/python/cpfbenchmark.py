@@ -0,0 +1,353 @@
+__author__ = 'manuelli'
+
+"""
+Headless replay and benchmark harness for the contact particle filter.
+
+Feeds residuals into ContactFilter.contactParticleFilterStep, either replayed
+from an lcm log or generated synthetically with
+ExternalForce.computeSingleContactPointResidual, and reports per stage latency
+percentiles, QP counts and localization error against the true contact locations.
+
+Usage
+-------
+directorPython cpfbenchmark.py --director_config <director_config.json> --synthetic --num_steps 500
+directorPython cpfbenchmark.py --director_config <director_config.json> --log <lcmlog>
+
+Exits with a nonzero status if one of the --max_* thresholds is exceeded, so it can be used in CI.
+"""
+
+import argparse
+import sys
+import time
+import numpy as np
+import yaml
+
+import lcm
+import bot_core as lcmbotcore
+import robotlocomotion as robotlocomotion_lcmtypes
+import cpf_lcmtypes
+from director import robotstate
+
+STAGE_NAMES = ['motionModel', 'measurementUpdate', 'importanceResampling', 'mostLikely', 'publish',
+               'manageParticleSets']
+
+PERCENTILES = [50, 90, 99]
+
+
+class LCMLogReplaySource(object):
+    """
+    Replays the residual, robot state and external force channels of an lcm log.
+    The ground truth contact locations come from EXTERNAL_CONTACT_LOCATION, as
+    published by externalforce.py.
+    """
+
+    def __init__(self, contactFilter, logFilename, residualChannel='RESIDUAL_OBSERVER_STATE',
+                 robotStateChannel='EST_ROBOT_STATE'):
+        self.contactFilter = contactFilter
+        self.logFilename = logFilename
+        self.residualChannel = residualChannel
+        self.robotStateChannel = robotStateChannel
+
+    def iterSteps(self):
+        """
+        Applies each logged message to the contact filter, yields the true
+        contact locations whenever a new residual is ready for a filter step
+        """
+        trueContacts = []
+        log = lcm.EventLog(self.logFilename, 'r')
+
+        for event in log:
+            if event.channel == self.robotStateChannel:
+                msg = lcmbotcore.robot_state_t.decode(event.data)
+                q = robotstate.convertStateMessageToDrakePose(msg)
+                self.contactFilter.robotStateJointController.setPose('EST_ROBOT_STATE', q)
+
+            elif event.channel == 'EXTERNAL_FORCE_TORQUE':
+                msg = cpf_lcmtypes.external_force_torque_t.decode(event.data)
+                self.contactFilter.onExternalForceTorque(msg)
+
+            elif event.channel == 'EXTERNAL_CONTACT_LOCATION':
+                msg = cpf_lcmtypes.multiple_contact_location_t.decode(event.data)
+                trueContacts = [{'linkName': c.body_name, 'locationInWorld': np.array(c.contact_position_in_world)}
+                                for c in msg.contacts]
+
+            elif event.channel == self.residualChannel:
+                msg = robotlocomotion_lcmtypes.residual_observer_state_t.decode(event.data)
+                self.contactFilter.onResidualObserverState(msg)
+                yield trueContacts
+
+        log.close()
+
+
+class SyntheticContactSource(object):
+    """
+    Generates residuals for random contacts at the current robot pose.
+
+    Each episode applies contactsPerEpisode forces, at random contact filter
+    points and with random directions inside the friction cone, for
+    stepsPerContact steps. It is followed by stepsWithoutContact steps of zero
+    residual so that the filter removes its particle sets before the next episode.
+    """
+
+    def __init__(self, contactFilter, externalForce, numSteps=500, contactsPerEpisode=1, stepsPerContact=50,
+                 stepsWithoutContact=30, forceMagnitude=None, noiseStddev=0.0, dt=0.01, linkNames=None, seed=0):
+        self.contactFilter = contactFilter
+        self.externalForce = externalForce
+        self.numSteps = numSteps
+        self.contactsPerEpisode = contactsPerEpisode
+        self.stepsPerContact = stepsPerContact
+        self.stepsWithoutContact = stepsWithoutContact
+        if forceMagnitude is None:
+            forceMagnitude = externalForce.options['externalForce']['initialForceMagnitude']
+        self.forceMagnitude = forceMagnitude
+        self.noiseStddev = noiseStddev
+        self.dt = dt
+        self.randomState = np.random.RandomState(seed)
+
+        self.cfpList = contactFilter.contactFilterPointListAll
+        if linkNames is not None:
+            self.cfpList = [cfp for cfp in self.cfpList if cfp.linkName in linkNames]
+
+    def sampleContacts(self):
+        """
+        :return: list of dicts with linkName, forceLocation, forceDirection in link frame
+        """
+        contacts = []
+        linkNamesUsed = set()
+        while len(contacts) < self.contactsPerEpisode:
+            cfp = self.cfpList[self.randomState.randint(len(self.cfpList))]
+            if cfp.linkName in linkNamesUsed:
+                continue
+
+            linkNamesUsed.add(cfp.linkName)
+            force = np.dot(cfp.rotatedFrictionCone, self.randomState.uniform(size=cfp.rotatedFrictionCone.shape[1]))
+            contacts.append({'linkName': cfp.linkName, 'forceLocation': np.array(cfp.contactLocation),
+                             'forceDirection': force/np.linalg.norm(force)})
+
+        return contacts
+
+    def iterSteps(self):
+        utime = 0
+        step = 0
+        contacts = []
+        episodeLength = self.stepsPerContact + self.stepsWithoutContact
+
+        while step < self.numSteps:
+            if step % episodeLength == 0:
+                contacts = self.sampleContacts()
+            activeContacts = contacts if (step % episodeLength) < self.stepsPerContact else []
+
+            q = self.contactFilter.getCurrentPose()
+            self.externalForce.drakeModel.setJointPositions(q)
+
+            residual = np.zeros(self.contactFilter.drakeModel.numJoints)
+            trueContacts = []
+            for contact in activeContacts:
+                linkName = contact['linkName']
+                wrench = self.externalForce.computeWrench(linkName, contact['forceDirection'], self.forceMagnitude,
+                                                          contact['forceLocation'])
+                residual += self.externalForce.computeSingleContactPointResidual(linkName, wrench)
+
+                linkFrame = self.contactFilter.robotStateModel.getLinkFrame(linkName)
+                trueContacts.append({'linkName': linkName,
+                                     'locationInWorld': np.array(linkFrame.TransformPoint(contact['forceLocation']))})
+
+            if self.noiseStddev > 0:
+                residual = residual + self.randomState.normal(scale=self.noiseStddev, size=np.size(residual))
+
+            self.contactFilter.setCurrentUtime(utime)
+            self.contactFilter.linksWithExternalForce = [contact['linkName'] for contact in activeContacts]
+            self.contactFilter.residual = residual
+
+            yield trueContacts
+
+            utime += int(self.dt*1e6)
+            step += 1
+
+
+class CPFBenchmark(object):
+    """
+    Runs the contact filter over the steps of a source and collects the statistics
+    """
+
+    def __init__(self, contactFilter):
+        self.contactFilter = contactFilter
+        self.reset()
+
+    def reset(self):
+        self.stepTimes = []
+        self.stageTimes = dict((name, []) for name in STAGE_NAMES)
+        self.numQPSolves = []
+        self.localizationErrors = []
+        self.numStepsWithContact = 0
+        self.numStepsWithEstimate = 0
+
+    def getEstimatedContactLocations(self):
+        solnData = self.contactFilter.mostLikelySolnData
+        if solnData is None:
+            return []
+
+        return [np.array(self.contactFilter.getCFPLocationInWorld(d['ContactFilterPoint']))
+                for d in solnData['cfpData']]
+
+    def run(self, source, verbose=False):
+        # the step is driven from here, not from the lcm subscriber
+        self.contactFilter.stop()
+
+        for trueContacts in source.iterSteps():
+            startTime = time.time()
+            self.contactFilter.contactParticleFilterStep(drawParticleSets=False, applyMotionModel=True)
+            self.stepTimes.append(time.time() - startTime)
+
+            stageTimes = self.contactFilter.debugInfo['stageTimes']
+            for name in STAGE_NAMES:
+                self.stageTimes[name].append(stageTimes[name])
+            self.numQPSolves.append(self.contactFilter.debugInfo['numQPSolves'])
+
+            if verbose and (len(self.stepTimes) % 100 == 0):
+                print "step %d, %.1f ms" %(len(self.stepTimes), 1000*self.stepTimes[-1])
+
+            if len(trueContacts) == 0:
+                continue
+
+            self.numStepsWithContact += 1
+            estimatedLocations = self.getEstimatedContactLocations()
+            if len(estimatedLocations) == 0:
+                continue
+
+            self.numStepsWithEstimate += 1
+            for contact in trueContacts:
+                error = min(np.linalg.norm(contact['locationInWorld'] - location) for location in estimatedLocations)
+                self.localizationErrors.append(error)
+
+    @staticmethod
+    def summarize(data):
+        data = np.asarray(data, dtype=np.float64)
+        if data.size == 0:
+            return None
+
+        summary = {'mean': float(np.mean(data)), 'max': float(np.max(data))}
+        for p in PERCENTILES:
+            summary['p%d' %(p)] = float(np.percentile(data, p))
+        return summary
+
+    def getResults(self):
+        results = dict()
+        results['numSteps'] = len(self.stepTimes)
+        results['stepTime'] = CPFBenchmark.summarize(self.stepTimes)
+        results['stageTimes'] = dict((name, CPFBenchmark.summarize(self.stageTimes[name])) for name in STAGE_NAMES)
+        results['numQPSolves'] = {'total': int(np.sum(self.numQPSolves)),
+                                  'perStep': CPFBenchmark.summarize(self.numQPSolves)}
+        results['localizationError'] = CPFBenchmark.summarize(self.localizationErrors)
+
+        results['detectionRate'] = None
+        if self.numStepsWithContact > 0:
+            results['detectionRate'] = 1.0*self.numStepsWithEstimate/self.numStepsWithContact
+
+        return results
+
+    def printResults(self):
+        results = self.getResults()
+        print "\nCPF BENCHMARK: %d steps" %(results['numSteps'])
+        print "%-22s %10s %10s %10s %10s %10s" %("stage (ms)", "mean", "p50", "p90", "p99", "max")
+
+        rows = [(name, results['stageTimes'][name]) for name in STAGE_NAMES] + [('total', results['stepTime'])]
+        for name, summary in rows:
+            if summary is None:
+                continue
+            print "%-22s %10.2f %10.2f %10.2f %10.2f %10.2f" %(name, 1000*summary['mean'], 1000*summary['p50'],
+                                                               1000*summary['p90'], 1000*summary['p99'],
+                                                               1000*summary['max'])
+
+        print "QP solves: %d total, %.1f per step" %(results['numQPSolves']['total'],
+                                                     results['numQPSolves']['perStep']['mean'])
+
+        if results['localizationError'] is not None:
+            print "localization error (m): mean %.4f, p50 %.4f, p90 %.4f" %(results['localizationError']['mean'],
+                                                                            results['localizationError']['p50'],
+                                                                            results['localizationError']['p90'])
+        if results['detectionRate'] is not None:
+            print "detection rate: %.3f" %(results['detectionRate'])
+
+
+def checkThresholds(results, maxP90StepTime=None, maxMedianLocalizationError=None, minDetectionRate=None):
+    """
+    :return: list of failure messages, empty if all the thresholds are met
+    """
+    failures = []
+    if (maxP90StepTime is not None) and (results['stepTime']['p90'] > maxP90StepTime):
+        failures.append("p90 step time %.4f s above %.4f s" %(results['stepTime']['p90'], maxP90StepTime))
+
+    if maxMedianLocalizationError is not None:
+        error = results['localizationError']
+        if (error is None) or (error['p50'] > maxMedianLocalizationError):
+            failures.append("median localization error above %.4f m" %(maxMedianLocalizationError))
+
+    if minDetectionRate is not None:
+        if (results['detectionRate'] is None) or (results['detectionRate'] < minDetectionRate):
+            failures.append("detection rate below %.3f" %(minDetectionRate))
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", type=str, default=None, help="lcm log to replay")
+    parser.add_argument("--synthetic", action='store_true', help="generate residuals from random contacts")
+    parser.add_argument("--num_steps", type=int, default=500)
+    parser.add_argument("--num_contacts", type=int, default=1)
+    parser.add_argument("--noise_stddev", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="save the results to this yaml file")
+    parser.add_argument("--max_p90_step_time", type=float, default=None)
+    parser.add_argument("--max_median_localization_error", type=float, default=None)
+    parser.add_argument("--min_detection_rate", type=float, default=None)
+    # the remaining arguments are for director
+    args, _ = parser.parse_known_args()
+
+    if (args.log is None) == (not args.synthetic):
+        parser.error("specify exactly one of --log or --synthetic")
+
+    from director import mainwindowapp
+    from director import robotsystem
+    import contactfilter
+    import externalforce
+
+    app = mainwindowapp.construct()
+    robotSystem = robotsystem.create(app.view, planningOnly=True)
+
+    contactFilter = None
+    if args.synthetic:
+        externalForce = externalforce.ExternalForce(robotSystem)
+        externalForce.stopPublishing()
+        contactFilter = contactfilter.ContactFilter(robotSystem.robotStateModel, robotSystem.robotStateJointController,
+                                                    drakeModel=externalForce.drakeModel)
+        source = SyntheticContactSource(contactFilter, externalForce, numSteps=args.num_steps,
+                                        contactsPerEpisode=args.num_contacts, noiseStddev=args.noise_stddev,
+                                        seed=args.seed)
+    else:
+        contactFilter = contactfilter.ContactFilter(robotSystem.robotStateModel, robotSystem.robotStateJointController)
+        source = LCMLogReplaySource(contactFilter, args.log, residualChannel=contactFilter.options['debug']['residualChannel'])
+
+    np.random.seed(args.seed)
+    benchmark = CPFBenchmark(contactFilter)
+    benchmark.run(source, verbose=True)
+    benchmark.printResults()
+    contactFilter.printDebugInfo()
+
+    results = benchmark.getResults()
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            yaml.dump(results, f, default_flow_style=False)
+
+    failures = checkThresholds(results, maxP90StepTime=args.max_p90_step_time,
+                               maxMedianLocalizationError=args.max_median_localization_error,
+                               minDetectionRate=args.min_detection_rate)
+    for failure in failures:
+        print "FAILED:", failure
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
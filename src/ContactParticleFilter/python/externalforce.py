@@ -109,7 +109,7 @@ class ExternalForce(object):
 
     def createTwoStepEstimator(self, configFilename):
         self.twoStepEstimator = TwoStepEstimator(self.robotStateModel, self.robotSystem.robotStateJointController,
-                                                 self.linkMeshData, configFilename)
+                                                 self.linkMeshData, configFilename, drakeModel=self.drakeModel)
 
     # either get the EST_ROBOT_STATE utime or just use the wall clock
     def getUtime(self):
@@ -212,10 +212,10 @@ class ExternalForce(object):
 
         return wrenchTransformed
 
-    # WARNING: make sure you call doKinematics before you get here
+    # WARNING: make sure you call self.drakeModel.setJointPositions before you get here
     def computeSingleContactPointResidual(self, linkName, wrench):
         linkId = self.drakeModel.model.findLinkID(linkName)
-        geometricJacobian = self.drakeModel.geometricJacobian(0,linkId,linkId,0,False)
+        geometricJacobian = self.drakeModel.getLinkJacobian(linkId)
         singleContactResidual = np.dot(geometricJacobian.transpose(), wrench)
         return singleContactResidual
 
@@ -287,10 +287,7 @@ class ExternalForce(object):
         # make sure we call doKinematics before we do all the geometricJacobian stuff
         if self.options['debug']['publishTrueResidual']:
             q = self.getCurrentPose()
-            self.drakeModel.model.setJointPositions(q)
-
-            # alternatively can just do setJointPositions
-            # self.drakeModel.model.setJointPositions(q)
+            self.drakeModel.setJointPositions(q)
 
 
         for key, val in self.externalForces.iteritems():
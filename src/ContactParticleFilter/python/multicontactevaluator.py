@@ -0,0 +1,187 @@
+__author__ = 'manuelli'
+import numpy as np
+import heapq
+import multiprocessing
+
+import qpsolver
+from nnlsqp import NNLSQP
+
+NUM_FRICTION_CONE_BASIS_VECTORS = 4
+
+# solver owned by each worker process, see initializeWorker
+_workerQPSolver = None
+
+
+def initializeWorker(numContactsList, config):
+    """
+    Pool initializer, every worker process builds its own solver models
+    """
+    global _workerQPSolver
+    _workerQPSolver = qpsolver.QPSolver(numContactsList, config)
+
+
+def computeSingleContactLowerBounds(residual, weightMatrix, H_stacks, rankTol=1e-9):
+    """
+    Lower bounds on the multi contact QP objective.
+
+    Any force on the contact points of the other links produces a residual in
+    the span of their H columns. Projecting that span out and solving the
+    single contact QP for contact point c on link i gives LB_i(c), and every
+    hypothesis that uses c has objective >= LB_i(c).
+
+    :param H_stacks: list, one entry per link, of N_i x n x 4 arrays
+    :return: list of arrays, LB_i of size N_i
+    """
+    # change of variables so that the weighted norm becomes the euclidean norm
+    L = np.linalg.cholesky(weightMatrix)
+    residualTilde = np.dot(L.transpose(), residual)
+    H_tilde_stacks = [np.einsum('nk,bnm->bkm', L, H) for H in H_stacks]
+
+    n = len(residual)
+    nnls = NNLSQP()
+    lowerBounds = []
+    for i in xrange(len(H_stacks)):
+        otherColumns = [H.transpose(1, 0, 2).reshape(n, -1) for j, H in enumerate(H_tilde_stacks) if j != i]
+
+        P = np.eye(n)
+        if len(otherColumns) > 0:
+            U, s, _ = np.linalg.svd(np.concatenate(otherColumns, axis=1), full_matrices=False)
+            U = U[:, s > rankTol*max(s[0], 1.0)]
+            P = P - np.dot(U, U.transpose())
+
+        H_projected = np.einsum('nk,bkm->bnm', P, H_tilde_stacks[i])
+        solnData = nnls.solveBatch(np.dot(P, residualTilde), H_projected, np.eye(n))
+        lowerBounds.append(np.maximum(solnData['objectiveValue'], 0.0))
+
+    return lowerBounds
+
+
+def evaluateShard(qpSolver, solverType, residual, weightMatrix, H_stacks, chunks, topK, lowerBounds=None):
+    """
+    Solves the QPs for a subset of the cartesian product of contact points
+
+    :param chunks: list of (start, stop) ranges of flat indices into the product,
+    the last link varies fastest
+    :param topK: size of the heap of best hypotheses that is kept
+    :param lowerBounds: optional, see computeSingleContactLowerBounds. A hypothesis
+    is skipped once the heap is full and its lower bound is above the worst objective in the heap
+    :return: list of (objectiveValue, flatIdx, alpha), and a stats dict
+    """
+    shape = tuple(len(H) for H in H_stacks)
+    numContacts = len(H_stacks)
+
+    # max heap on the objective value, stored as its negative
+    heap = []
+    stats = {'numEvaluated': 0, 'numPruned': 0}
+    for start, stop in chunks:
+        flatIdx = np.arange(start, stop)
+        idx = np.unravel_index(flatIdx, shape)
+
+        if (lowerBounds is not None) and (len(heap) == topK):
+            bound = np.max([lowerBounds[i][idx[i]] for i in xrange(numContacts)], axis=0)
+            keep = bound < -heap[0][0]
+            stats['numPruned'] += int(np.sum(~keep))
+            flatIdx = flatIdx[keep]
+            idx = tuple(x[keep] for x in idx)
+
+        if len(flatIdx) == 0:
+            continue
+
+        H = np.concatenate([H_stacks[i][idx[i]] for i in xrange(numContacts)], axis=2)
+        solnData = qpSolver.solveBatch(numContacts, residual, H, weightMatrix, solverType=solverType)
+        stats['numEvaluated'] += len(flatIdx)
+
+        for k in xrange(len(flatIdx)):
+            item = (-solnData['objectiveValue'][k], flatIdx[k], solnData['alpha'][k])
+            if len(heap) < topK:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+
+    return [(-negObj, flatIdx, alpha) for negObj, flatIdx, alpha in heap], stats
+
+
+def evaluateShardInWorker(args):
+    return evaluateShard(_workerQPSolver, *args)
+
+
+class MultiContactHypothesisEvaluator(object):
+    """
+    Finds the best multi contact hypotheses, one contact point per active link,
+    over the full cartesian product of contact points.
+
+    The product is split into chunks which are interleaved across numWorkers
+    processes, each with its own QPSolver. Each shard keeps a heap of its best
+    topK hypotheses and, if prune is set, skips hypotheses whose single contact
+    lower bound shows they can't make it into the heap.
+
+    The worker pool is forked in the constructor, so the evaluator should be
+    built on the main thread. Forking later from the engine's worker thread
+    would copy the locks held by the other threads in whatever state they are in.
+    """
+
+    def __init__(self, numContactsList, config, numWorkers=1, topK=20, prune=True, chunkSize=2000):
+        self.numContactsList = numContactsList
+        self.config = config
+        self.numWorkers = numWorkers
+        self.topK = topK
+        self.prune = prune
+        self.chunkSize = chunkSize
+        self.pool = None
+        self.stats = {'numHypotheses': 0, 'numEvaluated': 0, 'numPruned': 0}
+
+        if self.numWorkers > 1:
+            self.getPool()
+
+    def getPool(self):
+        # only forks here after close()
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.numWorkers, initializer=initializeWorker,
+                                             initargs=(self.numContactsList, self.config))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def evaluate(self, qpSolver, residual, weightMatrix, H_stacks, solverType):
+        """
+        :param qpSolver: solver used when evaluating in this process
+        :param H_stacks: list, one entry per active link, of N_i x n x 4 arrays
+        :return: list of (objectiveValue, indexTuple, alpha) sorted by objectiveValue,
+        indexTuple has the index of the contact point on each link, alpha is numContacts x 4
+        """
+        shape = tuple(len(H) for H in H_stacks)
+        numHypotheses = int(np.prod(shape))
+
+        lowerBounds = None
+        if self.prune:
+            lowerBounds = computeSingleContactLowerBounds(residual, weightMatrix, H_stacks)
+
+        chunks = [(start, min(start + self.chunkSize, numHypotheses))
+                  for start in xrange(0, numHypotheses, self.chunkSize)]
+
+        if self.numWorkers > 1 and len(chunks) > 1:
+            numShards = min(self.numWorkers, len(chunks))
+            args = [(solverType, residual, weightMatrix, H_stacks, chunks[i::numShards], self.topK, lowerBounds)
+                    for i in xrange(numShards)]
+            shardResults = self.getPool().map(evaluateShardInWorker, args)
+        else:
+            shardResults = [evaluateShard(qpSolver, solverType, residual, weightMatrix, H_stacks, chunks,
+                                          self.topK, lowerBounds)]
+
+        self.stats = {'numHypotheses': numHypotheses, 'numEvaluated': 0, 'numPruned': 0}
+        hypotheses = []
+        for shardHypotheses, shardStats in shardResults:
+            hypotheses.extend(shardHypotheses)
+            self.stats['numEvaluated'] += shardStats['numEvaluated']
+            self.stats['numPruned'] += shardStats['numPruned']
+
+        hypotheses.sort(key=lambda x: x[0])
+        hypotheses = hypotheses[0:self.topK]
+
+        return [(objectiveValue, np.unravel_index(flatIdx, shape),
+                 alpha.reshape(len(shape), NUM_FRICTION_CONE_BASIS_VECTORS))
+                for objectiveValue, flatIdx, alpha in hypotheses]
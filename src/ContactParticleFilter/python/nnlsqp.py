@@ -0,0 +1,187 @@
+__author__ = 'manuelli'
+import numpy as np
+
+NUM_FRICTION_CONE_BASIS_VECTORS = 4
+
+
+class NNLSQP(object):
+    """
+    Solves the measurement update QP
+
+        min_alpha (r - H alpha)^T W (r - H alpha)  s.t. alpha >= 0
+
+    as a nonnegative least squares problem with the Lawson-Hanson active set
+    method. The problems are tiny (4 variables per contact point), so instead
+    of calling a solver once per particle, solveBatch runs the active set
+    iterations for a whole stack of problems at once in numpy.
+
+    Doesn't need any external solver, and returns the same alphaVals and
+    objectiveValue as ContactFilterGurobi.
+    """
+
+    def __init__(self, numContactsList=None, maxIterFactor=3, tol=1e-10):
+        # numContactsList is only kept for interface compatibility with the other
+        # solvers, problems of any size can be solved
+        self.numContactsList = numContactsList
+        self.maxIterFactor = maxIterFactor
+        self.tol = tol
+
+        # number of active set iterations of the last call to solveBatch
+        self.lastNumIterations = 0
+
+    # solves a single measurement update step for numContacts
+    def solve(self, numContacts, residual, H_list, W):
+        H = np.concatenate(H_list, axis=1)
+        batchSolnData = self.solveBatch(residual, H[np.newaxis, :, :], W)
+        return self.parseModelSolution(batchSolnData['alpha'][0], batchSolnData['objectiveValue'][0], numContacts)
+
+    def solveBatch(self, residual, H, W, initialPassive=None):
+        """
+        Solves a batch of QPs that share the residual and weight matrix
+
+        :param residual: numpy array of size n
+        :param H: B x n x m stack of matrices, m = 4*numContacts
+        :param W: n x n weight matrix
+        :param initialPassive: optional B x m boolean array, guess of which alpha's
+        are positive at the solution, e.g. the ones from the previous filter step
+        :return: dict with alpha (B x m) and objectiveValue (B,)
+        """
+        H = np.asarray(H, dtype=np.float64)
+        residual = np.asarray(residual, dtype=np.float64)
+
+        HtW = np.einsum('bnm,nk->bmk', H, W)
+        Q = np.einsum('bmn,bnk->bmk', HtW, H)
+        c = np.einsum('bmn,n->bm', HtW, residual)
+        constant = np.dot(np.dot(residual, W), residual)
+
+        alpha = self.solveNormalEquationsNonnegative(Q, c, initialPassive=initialPassive)
+        objectiveValue = (np.einsum('bi,bij,bj->b', alpha, Q, alpha) - 2.0*np.einsum('bi,bi->b', c, alpha)
+                          + constant)
+
+        return {'alpha': alpha, 'objectiveValue': objectiveValue}
+
+    def solveNormalEquationsNonnegative(self, Q, c, initialPassive=None):
+        """
+        Lawson-Hanson active set method for min x^T Q x - 2 c^T x s.t. x >= 0,
+        run in lockstep over a batch of problems.
+
+        :param Q: B x m x m positive semidefinite matrices
+        :param c: B x m
+        :param initialPassive: optional B x m boolean array to warm start from
+        :return: x, B x m
+        """
+        B, m = c.shape
+        x = np.zeros((B, m))
+        passive = np.zeros((B, m), dtype=bool)
+        tol = self.tol*max(1.0, np.max(np.abs(c)) if c.size else 1.0)
+
+        if initialPassive is not None:
+            x, passive = NNLSQP.initializeFromPassiveSet(Q, c, np.array(initialPassive, dtype=bool), tol)
+
+        batchIdx = np.arange(B)
+        self.lastNumIterations = 0
+        for outerIter in xrange(self.maxIterFactor*m):
+            self.lastNumIterations += 1
+            # negative half gradient, a positive entry means increasing that
+            # variable decreases the objective
+            w = c - np.einsum('bij,bj->bi', Q, x)
+            w[passive] = -np.inf
+            j = np.argmax(w, axis=1)
+            active = np.flatnonzero(w[batchIdx, j] > tol)
+            if len(active) == 0:
+                break
+
+            passive[active, j[active]] = True
+
+            while len(active) > 0:
+                s = NNLSQP.solvePassiveSet(Q[active], c[active], passive[active])
+                P = passive[active]
+
+                feasible = np.all((s > tol) | ~P, axis=1)
+                x[active[feasible]] = s[feasible]
+
+                active = active[~feasible]
+                if len(active) == 0:
+                    break
+
+                # step from x towards s until the first passive variable hits zero,
+                # then move that variable to the active set
+                s = s[~feasible]
+                xa = x[active]
+                P = passive[active]
+                blocking = P & (s <= tol)
+                denom = np.where(blocking, xa - s, 1.0)
+                ratio = np.where(blocking, xa/denom, np.inf)
+                k = np.argmin(ratio, axis=1)
+                stepSize = ratio[np.arange(len(active)), k]
+
+                xa = xa + stepSize[:, np.newaxis]*(s - xa)
+                P = P & (xa > tol)
+                P[np.arange(len(active)), k] = False
+                xa[~P] = 0.0
+
+                x[active] = xa
+                passive[active] = P
+
+        return x
+
+    @staticmethod
+    def initializeFromPassiveSet(Q, c, P, tol):
+        """
+        Finds a valid starting point for the active set iterations from a guess
+        of the passive set: x is the unconstrained minimizer over the passive
+        variables and strictly positive on them. Variables that come out
+        nonpositive are dropped from the passive set until that holds, at most
+        m rounds since the passive set only shrinks.
+        """
+        B, m = c.shape
+        x = np.zeros((B, m))
+        todo = np.flatnonzero(np.any(P, axis=1))
+
+        for i in xrange(m):
+            if len(todo) == 0:
+                break
+
+            s = NNLSQP.solvePassiveSet(Q[todo], c[todo], P[todo])
+            Pt = P[todo]
+            positive = s > tol
+            done = np.all(positive | ~Pt, axis=1)
+
+            x[todo[done]] = np.where(Pt[done], s[done], 0.0)
+            P[todo[~done]] = Pt[~done] & positive[~done]
+            todo = todo[~done]
+            todo = todo[np.any(P[todo], axis=1)]
+
+        # anything left didn't settle, start it cold
+        P[todo] = False
+        x[todo] = 0.0
+        return x, P
+
+    @staticmethod
+    def solvePassiveSet(Q, c, P):
+        """
+        Unconstrained minimizer over the passive variables, the others are fixed at zero
+        """
+        m = c.shape[1]
+        PP = P[:, :, np.newaxis] & P[:, np.newaxis, :]
+        Qp = np.where(PP, Q, 0.0)
+
+        # identity on the rows of the fixed variables, small regularization on the
+        # others in case the columns of H are numerically dependent
+        diag = np.arange(m)
+        scale = np.maximum(np.abs(Q[:, diag, diag]).max(axis=1), 1.0)
+        Qp[:, diag, diag] += np.where(P, 1e-12*scale[:, np.newaxis], 1.0)
+
+        cp = np.where(P, c, 0.0)
+        return np.linalg.solve(Qp, cp[:, :, np.newaxis])[:, :, 0]
+
+    def parseModelSolution(self, alpha, objectiveValue, numContacts):
+        d = {}
+        d['alphaVals'] = {}
+
+        for i in xrange(0, numContacts):
+            for j in xrange(0, NUM_FRICTION_CONE_BASIS_VECTORS):
+                d['alphaVals'][i,j] = alpha[i*NUM_FRICTION_CONE_BASIS_VECTORS + j]
+
+        d['objectiveValue'] = objectiveValue
+        return d
@@ -0,0 +1,87 @@
+import unittest
+import numpy as np
+import scipy.linalg
+import scipy.optimize
+
+from nnlsqp import NNLSQP, NUM_FRICTION_CONE_BASIS_VECTORS
+
+
+def make_problems(numProblems, numRows, numContacts, seed=0):
+    """
+    Random measurement update QPs of the same shape as the contact filter's,
+    sharing the residual and the (diagonal, positive) weight matrix
+    """
+    np.random.seed(seed)
+    m = numContacts*NUM_FRICTION_CONE_BASIS_VECTORS
+    H = np.random.randn(numProblems, numRows, m)
+    residual = np.random.randn(numRows)
+    W = np.diag(np.random.uniform(0.5, 2.0, size=numRows))
+    return residual, H, W
+
+
+def solve_with_scipy(residual, H, W):
+    """
+    min (r - H alpha)^T W (r - H alpha) s.t. alpha >= 0 is the nonnegative
+    least squares problem min |L^T (r - H alpha)|^2 with W = L L^T
+    """
+    L = scipy.linalg.cholesky(W, lower=True)
+    alpha, rnorm = scipy.optimize.nnls(np.dot(L.T, H), np.dot(L.T, residual))
+    return alpha, rnorm**2
+
+
+class NNLSQPTest(unittest.TestCase):
+
+    def assertMatchesScipy(self, residual, H, W, batchSolnData):
+        for b in xrange(H.shape[0]):
+            alpha, objectiveValue = solve_with_scipy(residual, H[b], W)
+            np.testing.assert_allclose(batchSolnData['alpha'][b], alpha, atol=1e-7)
+            np.testing.assert_allclose(batchSolnData['objectiveValue'][b], objectiveValue, rtol=1e-7, atol=1e-9)
+
+    def test_batch_matches_scipy_nnls(self):
+        solver = NNLSQP()
+        for numContacts in [1, 2, 3]:
+            residual, H, W = make_problems(50, 7, numContacts, seed=numContacts)
+            batchSolnData = solver.solveBatch(residual, H, W)
+
+            self.assertEqual(batchSolnData['alpha'].shape, (50, numContacts*NUM_FRICTION_CONE_BASIS_VECTORS))
+            self.assertTrue(np.all(batchSolnData['alpha'] >= 0))
+            self.assertMatchesScipy(residual, H, W, batchSolnData)
+
+    def test_more_variables_than_rows(self):
+        # the problem isn't strictly convex, only the objective value is unique
+        residual, H, W = make_problems(20, 3, 2, seed=3)
+        batchSolnData = NNLSQP().solveBatch(residual, H, W)
+
+        self.assertTrue(np.all(batchSolnData['alpha'] >= 0))
+        for b in xrange(H.shape[0]):
+            _, objectiveValue = solve_with_scipy(residual, H[b], W)
+            np.testing.assert_allclose(batchSolnData['objectiveValue'][b], objectiveValue, rtol=1e-6, atol=1e-9)
+
+    def test_warm_start_gives_the_same_solution(self):
+        solver = NNLSQP()
+        residual, H, W = make_problems(30, 7, 2, seed=4)
+        coldSolnData = solver.solveBatch(residual, H, W)
+
+        # the right passive set, a wrong one, and the cold start all agree
+        for initialPassive in [coldSolnData['alpha'] > 0, np.random.uniform(size=coldSolnData['alpha'].shape) > 0.5]:
+            warmSolnData = solver.solveBatch(residual, H, W, initialPassive=initialPassive)
+            np.testing.assert_allclose(warmSolnData['alpha'], coldSolnData['alpha'], atol=1e-9)
+            np.testing.assert_allclose(warmSolnData['objectiveValue'], coldSolnData['objectiveValue'], atol=1e-9)
+
+    def test_solve_returns_alpha_vals_per_contact(self):
+        numContacts = 2
+        residual, H, W = make_problems(1, 7, numContacts, seed=5)
+        H_list = np.split(H[0], numContacts, axis=1)
+
+        solnData = NNLSQP().solve(numContacts, residual, H_list, W)
+        alpha, objectiveValue = solve_with_scipy(residual, H[0], W)
+
+        self.assertEqual(len(solnData['alphaVals']), numContacts*NUM_FRICTION_CONE_BASIS_VECTORS)
+        for i in xrange(numContacts):
+            for j in xrange(NUM_FRICTION_CONE_BASIS_VECTORS):
+                self.assertAlmostEqual(solnData['alphaVals'][i, j], alpha[i*NUM_FRICTION_CONE_BASIS_VECTORS + j])
+        self.assertAlmostEqual(solnData['objectiveValue'], objectiveValue)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,6 +31,7 @@ class PythonDrakeModel(object):
         self.jointNameToIdxMap = self.getJointNameToIdxMap()
         self.jointIdxToNameMap = self.getJointIdxToNameMap()
         self.jointNames = self.model.getJointNames()
+        self.initializeJacobianCache()
 
     # filename should be relative to drake source director
     def loadRobotModelFromURDFFilename(self, floatingBaseTypeString, filename):
@@ -96,6 +97,49 @@ class PythonDrakeModel(object):
         return data
 
 
+    def initializeJacobianCache(self):
+        # link jacobians for the current joint positions, keyed by body id
+        self.linkJacobianCache = dict()
+        self.jacobianCacheStats = {'hits': 0, 'misses': 0}
+        self.currentJointPositions = None
+
+        # incremented every time the joint positions change, lets other caches
+        # that depend on the pose know when to invalidate themselves
+        self.jointPositionsVersion = 0
+
+    def setJointPositions(self, q):
+        """
+        Calls setJointPositions on the underlying ddDrakeModel. If q is different
+        from the last call the link jacobian cache is cleared. Use this instead of
+        self.model.setJointPositions so that the cache stays valid.
+        """
+        q = np.array(q, dtype=np.float64)
+        if (self.currentJointPositions is not None) and np.array_equal(q, self.currentJointPositions):
+            return
+
+        self.model.setJointPositions(q)
+        self.currentJointPositions = q
+        self.linkJacobianCache = dict()
+        self.jointPositionsVersion += 1
+
+    def getLinkJacobian(self, bodyId):
+        """
+        Geometric jacobian of bodyId expressed in its own frame, i.e.
+        geometricJacobian(0, bodyId, bodyId, 0, False). Cached until the joint
+        positions change.
+
+        Make sure you call setJointPositions(q) before calling this method
+        """
+        linkJacobian = self.linkJacobianCache.get(bodyId)
+        if linkJacobian is None:
+            self.jacobianCacheStats['misses'] += 1
+            linkJacobian = self.geometricJacobian(0, bodyId, bodyId, 0, False)
+            self.linkJacobianCache[bodyId] = linkJacobian
+        else:
+            self.jacobianCacheStats['hits'] += 1
+
+        return linkJacobian
+
     # make sure you call setJointPositions(q) on the ddDrakeModel BEFORE you
     # call this method
     def geometricJacobian(self, base_body_or_frame_ind, end_effector_body_or_frame_id,
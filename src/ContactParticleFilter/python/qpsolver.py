@@ -8,7 +8,8 @@ NUM_FRICTION_CONE_BASIS_VECTORS = 4
 
 
 # General interface that can be used by the CPF to solve the QP problems.
-# Have the option of using either Gurobi or ForcesPro
+# Have the option of using either Gurobi, ForcesPro or the built in batched
+# nonnegative least squares solver (nnls)
 class QPSolver:
 
     def __init__(self, numContactsList, config):
@@ -20,6 +21,9 @@ class QPSolver:
         self.config = copy.deepcopy(config)
         self.numContactsList = numContactsList
 
+        # nnls has no external dependencies, so it is always available
+        self.initializeNNLS(numContactsList)
+
         if self.config['solver']['loadAllSolvers']:
             self.initializeForcesPro(numContactsList)
             self.initializeGurobi(numContactsList)
@@ -27,8 +31,10 @@ class QPSolver:
             self.initializeGurobi(numContactsList)
         elif self.config['solver']['solverType'] == 'forcespro':
             self.initializeForcesPro(numContactsList)
+        elif self.config['solver']['solverType'] == 'nnls':
+            pass
         else:
-            raise ValueError("solver type must be one of gurobi or forcespro")
+            raise ValueError("solver type must be one of gurobi, forcespro or nnls")
 
     def initializeGurobi(self, numContactsList):
         import contactfiltergurobi
@@ -38,17 +44,51 @@ class QPSolver:
         import forcesproqp
         self.forcesPro = forcesproqp.ForcesProQP(numContactsList)
 
+    def initializeNNLS(self, numContactsList):
+        import nnlsqp
+        self.nnls = nnlsqp.NNLSQP(numContactsList)
+
     def solve(self, numContacts, residual, H_list, weightMatrix, solverType='gurobi'):
         solnData = {}
         if solverType == 'gurobi':
             solnData = self.gurobi.solve(numContacts, residual, H_list, weightMatrix)
         elif solverType=='forcespro':
             solnData = self.forcesPro.solve(numContacts, residual, H_list, weightMatrix)
+        elif solverType == 'nnls':
+            solnData = self.nnls.solve(numContacts, residual, H_list, weightMatrix)
         else:
-            raise ValueError("solver type must be one of gurobi or forcespro")
+            raise ValueError("solver type must be one of gurobi, forcespro or nnls")
 
         return solnData
 
+    def solveBatch(self, numContacts, residual, H, weightMatrix, solverType='gurobi', initialPassive=None):
+        """
+        Solves a batch of QPs with the same residual and number of contacts.
+
+        :param H: B x n x (4*numContacts) array, H[b] is the concatenation of the H_list
+        of problem b
+        :param initialPassive: optional B x (4*numContacts) boolean array of the alpha's
+        expected to be positive, used to warm start the nnls solver. Ignored by the other solvers
+        :return: dict with alpha (B x 4*numContacts) and objectiveValue (B,)
+        """
+        if solverType == 'nnls':
+            return self.nnls.solveBatch(residual, H, weightMatrix, initialPassive=initialPassive)
+
+        # the other solvers handle a single problem at a time
+        numProblems = len(H)
+        numVars = numContacts*NUM_FRICTION_CONE_BASIS_VECTORS
+        batchSolnData = {'alpha': np.zeros((numProblems, numVars)), 'objectiveValue': np.zeros(numProblems)}
+        for b in xrange(numProblems):
+            H_list = np.split(H[b], numContacts, axis=1)
+            solnData = self.solve(numContacts, residual, H_list, weightMatrix, solverType=solverType)
+            for i in xrange(0,numContacts):
+                for j in xrange(0,NUM_FRICTION_CONE_BASIS_VECTORS):
+                    batchSolnData['alpha'][b, i*NUM_FRICTION_CONE_BASIS_VECTORS + j] = solnData['alphaVals'][i,j]
+
+            batchSolnData['objectiveValue'][b] = solnData['objectiveValue']
+
+        return batchSolnData
+
 
     def test(self, numContacts = 1):
         numVars = numContacts*NUM_FRICTION_CONE_BASIS_VECTORS
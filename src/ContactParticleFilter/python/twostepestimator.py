@@ -15,18 +15,23 @@ import contactfilterutils as cfUtils
 
 class TwoStepEstimator:
 
-    def __init__(self, robotStateModel, robotStateJointController, linkMeshData, config_filename):
+    def __init__(self, robotStateModel, robotStateJointController, linkMeshData, config_filename, drakeModel=None):
         """
 
         :param robotStateModel:
         :param robotStateJointController:
         :param linkMeshData: can be found in externalForce.linkMeshData
         :param config: config filename, expected to be examples/ContactParticleFilter/config directory
+        :param drakeModel: optional PythonDrakeModel to share (along with its jacobian cache),
+        if None a new one is created
         """
         self.robotStateModel = robotStateModel
         self.robotStateJointController = robotStateJointController
         self.config = cfUtils.loadConfig(config_filename)
-        self.createDrakeModel()
+        if drakeModel is None:
+            self.createDrakeModel()
+        else:
+            self.drakeModel = drakeModel
         self.initializeRobotPoseTranslator()
         self.linkMeshData = linkMeshData
         self.computeResidualThresholdForContact()
@@ -108,14 +113,14 @@ class TwoStepEstimator:
 
         # do kinematics on our internal model
         q = self.getCurrentPose()
-        self.drakeModel.model.setJointPositions(q)
+        self.drakeModel.setJointPositions(q)
 
         # stack the jacobians
         jacobianTransposeList = []
 
         for linkName in linkNamesWithContactForce:
             linkId = self.drakeModel.model.findLinkID(linkName)
-            J = self.drakeModel.geometricJacobian(0,linkId,linkId, 0, False)
+            J = self.drakeModel.getLinkJacobian(linkId)
             jacobianTransposeList.append(J.transpose())
 
 
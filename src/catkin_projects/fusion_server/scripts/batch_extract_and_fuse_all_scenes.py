@@ -3,138 +3,139 @@
 import os
 import rospy
 import time
-import gc
-import multiprocessing as mp
-import resource
+import argparse
 
 
-from fusion_server.fusion import FusionServer
+from fusion_server.fusion import FusionServer, extract_images_from_rosbag
 import fusion_server.tsdf_fusion as tsdf_fusion
+from fusion_server.scene_pipeline import ScenePipeline, PipelineStage
 
 import spartan.utils.utils as spartanUtils
 
 
-def mem():
-    print('Memory usage         : % 2.2f MB' % round(
-        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,1)
-    )
+def extract_data_from_rosbag(scene):
+    extract_images_from_rosbag(scene.bag_filepath, scene.images_dir, streaming=True)
 
-def already_extracted_rosbag(log_full_path):
-    images_dir = os.path.join(log_full_path, 'processed', 'images')
-    file_to_check = os.path.join(images_dir, 'camera_info.yaml')
-    return os.path.exists(file_to_check)
-        
-def already_ran_tsdf_fusion(log_full_path):
-    processed_dir = os.path.join(log_full_path, 'processed')
-    file_to_check = os.path.join(processed_dir, 'fusion_mesh.ply')
-    return os.path.exists(file_to_check)
+def format_data_for_tsdf(scene):
+    tsdf_fusion.format_data_for_tsdf(scene.images_dir)
 
-def already_downsampled(log_full_path):
-    images_dir = os.path.join(log_full_path, 'processed', 'images')
-    file_to_check_1 = os.path.join(images_dir, "000000_rgb.png")
-    file_to_check_2 = os.path.join(images_dir, "000001_rgb.png")
-    return not (os.path.exists(file_to_check_1) and os.path.exists(file_to_check_2))
-
-def extract_data_from_rosbag(bag_filepath):
-    fs = FusionServer()    
-    processed_dir, images_dir = fs.extract_data_from_rosbag(bag_filepath)
-
-def extract_and_fuse_single_scene(log_full_path, downsample=False):
-
-    print "extracting and fusing scene:", log_full_path 
-    log = os.path.split(log_full_path)[-1]
-
-    mem()
-
-    if not already_extracted_rosbag(log_full_path):
-        print "extracting", log_full_path
-        bag_filepath = os.path.join(log_full_path, 'raw', 'fusion_'+log+'.bag')
-
-        # run this memory intensive step in a process, to allow
-        # it to release memory back to the operating system
-        # when finished
-        proc = mp.Process(target=extract_data_from_rosbag, args=(bag_filepath,))
-        proc.start()
-        proc.join()
-
-        print "finished extracting", log_full_path
-        # counter_new_extracted += 1
+def run_tsdf_fusion(scene):
+    if tsdf_fusion.tsdf_fusion_cuda_available():
+        tsdf_fusion.run_tsdf_fusion_cuda(scene.images_dir, output_dir=scene.processed_dir)
     else:
-        print "already extracted", log_full_path
-
-
-    processed_dir = os.path.join(log_full_path, 'processed')
-    images_dir    = os.path.join(processed_dir, 'images')
-    
-    # we need to free some memory
-    gc.collect()
-    mem()
+        print "tsdf-fusion executable not found, running cpu tsdf fusion"
+        tsdf_fusion.run_tsdf_fusion_cpu(scene.images_dir, output_dir=scene.processed_dir)
+
+def convert_tsdf_to_ply(scene):
+    tsdf_bin_filename = os.path.join(scene.processed_dir, 'tsdf.bin')
+    tsdf_mesh_filename = os.path.join(scene.processed_dir, 'fusion_mesh.ply')
+    tsdf_fusion.convert_tsdf_to_ply(tsdf_bin_filename, tsdf_mesh_filename)
+
+def downsample(scene):
+    linear_distance_threshold = 0.03
+    angle_distance_threshold = 10 # in degrees
+    FusionServer.downsample_by_pose_difference_threshold(scene.images_dir, linear_distance_threshold, angle_distance_threshold)
+
+def make_pipeline_stages(downsample_images=False):
+    """
+    extract -> format -> fuse -> mesh (-> downsample)
+
+    Extraction decodes and encodes images in python, so it runs in worker
+    processes. The other stages mostly wait on disk or on the tsdf-fusion
+    executable and stay on the scene threads.
+
+    The format stage only writes the text files needed by the CUDA tsdf-fusion
+    executable, it is skipped when the CPU fusion is used.
+    """
+
+    def images_file(name):
+        return lambda scene: [os.path.join(scene.images_dir, name)]
+
+    def processed_file(name):
+        return lambda scene: [os.path.join(scene.processed_dir, name)]
+
+    # scenes extracted before pose_data.npz existed only have pose_data.yaml,
+    # those are still considered up to date
+    def pose_data(scene):
+        return [spartanUtils.get_pose_data_filename(scene.images_dir)]
+
+    def pose_and_camera_info(scene):
+        return pose_data(scene) + [os.path.join(scene.images_dir, 'camera_info.yaml')]
+
+    stages = []
+    stages.append(PipelineStage('extract', extract_data_from_rosbag,
+                                get_inputs=lambda scene: [scene.bag_filepath],
+                                get_outputs=pose_and_camera_info,
+                                use_process=True))
+
+    fuse_dependencies = ['extract']
+    if tsdf_fusion.tsdf_fusion_cuda_available():
+        stages.append(PipelineStage('format', format_data_for_tsdf,
+                                    get_inputs=pose_and_camera_info,
+                                    get_outputs=images_file('camera-intrinsics.txt'),
+                                    dependencies=['extract']))
+        fuse_dependencies = ['format']
+
+    stages.append(PipelineStage('fuse', run_tsdf_fusion,
+                                get_inputs=pose_and_camera_info,
+                                get_outputs=processed_file('tsdf.bin'),
+                                dependencies=fuse_dependencies))
+
+    stages.append(PipelineStage('mesh', convert_tsdf_to_ply,
+                                get_inputs=processed_file('tsdf.bin'),
+                                get_outputs=processed_file('fusion_mesh.ply'),
+                                dependencies=['fuse']))
+
+    if downsample_images:
+        stages.append(PipelineStage('downsample', downsample,
+                                    get_inputs=pose_data,
+                                    get_outputs=images_file(FusionServer.KEYFRAMES_FILENAME),
+                                    dependencies=['extract']))
+
+    return stages
+
+def make_pipeline(num_workers=1, max_concurrent_extractions=None, max_concurrent_fusions=1,
+    downsample_images=False):
+    concurrency_limits = dict()
+    concurrency_limits['fuse'] = max_concurrent_fusions
+    if max_concurrent_extractions is not None:
+        concurrency_limits['extract'] = max_concurrent_extractions
+
+    return ScenePipeline(make_pipeline_stages(downsample_images=downsample_images),
+                         num_workers=num_workers, concurrency_limits=concurrency_limits)
 
+def extract_and_fuse_single_scene(log_full_path, downsample=False):
+    print "extracting and fusing scene:", log_full_path
+    pipeline = make_pipeline(num_workers=1, downsample_images=downsample)
+    pipeline.run([log_full_path])
 
-    if not already_ran_tsdf_fusion(log_full_path):
-        print "preparing for tsdf_fusion for", log_full_path
-        tsdf_fusion.format_data_for_tsdf(images_dir)
-        gc.collect()
-
-        print "running tsdf fusion"
-        tsdf_fusion.run_tsdf_fusion_cuda(images_dir)
-        gc.collect()
 
-        print "converting tsdf to ply"
-        tsdf_bin_filename = os.path.join(processed_dir, 'tsdf.bin')
-        tsdf_mesh_filename = os.path.join(processed_dir, 'fusion_mesh.ply')
-        tsdf_fusion.convert_tsdf_to_ply(tsdf_bin_filename, tsdf_mesh_filename)
-        # counter_new_fused += 1
-    else:
-        print "already ran tsdf_fusion for", log_full_path
-
-    if not already_downsampled(log_full_path) and downsample:
-        fs = FusionServer()
-        print "downsampling image folder"
-        linear_distance_threshold = 0.03
-        angle_distance_threshold = 10 # in degrees
-        fs.downsample_by_pose_difference_threshold(images_dir, linear_distance_threshold, angle_distance_threshold)
-        # counter_new_downsampled += 1
-    else:
-        print "already downsampled for", log_full_path
-
- 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_workers", type=int, default=4, help="number of scenes to process in parallel")
+    parser.add_argument("--max_concurrent_extractions", type=int, default=None)
+    parser.add_argument("--max_concurrent_fusions", type=int, default=1)
+    parser.add_argument("--downsample", action='store_true')
+    args = parser.parse_args()
 
     start = time.time()
 
-    fs = FusionServer()
-    
     logs_proto_path = os.path.join(spartanUtils.getSpartanSourceDir(), 'data_volume', 'pdc', 'logs_special', 'static_scenes')
 
     logs_proto_list = sorted(os.listdir(logs_proto_path))
+    log_full_paths = [os.path.join(logs_proto_path, log) for log in logs_proto_list]
 
-    counter_new_extracted   = 0
-    counter_new_fused       = 0
-    counter_new_downsampled = 0
-
-    for log in logs_proto_list:
-
-        log_full_path = os.path.join(logs_proto_path, log)
-
-        extract_and_fuse_single_scene(log_full_path)
-
+    pipeline = make_pipeline(num_workers=args.num_workers,
+                             max_concurrent_extractions=args.max_concurrent_extractions,
+                             max_concurrent_fusions=args.max_concurrent_fusions,
+                             downsample_images=args.downsample)
+    pipeline.run(log_full_paths)
 
     print "finished extracting and fusing all logs in logs_proto"
 
-    print "SUMMARY:"
-    # print "number new logs extracted:  ", counter_new_extracted
-    # print "number new logs fused:      ", counter_new_fused
-    # print "number new logs downsampled:", counter_new_downsampled
-
     end = time.time()
     hours, rem = divmod(end-start, 3600)
     minutes, seconds = divmod(rem, 60)
     time_string = "{:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds)
     print "total time:               ",  time_string
     print "(hours, minutes, seconds with two decimals)"
-
-
-
-
-
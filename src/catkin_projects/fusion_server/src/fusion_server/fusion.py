@@ -7,6 +7,10 @@ import sys
 import time
 import subprocess
 import copy
+import collections
+import threading
+import multiprocessing
+import multiprocessing.pool
 import numpy as np
 import cv2
 import shutil
@@ -66,13 +70,129 @@ class TFWrapper(object):
 
 
 
+def write_image(filename, img):
+    """
+    Writes an image using cv2.imwrite. Meant to be run inside an ImageWriterPool
+    worker, so errors are returned as a string instead of raised.
+    """
+    try:
+        if not cv2.imwrite(filename, img):
+            return "cv2.imwrite failed to write %s" %(filename)
+    except Exception as e:
+        return "failed to write %s: %s" %(filename, e)
+
+    return None
+
+
+class ImageWriterPool(object):
+    """
+    Encodes and writes images to disk using a pool of workers. cv2.imwrite
+    releases the GIL while compressing, so threads are usually enough. Set
+    use_processes=True to use a process pool instead.
+
+    The output is byte-identical to calling cv2.imwrite serially. submit()
+    blocks once max_pending writes are outstanding, which provides
+    back-pressure against whatever is producing the images.
+
+    With num_workers=0 images are written synchronously inside submit().
+    """
+
+    def __init__(self, num_workers=4, use_processes=False, max_pending=None):
+        self.num_workers = num_workers
+
+        if max_pending is None:
+            max_pending = 4 * max(num_workers, 1)
+
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._errors = []
+        self._results = []
+        self._pool = None
+
+        if num_workers > 0:
+            if use_processes:
+                self._pool = multiprocessing.Pool(num_workers)
+            else:
+                self._pool = multiprocessing.pool.ThreadPool(num_workers)
+
+    def submit(self, filename, img):
+        """
+        Queues img to be written to filename. Blocks if there are already
+        max_pending writes outstanding.
+        """
+        if self._pool is None:
+            self._on_write_finished(write_image(filename, img), release=False)
+            return
+
+        # the pool only calls the callback for writes that succeed, writes
+        # that fail inside the pool (e.g. img can't be sent to a worker
+        # process) are found by polling their results
+        while not self._pending.acquire(False):
+            if not self._release_failed_writes() and len(self._results) > 0:
+                self._results[0].wait(0.01)
+
+        try:
+            result = self._pool.apply_async(write_image, (filename, img), callback=self._on_write_finished)
+        except Exception:
+            self._pending.release()
+            raise
+
+        self._results.append(result)
+
+    def _on_write_finished(self, error, release=True):
+        # this runs on the pool's result handler thread, which dies if it raises
+        try:
+            if error is not None:
+                self._errors.append(error)
+        finally:
+            if release:
+                self._pending.release()
+
+    def _release_failed_writes(self):
+        """
+        Drops the finished writes from self._results, releasing the pending
+        slot of the ones that failed without calling _on_write_finished.
+
+        :return: whether any write had failed
+        """
+        unfinished = []
+        num_failed = 0
+        for result in self._results:
+            if not result.ready():
+                unfinished.append(result)
+            elif not result.successful():
+                try:
+                    result.get()
+                except Exception as e:
+                    self._errors.append("image write failed in the pool: %s" %(e))
+                self._pending.release()
+                num_failed += 1
+
+        self._results = unfinished
+        return num_failed > 0
+
+    def close(self):
+        """
+        Waits for all outstanding writes to finish. Raises an IOError if
+        any of them failed.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._release_failed_writes()
+
+        if len(self._errors) > 0:
+            raise IOError("%d image writes failed, first error: %s" %(len(self._errors), self._errors[0]))
+
+
 class ImageCapture(object):
     """
     Class used to capture synchronized images. It can also read them from a log
     """
 
     def __init__(self, rgb_topic, depth_topic, camera_info_topic,
-        camera_frame, world_frame, rgb_encoding='bgr8'):
+        camera_frame, world_frame, rgb_encoding='bgr8', num_image_writers=4,
+        image_writers_use_processes=False, max_skew_secs=None, export_pose_data_yaml=True):
 
         self.camera_frame = camera_frame
         self.world_frame = world_frame
@@ -80,6 +200,15 @@ class ImageCapture(object):
     
 
         self.rgb_encoding = rgb_encoding
+        self.num_image_writers = num_image_writers
+        self.image_writers_use_processes = image_writers_use_processes
+
+        # depth images without an rgb image within max_skew_secs are dropped,
+        # None keeps all of them
+        self.max_skew_secs = max_skew_secs
+
+        # pose_data.npz is always written, pose_data.yaml is a human readable copy
+        self.export_pose_data_yaml = export_pose_data_yaml
         self.topics_dict = dict()
         self.topics_dict['rgb'] = rgb_topic
         self.topics_dict['depth'] = depth_topic
@@ -177,7 +306,7 @@ class ImageCapture(object):
         print "image_topics: ", image_topics
 
         # extract TF information
-        tf_t = rosUtils.setup_tf_transformer_from_ros_bag(bag, cache_time_secs=3600)
+        tf_index = rosUtils.setup_tf_index_from_ros_bag(bag)
 
         log_rate = 100
 
@@ -201,17 +330,6 @@ class ImageCapture(object):
                 cv_img = rosUtils.depth_image_to_cv2_uint16(msg, bridge=self.cv_bridge)
                 data = depth_data
 
-                try:
-                    # rot ix (x,y,z,w)
-                    (trans, rot) = tf_t.lookupTransform(self.world_frame, self.camera_frame, msg.header.stamp)
-                except:
-                    print "wasn't able to get transform for image message %d, skipping" %(counter)
-                    continue
-
-
-                depth_data['camera_to_world'].append((trans, rot))
-                
-
             # save the relevant data
             data['msgs'].append(msg)
             data['cv_img'].append(cv_img)
@@ -223,13 +341,16 @@ class ImageCapture(object):
 
         rgb_data['timestamps'] = np.array(rgb_data['timestamps'])
 
+        # look up all the camera poses at once, rot is (x,y,z,w)
+        trans, rot, tf_valid = tf_index.lookupTransforms(self.world_frame, self.camera_frame, depth_data['timestamps'])
+        depth_data['camera_to_world'] = zip(trans.tolist(), rot.tolist())
+        if not np.all(tf_valid):
+            print "wasn't able to get transform for %d depth images, skipping them" %(np.count_nonzero(~tf_valid))
+
         # synchronize the images
-        synchronized_rgb_imgs = []
-        for idx, stamp in enumerate(depth_data['timestamps']):
-            rgb_idx = ImageCapture.lookup_synchronized_image(stamp, rgb_data['timestamps'])
-            synchronized_rgb_imgs.append(rgb_data['cv_img'][rgb_idx])
-            if idx % log_rate == 0:
-                print "depth image %d matched to rgb image %d" %(idx, rgb_idx)
+        rgb_indices, skews, valid = self.synchronize_timestamps(depth_data['timestamps'], rgb_data['timestamps'])
+        ImageCapture.print_skew_statistics(skews[valid], np.count_nonzero(~valid))
+        valid = valid & tf_valid
 
 
         # save to a file
@@ -237,10 +358,16 @@ class ImageCapture(object):
             os.makedirs(output_dir)
 
 
-        pose_data = dict()
+        pose_data = dict((key, []) for key in spartanUtils.POSE_DATA_COLUMNS)
 
-        for idx, depth_img in enumerate(depth_data['cv_img']):
-            rgb_img = synchronized_rgb_imgs[idx]
+        image_writer = self.make_image_writer_pool()
+
+        idx = 0
+        for depth_idx, depth_img in enumerate(depth_data['cv_img']):
+            if not valid[depth_idx]:
+                continue
+
+            rgb_img = rgb_data['cv_img'][rgb_indices[depth_idx]]
 
             rgb_filename = "%06i_%s.png" % (idx, "rgb")
             rgb_filename_full = os.path.join(output_dir, rgb_filename)
@@ -251,25 +378,164 @@ class ImageCapture(object):
             if idx % log_rate == 0:
                 print "writing image %d to file %s" %(idx, rgb_filename)
             
-            cv2.imwrite(rgb_filename_full, rgb_img)
+            image_writer.submit(rgb_filename_full, rgb_img)
             if not rgb_only:
-                cv2.imwrite(depth_filename_full, depth_img)
+                image_writer.submit(depth_filename_full, depth_img)
+
+            trans, rot = depth_data['camera_to_world'][depth_idx]
+            pose_data['index'].append(idx)
+            pose_data['timestamp'].append(depth_data['timestamps'][depth_idx])
+            pose_data['pose'].append(list(trans) + [rot[3], rot[0], rot[1], rot[2]])
+            pose_data['rgb_image_filename'].append(rgb_filename)
+            pose_data['depth_image_filename'].append(depth_filename)
+            idx += 1
 
-            pose_data[idx] = dict()
-            d = pose_data[idx] 
-            trans, rot = depth_data['camera_to_world'][idx]
-            quat_wxyz = [rot[3], rot[0], rot[1], rot[2]]
-            transform_dict = spartanUtils.dictFromPosQuat(trans, quat_wxyz)
-            d['camera_to_world'] = transform_dict
-            d['timestamp'] = depth_data['timestamps'][idx]
-            d['rgb_image_filename'] = rgb_filename
-            d['depth_image_filename'] = depth_filename
+        image_writer.close()
 
+        self.save_pose_data(pose_data, output_dir)
 
+        self.save_camera_info_from_ros_bag(bag, output_dir)
+
+    def process_ros_bag_streaming(self, bag, output_dir, rgb_only=False, reorder_window=10):
+        """
+        Streaming version of process_ros_bag. Instead of loading every image in
+        the log into memory, depth images are matched to the closest rgb image
+        within a small reorder window and the pair is written to disk as soon
+        as the match is known. Peak memory is bounded by reorder_window and
+        doesn't grow with the length of the log.
+
+        :param reorder_window: max number of rgb (and pending depth) messages to buffer.
+        If no rgb image arrives the oldest pending depth image is dropped and counted
+        as rejected
+        :type reorder_window: int
+        """
+
+        image_topics = self.topics_dict.values()
+        print "image_topics: ", image_topics
+
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        # extract TF information
+        tf_index = rosUtils.setup_tf_index_from_ros_bag(bag)
+
+        log_rate = 100
 
-        spartanUtils.saveToYaml(pose_data, os.path.join(output_dir,'pose_data.yaml'))
+        # (stamp, msg) for the most recent rgb messages
+        rgb_buffer = collections.deque(maxlen=reorder_window)
 
-        # extract the camera info msg
+        # (stamp, msg, camera_to_world) for depth messages waiting on a match
+        depth_buffer = collections.deque()
+        num_rgb_msgs = 0
+
+        pose_data = dict((key, []) for key in spartanUtils.POSE_DATA_COLUMNS)
+        skews = []
+        num_rejected = [0]
+
+        image_writer = self.make_image_writer_pool()
+
+        def write_next_pair():
+            depth_stamp, depth_msg, camera_to_world = depth_buffer.popleft()
+            rgb_stamps = [x[0] for x in rgb_buffer]
+            rgb_indices, pair_skews, valid = self.synchronize_timestamps([depth_stamp], rgb_stamps)
+            if not valid[0]:
+                num_rejected[0] += 1
+                return
+
+            rgb_stamp, rgb_msg = rgb_buffer[rgb_indices[0]]
+            skews.append(pair_skews[0])
+
+            idx = len(pose_data['index'])
+            rgb_filename = "%06i_%s.png" % (idx, "rgb")
+            depth_filename = "%06i_%s.png" % (idx, "depth")
+
+            if idx % log_rate == 0:
+                print "writing image %d to file %s, rgb/depth skew %.4f s" %(idx, rgb_filename, abs(rgb_stamp - depth_stamp)*1e-9)
+
+            rgb_img = self.cv_bridge.imgmsg_to_cv2(rgb_msg, desired_encoding=self.rgb_encoding)
+            image_writer.submit(os.path.join(output_dir, rgb_filename), rgb_img)
+            if not rgb_only:
+                depth_img = rosUtils.depth_image_to_cv2_uint16(depth_msg, bridge=self.cv_bridge)
+                image_writer.submit(os.path.join(output_dir, depth_filename), depth_img)
+
+            # rot is (x,y,z,w)
+            trans, rot = camera_to_world
+            pose_data['index'].append(idx)
+            pose_data['timestamp'].append(depth_stamp)
+            pose_data['pose'].append(list(trans) + [rot[3], rot[0], rot[1], rot[2]])
+            pose_data['rgb_image_filename'].append(rgb_filename)
+            pose_data['depth_image_filename'].append(depth_filename)
+
+        counter = 0
+        for topic, msg, t in bag.read_messages(topics=image_topics):
+            counter += 1
+
+            if counter % log_rate == 0:
+                print "processing image message %d" %(counter)
+
+            stamp = msg.header.stamp.to_nsec()
+            if "rgb" in topic:
+                rgb_buffer.append((stamp, msg))
+                num_rgb_msgs += 1
+            elif "depth" in topic:
+                try:
+                    # rot ix (x,y,z,w)
+                    camera_to_world = tf_index.lookupTransform(self.world_frame, self.camera_frame, msg.header.stamp)
+                except:
+                    print "wasn't able to get transform for image message %d, skipping" %(counter)
+                    continue
+
+                depth_buffer.append((stamp, msg, camera_to_world))
+
+            # a depth image can be written once an rgb image at least as new
+            # as it has arrived, or if it has been waiting too long
+            while (len(depth_buffer) > 0) and (len(rgb_buffer) > 0):
+                if (rgb_buffer[-1][0] >= depth_buffer[0][0]) or (len(depth_buffer) > reorder_window):
+                    write_next_pair()
+                else:
+                    break
+
+            # there is no rgb image to match against yet
+            while len(depth_buffer) > reorder_window:
+                depth_buffer.popleft()
+                num_rejected[0] += 1
+
+        while (len(depth_buffer) > 0) and (len(rgb_buffer) > 0):
+            write_next_pair()
+
+        num_rejected[0] += len(depth_buffer)
+        depth_buffer.clear()
+
+        if num_rgb_msgs == 0:
+            print "WARNING: no messages on rgb topic %s, no images were extracted" %(self.topics_dict['rgb'])
+
+        image_writer.close()
+
+        print "Extracted %d rgbd image pairs" %(len(pose_data['index']))
+        ImageCapture.print_skew_statistics(skews, num_rejected[0])
+
+        self.save_pose_data(pose_data, output_dir)
+
+        self.save_camera_info_from_ros_bag(bag, output_dir)
+
+    def save_pose_data(self, pose_data, output_dir):
+        """
+        Writes pose_data.npz, plus pose_data.yaml if self.export_pose_data_yaml
+
+        :param pose_data: dict of lists, keyed by spartanUtils.POSE_DATA_COLUMNS
+        """
+        columns = spartanUtils.make_pose_data_columns(pose_data['index'], pose_data['timestamp'], pose_data['pose'],
+                                                      pose_data['rgb_image_filename'], pose_data['depth_image_filename'])
+        spartanUtils.save_pose_data(columns, output_dir, export_yaml=self.export_pose_data_yaml)
+
+    def make_image_writer_pool(self):
+        return ImageWriterPool(num_workers=self.num_image_writers,
+                               use_processes=self.image_writers_use_processes)
+
+    def save_camera_info_from_ros_bag(self, bag, output_dir):
+        """
+        Writes the first camera info msg in the log to camera_info.yaml
+        """
 
         camera_info_msg = None
         for topic, msg, t in bag.read_messages(topics=self.camera_info_topic):
@@ -293,11 +559,65 @@ class ImageCapture(object):
         Parameters:
             query_time: int
                 the time you want to find closest match to
-            
+            timestamps: array of int
+                the timestamps to search
+
+        Returns the index of the timestamp closest to query_time
+        """
+        indices, _, _ = spartanUtils.synchronize_timestamps([query_time], timestamps)
+        return indices[0]
+
+    def synchronize_timestamps(self, depth_timestamps, rgb_timestamps):
+        """
+        Matches each depth timestamp (in nanoseconds) to the closest rgb timestamp,
+        rejecting matches further apart than self.max_skew_secs.
+        See spartanUtils.synchronize_timestamps
+        """
+        max_skew = None
+        if self.max_skew_secs is not None:
+            max_skew = self.max_skew_secs * 1e9
+
+        return spartanUtils.synchronize_timestamps(depth_timestamps, rgb_timestamps, max_skew=max_skew)
 
+    @staticmethod
+    def print_skew_statistics(skews, num_rejected=0):
         """
-        idx = np.searchsorted(timestamps, query_time)
-        return min(idx, np.size(timestamps))
+        Prints summary statistics of the rgb/depth skews, in nanoseconds
+        """
+        stats = spartanUtils.compute_skew_statistics(skews)
+        print "synchronized %d rgb/depth pairs, rejected %d" %(stats['num_pairs'], num_rejected)
+        if stats['num_pairs'] > 0:
+            print "rgb/depth skew (ms): mean %.2f, median %.2f, p95 %.2f, max %.2f" %(stats['mean']*1e-6,
+                stats['median']*1e-6, stats['p95']*1e-6, stats['max']*1e-6)
+
+
+def extract_images_from_rosbag(bag_filepath, images_dir, camera_serial_number="carmine_1", camera_frame=None,
+    world_frame='base', rgb_only=False, streaming=True, num_image_writers=4, max_skew_secs=None, export_pose_data_yaml=True):
+    """
+    Extracts the images and camera poses of a log into images_dir.
+
+    Only an ImageCapture is built and TF is read from the bag itself, there is
+    no FusionServer, RobotService or TF listener, so this doesn't need a ROS
+    master and can run in a worker process.
+
+    :param camera_frame: defaults to the rgb optical frame of the camera
+    """
+    rgb_topic = "/camera_"+camera_serial_number+"/rgb/image_rect_color"
+    depth_topic = "/camera_"+camera_serial_number+"/depth_registered/sw_registered/image_rect"
+    camera_info_topic = "/camera_"+camera_serial_number+"/rgb/camera_info"
+    if camera_frame is None:
+        camera_frame = "camera_" + camera_serial_number + "_rgb_optical_frame"
+
+    image_capture = ImageCapture(rgb_topic, depth_topic, camera_info_topic,
+        camera_frame, world_frame, rgb_encoding='bgr8',
+        num_image_writers=num_image_writers,
+        max_skew_secs=max_skew_secs,
+        export_pose_data_yaml=export_pose_data_yaml)
+    image_capture.load_ros_bag(bag_filepath)
+    if streaming:
+        image_capture.process_ros_bag_streaming(image_capture.ros_bag, images_dir, rgb_only=rgb_only)
+    else:
+        image_capture.process_ros_bag(image_capture.ros_bag, images_dir, rgb_only=rgb_only)
 
 
 class FusionType:
@@ -306,6 +626,9 @@ class FusionType:
 
 class FusionServer(object):
 
+    # manifest written by downsample_by_pose_difference_threshold
+    KEYFRAMES_FILENAME = "keyframes.yaml"
+
     def __init__(self, camera_serial_number="carmine_1"):
         self.camera_serial_number = camera_serial_number
         self.bagging = False
@@ -351,6 +674,22 @@ class FusionServer(object):
 
         self.config['fusion_type'] = FusionType.TSDF_FUSION
 
+        # number of workers used to encode/write png's when extracting
+        # images from a log, 0 writes them serially on the main thread
+        self.config['num_image_writers'] = 4
+
+        # max allowed time difference between a depth image and the rgb image it
+        # is synchronized with, None keeps every depth image
+        self.config['max_rgb_depth_skew_secs'] = None
+
+        # also write pose_data.yaml next to pose_data.npz when extracting images
+        self.config['export_pose_data_yaml'] = True
+
+        # after capture_scene_and_fuse the keyframes are listed in images/keyframes.yaml.
+        # If set, the images folder is also replaced by one holding only the keyframes,
+        # for tools that read the folder directly. This drops the other images.
+        self.config['materialize_keyframes'] = False
+
         self.topics_to_bag = [
             "/tf",
             "/tf_static",
@@ -604,35 +943,41 @@ class FusionServer(object):
 
         return bag_filepath
 
-    def extract_data_from_rosbag(self, bag_filepath, rgb_only=False):
+    def extract_data_from_rosbag(self, bag_filepath, rgb_only=False, streaming=False, images_dir=None):
         """
         This wraps the ImageCapture calls to load and process the raw rosbags, to prepare for fusion.
 
         :param: bag_filepath, the full path to where the rosbag (fusion-*.bag) was saved
         :ptype: string
 
+        :param: streaming, if True use ImageCapture.process_ros_bag_streaming, which keeps
+                memory bounded regardless of the length of the log
+        :ptype: bool
+
+        :param: images_dir, where to write the images. Defaults to processed/rgbd_images,
+                or processed/images if rgb_only
+        :ptype: string
+
         :return: data dir, images_dir the full path to the directory where all the extracted data is saved
                             and its images subdirectory
         :rtype: two strings, separated by commas
         """
 
-        # extract RGB and Depth images from Rosbag
-        rgb_topic = self.topics_dict['rgb']
-        depth_topic = self.topics_dict['depth']
-        camera_info_topic = self.topics_dict['camera_info']
-
         log_dir = os.path.dirname(os.path.dirname(bag_filepath))
         processed_dir = os.path.join(log_dir, 'processed')
-        images_dir = os.path.join(processed_dir, 'rgbd_images')
+        if images_dir is None:
+            images_dir = os.path.join(processed_dir, 'rgbd_images')
 
-        if rgb_only:
-            images_dir = os.path.join(processed_dir, 'images')
+            if rgb_only:
+                images_dir = os.path.join(processed_dir, 'images')
 
         print "Using log dir %s, processed_dir %s, and images_dir %s" % (log_dir, processed_dir, images_dir)
-        image_capture = ImageCapture(rgb_topic, depth_topic, camera_info_topic,
-            self.config['camera_frame'], self.config['world_frame'], rgb_encoding='bgr8')
-        image_capture.load_ros_bag(bag_filepath)
-        image_capture.process_ros_bag(image_capture.ros_bag, images_dir, rgb_only=rgb_only)
+        # extract RGB and Depth images from Rosbag
+        extract_images_from_rosbag(bag_filepath, images_dir, camera_serial_number=self.camera_serial_number,
+            camera_frame=self.config['camera_frame'], world_frame=self.config['world_frame'], rgb_only=rgb_only, streaming=streaming,
+            num_image_writers=self.config['num_image_writers'],
+            max_skew_secs=self.config['max_rgb_depth_skew_secs'],
+            export_pose_data_yaml=self.config['export_pose_data_yaml'])
 
         rospy.loginfo("Finished writing images to disk")
 
@@ -699,7 +1044,11 @@ class FusionServer(object):
         print "downsampling image folder"
         linear_distance_threshold = 0.03
         angle_distance_threshold = 10 # in degrees
-        FusionServer.downsample_by_pose_difference_threshold(images_dir, linear_distance_threshold, angle_distance_threshold)
+        materialize_dir = None
+        if self.config['materialize_keyframes']:
+            materialize_dir = images_dir
+        FusionServer.downsample_by_pose_difference_threshold(images_dir, linear_distance_threshold, angle_distance_threshold,
+            materialize_dir=materialize_dir)
 
 
         rospy.loginfo("handle_capture_scene_and_fuse finished!")
@@ -760,83 +1109,161 @@ class FusionServer(object):
 
 
     @staticmethod
-    def downsample_by_pose_difference_threshold(images_dir_full_path, linear_distance_threshold, rotation_angle_threshold):
+    def select_keyframes_by_pose_difference(positions, quaternions, linear_distance_threshold, rotation_angle_threshold):
+        """
+        Greedily selects keyframes: the first pose is kept, and the next pose kept
+        is the first one that is further than the thresholds from the last kept pose.
+
+        Which pose is compared against depends on the previous selection, so the
+        search is sequential over keyframes. The poses after each keyframe are
+        compared against it in batches, starting with twice the previous gap and
+        doubling until a pose past the thresholds is found. The total work stays
+        linear in the number of poses.
+
+        :param positions: N x 3 array of positions
+        :param quaternions: N x 4 array of quaternions [w,x,y,z]
+        :param linear_distance_threshold: threshold on the translation, in meters
+        :param rotation_angle_threshold: threshold on the angle between the rotations, in degrees
+        :return: indices of the kept poses
+        :rtype: list of int
         """
-        Downsamples poses and keeps only those that are sufficiently apart
+        num_poses = positions.shape[0]
+        if num_poses == 0:
+            return []
+
+        min_batch_size = 8
+        keyframe_indices = [0]
+        idx = 0
+        gap = min_batch_size
+        start = 1
+        while start < num_poses:
+            batch_size = max(2*gap, min_batch_size)
+            end = min(start + batch_size, num_poses)
+
+            linear_distance = np.linalg.norm(positions[start:end] - positions[idx], axis=1)
+            rotation_distance = spartanUtils.compute_angle_between_quaternions(quaternions[start:end], quaternions[idx])
+            far_enough = (linear_distance > linear_distance_threshold) | (np.rad2deg(rotation_distance) > rotation_angle_threshold)
+
+            if not np.any(far_enough):
+                gap = end - idx
+                start = end
+                continue
+
+            next_idx = start + int(np.argmax(far_enough))
+            gap = next_idx - idx
+            idx = next_idx
+            keyframe_indices.append(idx)
+            start = idx + 1
+
+        return keyframe_indices
+
+    @staticmethod
+    def downsample_by_pose_difference_threshold(images_dir_full_path, linear_distance_threshold, rotation_angle_threshold,
+        materialize_dir=None):
+        """
+        Downsamples poses and keeps only those that are sufficiently apart.
+
+        No images are moved. The selected frames are written to keyframes.yaml in
+        images_dir_full_path, which can be read with FusionServer.load_keyframe_pose_data.
+        If materialize_dir is given it is additionally populated with hardlinks to the
+        selected images, along with their pose data and camera_info.yaml, for
+        tools that need a flat directory.
+
         :param images_dir_full_path:
         :type images_dir_full_path:
         :param linear_distance_threshold: threshold on the translation, in meters
         :type linear_distance_threshold:
         :param rotation_angle_threshold: threshold on the angle between the rotations, in degrees
         :type rotation_angle_threshold:
-        :return:
-        :rtype:
+        :param materialize_dir: optional directory to hardlink the selected images into
+        :type materialize_dir: str
+        :return: the pose data columns of the selected frames, see spartanUtils.POSE_DATA_COLUMNS
+        :rtype: dict
         """
-        pose_yaml = os.path.join(images_dir_full_path, "pose_data.yaml")
-        pose_dict = spartanUtils.getDictFromYamlFilename(pose_yaml)
+        pose_data = spartanUtils.load_pose_data(images_dir_full_path)
 
-        images_dir_temp_path = os.path.join(os.path.dirname(images_dir_full_path), 'images_temp')
-        if not os.path.isdir(images_dir_temp_path):
-            os.makedirs(images_dir_temp_path)
-        
-        
-        previous_pose_pos = FusionServer.get_numpy_position_from_pose(pose_dict[0])
-        previous_pose_quat = FusionServer.get_quaternion_from_pose(pose_dict[0])
+        frame_indices = pose_data['index']
+        positions = pose_data['pose'][:, 0:3]
+        quaternions = pose_data['pose'][:, 3:7]
 
         print "Using downsampling by pose difference threshold... "
-        print "Previously: ", len(pose_dict), " images"
+        print "Previously: ", len(frame_indices), " images"
 
-        num_kept_images    = 0
-        num_deleted_images = 0
+        keyframe_rows = FusionServer.select_keyframes_by_pose_difference(positions, quaternions,
+            linear_distance_threshold, rotation_angle_threshold)
+        keyframes = [int(frame_indices[i]) for i in keyframe_rows]
 
-        for i in range(0,len(pose_dict)):
-            single_frame_data = pose_dict[i]
-            this_pose_pos = FusionServer.get_numpy_position_from_pose(pose_dict[i])
-            this_pose_quat = FusionServer.get_quaternion_from_pose(pose_dict[i])
+        manifest = dict()
+        manifest['linear_distance_threshold'] = linear_distance_threshold
+        manifest['rotation_angle_threshold'] = rotation_angle_threshold
+        manifest['num_frames'] = len(frame_indices)
+        manifest['keyframes'] = keyframes
 
-            linear_distance = np.linalg.norm(this_pose_pos - previous_pose_pos)
+        # write to a temp file and rename so that a crash never leaves a partial manifest
+        manifest_filename = os.path.join(images_dir_full_path, FusionServer.KEYFRAMES_FILENAME)
+        spartanUtils.saveToYaml(manifest, manifest_filename + ".tmp")
+        os.rename(manifest_filename + ".tmp", manifest_filename)
 
-            rotation_distance = spartanUtils.compute_angle_between_quaternions(this_pose_quat,
-                previous_pose_quat)
+        keyframe_pose_data = spartanUtils.select_pose_data(pose_data, keyframe_rows)
 
+        if materialize_dir is not None:
+            FusionServer.materialize_keyframes(images_dir_full_path, keyframe_pose_data, materialize_dir)
 
-            if i == 0:
-                keep_image = True
-                num_kept_images += 1
-            elif (linear_distance > linear_distance_threshold) or (np.rad2deg(rotation_distance) > rotation_angle_threshold):
-                previous_pose_pos = this_pose_pos
-                previous_pose_quat = this_pose_quat
-                num_kept_images += 1
-            else:
-                # delete pose from forward kinematics
-                del pose_dict[i]
-                continue
+        print "After: ", len(keyframes), " images"
 
-            # if we have gotten here, then move the images over to the new directory
+        return keyframe_pose_data
 
-            rgb_filename = os.path.join(images_dir_full_path, single_frame_data['rgb_image_filename'])
-            rgb_filename_temp = os.path.join(images_dir_temp_path, single_frame_data['rgb_image_filename'])
+    @staticmethod
+    def materialize_keyframes(images_dir_full_path, keyframe_pose_data, materialize_dir):
+        """
+        Populates materialize_dir with hardlinks to the keyframe images, their
+        pose data, camera_info.yaml and keyframes.yaml. The directory is built under
+        a temporary name and renamed into place once complete, so materialize_dir
+        may be images_dir_full_path itself to drop the other frames in place.
+
+        An existing materialize_dir is renamed aside before the new one is renamed
+        into place, and only deleted after that, so a crash at any point leaves
+        the old or the new directory in place.
+        """
+        filenames = []
+        for key in ['rgb_image_filename', 'depth_image_filename']:
+            filenames.extend(keyframe_pose_data[key])
 
-            shutil.move(rgb_filename, rgb_filename_temp)
+        missing = [f for f in filenames if not os.path.exists(os.path.join(images_dir_full_path, f))]
+        if len(missing) > 0:
+            raise IOError("%d keyframe images are missing from %s, e.g. %s" %(len(missing), images_dir_full_path, missing[0]))
 
-            depth_filename = os.path.join(images_dir_full_path, single_frame_data['depth_image_filename'])
-            depth_filename_temp = os.path.join(images_dir_temp_path, single_frame_data['depth_image_filename'])
-            shutil.move(depth_filename, depth_filename_temp)
-                # # delete pose from posegraph
-                # del posegraph_list[i-num_deleted_images]
-                # num_deleted_images += 1
+        materialize_dir = materialize_dir.rstrip('/')
+        materialize_dir_temp = materialize_dir + '_temp'
+        materialize_dir_old = materialize_dir + '_old'
+        for directory in [materialize_dir_temp, materialize_dir_old]:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+        os.makedirs(materialize_dir_temp)
 
-        
-        # write downsamples pose_data.yaml (forward kinematics)
-        spartanUtils.saveToYaml(pose_dict, os.path.join(images_dir_temp_path,'pose_data.yaml'))
+        for filename in filenames:
+            os.link(os.path.join(images_dir_full_path, filename), os.path.join(materialize_dir_temp, filename))
 
-        # remove old images
-        shutil.move(os.path.join(images_dir_full_path, 'camera_info.yaml'), os.path.join(images_dir_temp_path, 'camera_info.yaml'))
-        shutil.rmtree(images_dir_full_path)
+        for filename in ['camera_info.yaml', FusionServer.KEYFRAMES_FILENAME]:
+            shutil.copy(os.path.join(images_dir_full_path, filename), os.path.join(materialize_dir_temp, filename))
+        spartanUtils.save_pose_data(keyframe_pose_data, materialize_dir_temp)
 
-        print "renaming %s to %s " %(images_dir_temp_path, images_dir_full_path)
+        if os.path.isdir(materialize_dir):
+            os.rename(materialize_dir, materialize_dir_old)
 
-        # rename temp images to images
-        os.rename(images_dir_temp_path, images_dir_full_path)
+        print "renaming %s to %s " %(materialize_dir_temp, materialize_dir)
+        os.rename(materialize_dir_temp, materialize_dir)
+
+        if os.path.isdir(materialize_dir_old):
+            shutil.rmtree(materialize_dir_old)
+
+    @staticmethod
+    def load_keyframe_pose_data(images_dir_full_path):
+        """
+        Returns the pose data columns of the frames selected by downsample_by_pose_difference_threshold
+        """
+        pose_data = spartanUtils.load_pose_data(images_dir_full_path)
+        manifest = spartanUtils.getDictFromYamlFilename(os.path.join(images_dir_full_path, FusionServer.KEYFRAMES_FILENAME))
 
-        print "After: ", num_kept_images, " images"
+        keyframe_rows = np.flatnonzero(np.in1d(pose_data['index'], manifest['keyframes']))
+        return spartanUtils.select_pose_data(pose_data, keyframe_rows)
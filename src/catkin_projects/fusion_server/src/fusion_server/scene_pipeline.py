@@ -0,0 +1,333 @@
+#!/usr/bin/python
+import os
+import time
+import hashlib
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.pool
+
+import spartan.utils.utils as spartan_utils
+
+
+def compute_file_hash(filename, chunk_size=2**20):
+    """
+    sha1 of the contents of a file
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+class SceneDirectories(object):
+    """
+    Standard locations of the files for a single scene (log)
+    """
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.log_name = os.path.split(os.path.normpath(log_dir))[-1]
+        self.bag_filepath = os.path.join(log_dir, 'raw', 'fusion_' + self.log_name + '.bag')
+        self.processed_dir = os.path.join(log_dir, 'processed')
+        self.images_dir = os.path.join(self.processed_dir, 'images')
+        self.records_filename = os.path.join(self.processed_dir, 'pipeline_records.yaml')
+
+
+class PipelineStage(object):
+    """
+    A single step of the per-scene pipeline.
+
+    :param name: unique name of the stage
+    :param run: function taking a SceneDirectories object
+    :param get_inputs: function taking a SceneDirectories object and returning the list of
+    files the stage reads. The stage is re-run whenever the content of one of these changes
+    :param get_outputs: function taking a SceneDirectories object and returning the list of
+    files the stage writes. The stage is re-run if one of these is missing
+    :param dependencies: names of the stages that must complete before this one
+    :param use_process: run the stage in a worker process instead of the scene's
+    thread, for CPU bound python stages that would otherwise contend for the GIL.
+    run must then be a module level function. Worker processes are daemonic, so
+    the stage can't start processes of its own
+    """
+
+    def __init__(self, name, run, get_inputs, get_outputs, dependencies=None, use_process=False):
+        self.name = name
+        self.run = run
+        self.get_inputs = get_inputs
+        self.get_outputs = get_outputs
+        self.dependencies = dependencies or []
+        self.use_process = use_process
+
+
+class StageStatus:
+    RAN = 'ran'
+    UP_TO_DATE = 'up_to_date'
+    FAILED = 'failed'
+    BLOCKED = 'blocked'
+
+
+class ScenePipeline(object):
+    """
+    Runs a DAG of PipelineStages over many scenes.
+
+    Scenes are processed in parallel by num_workers threads, each walking the
+    stages of its scene in dependency order. concurrency_limits caps how many
+    scenes can be inside a given stage at once, e.g. {'fuse': 1} so only one
+    scene uses the GPU at a time. Stages with use_process set are handed off to
+    a pool of worker processes, the others run on the scene's thread.
+
+    Completed stages are recorded in processed/pipeline_records.yaml with the
+    content hash of their inputs, a stage is skipped on later runs unless its
+    inputs changed or its outputs are missing.
+    """
+
+    def __init__(self, stages, num_workers=4, concurrency_limits=None):
+        self.stages = ScenePipeline.sort_stages(stages)
+        self.num_workers = num_workers
+
+        concurrency_limits = concurrency_limits or dict()
+        self._semaphores = dict()
+        self._num_processes = 0
+        for stage in self.stages:
+            limit = concurrency_limits.get(stage.name, num_workers)
+            self._semaphores[stage.name] = threading.BoundedSemaphore(limit)
+            if stage.use_process:
+                self._num_processes = max(self._num_processes, min(limit, num_workers))
+
+        self._process_pool = None
+
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @staticmethod
+    def sort_stages(stages):
+        """
+        Topologically sorts the stages by their dependencies
+        """
+        stage_dict = dict()
+        for stage in stages:
+            stage_dict[stage.name] = stage
+
+        sorted_stages = []
+        visited = set()
+        visiting = set()
+
+        def visit(stage):
+            if stage.name in visited:
+                return
+            if stage.name in visiting:
+                raise ValueError("pipeline stages have a dependency cycle involving %s" %(stage.name))
+
+            visiting.add(stage.name)
+            for name in stage.dependencies:
+                if name not in stage_dict:
+                    raise ValueError("stage %s depends on unknown stage %s" %(stage.name, name))
+                visit(stage_dict[name])
+            visiting.remove(stage.name)
+
+            visited.add(stage.name)
+            sorted_stages.append(stage)
+
+        for stage in stages:
+            visit(stage)
+
+        return sorted_stages
+
+    def reset_stats(self):
+        self.stats = dict()
+        for stage in self.stages:
+            self.stats[stage.name] = {StageStatus.RAN: 0, StageStatus.UP_TO_DATE: 0,
+                                      StageStatus.FAILED: 0, StageStatus.BLOCKED: 0,
+                                      'elapsed': 0.0}
+
+    @staticmethod
+    def load_records(scene):
+        if not os.path.exists(scene.records_filename):
+            return dict()
+
+        records = spartan_utils.getDictFromYamlFilename(scene.records_filename)
+        if records is None:
+            return dict()
+
+        return records
+
+    @staticmethod
+    def save_records(scene, records):
+        if not os.path.isdir(scene.processed_dir):
+            os.makedirs(scene.processed_dir)
+
+        spartan_utils.saveToYaml(records, scene.records_filename)
+
+    @staticmethod
+    def compute_input_hashes(filenames, previous_hashes=None):
+        """
+        Content hashes of the input files. If the size and mtime of a file match
+        the entry in previous_hashes the stored hash is reused instead of
+        reading the file again.
+
+        :return: dict filename -> dict with keys sha1, size, mtime. None if an input is missing
+        """
+        previous_hashes = previous_hashes or dict()
+        hashes = dict()
+        for filename in filenames:
+            if not os.path.exists(filename):
+                return None
+
+            stat = os.stat(filename)
+            previous = previous_hashes.get(filename)
+            if (previous is not None) and (previous['size'] == stat.st_size) and (previous['mtime'] == stat.st_mtime):
+                hashes[filename] = previous
+                continue
+
+            hashes[filename] = {'sha1': compute_file_hash(filename), 'size': stat.st_size,
+                                'mtime': stat.st_mtime}
+
+        return hashes
+
+    @staticmethod
+    def is_up_to_date(stage, scene, record, input_hashes):
+        if record is None:
+            return False
+
+        for filename in stage.get_outputs(scene):
+            if not os.path.exists(filename):
+                return False
+
+        recorded_hashes = record.get('inputs', dict())
+        if set(recorded_hashes.keys()) != set(input_hashes.keys()):
+            return False
+
+        for filename, h in input_hashes.iteritems():
+            if recorded_hashes[filename]['sha1'] != h['sha1']:
+                return False
+
+        return True
+
+    def _update_stats(self, stage_name, status, elapsed=0.0):
+        with self._stats_lock:
+            self.stats[stage_name][status] += 1
+            self.stats[stage_name]['elapsed'] += elapsed
+
+    def run_scene(self, log_dir):
+        """
+        Runs all the stages for a single scene
+
+        :return: dict stage name -> StageStatus
+        """
+        scene = SceneDirectories(log_dir)
+        records = ScenePipeline.load_records(scene)
+        status = dict()
+
+        for stage in self.stages:
+            if any(status[name] in (StageStatus.FAILED, StageStatus.BLOCKED) for name in stage.dependencies):
+                status[stage.name] = StageStatus.BLOCKED
+                self._update_stats(stage.name, StageStatus.BLOCKED)
+                continue
+
+            record = records.get(stage.name)
+            previous_hashes = None
+            if record is not None:
+                previous_hashes = record.get('inputs')
+
+            input_hashes = ScenePipeline.compute_input_hashes(stage.get_inputs(scene), previous_hashes)
+            if input_hashes is None:
+                print "[%s] %s: missing inputs, skipping" %(scene.log_name, stage.name)
+                status[stage.name] = StageStatus.BLOCKED
+                self._update_stats(stage.name, StageStatus.BLOCKED)
+                continue
+
+            if ScenePipeline.is_up_to_date(stage, scene, record, input_hashes):
+                print "[%s] %s: up to date" %(scene.log_name, stage.name)
+                status[stage.name] = StageStatus.UP_TO_DATE
+                self._update_stats(stage.name, StageStatus.UP_TO_DATE)
+                continue
+
+            with self._semaphores[stage.name]:
+                print "[%s] %s: running" %(scene.log_name, stage.name)
+                start_time = time.time()
+                try:
+                    if stage.use_process and (self._process_pool is not None):
+                        self._process_pool.apply(stage.run, (scene,))
+                    else:
+                        stage.run(scene)
+                except Exception:
+                    traceback.print_exc()
+                    print "[%s] %s: FAILED" %(scene.log_name, stage.name)
+                    status[stage.name] = StageStatus.FAILED
+                    self._update_stats(stage.name, StageStatus.FAILED, time.time() - start_time)
+                    continue
+
+                elapsed = time.time() - start_time
+
+            print "[%s] %s: finished in %.1f seconds" %(scene.log_name, stage.name, elapsed)
+            status[stage.name] = StageStatus.RAN
+            self._update_stats(stage.name, StageStatus.RAN, elapsed)
+
+            records[stage.name] = {'inputs': input_hashes, 'elapsed': elapsed,
+                                   'completed': spartan_utils.get_current_YYYY_MM_DD_hh_mm_ss()}
+            ScenePipeline.save_records(scene, records)
+
+        return status
+
+    def run(self, log_dirs):
+        """
+        Runs the pipeline over all the scenes in log_dirs
+
+        :return: dict log_dir -> (dict stage name -> StageStatus)
+        """
+        self.reset_stats()
+        start_time = time.time()
+
+        if self.num_workers > 1:
+            # the worker processes are forked before any scene thread is started
+            if self._num_processes > 0:
+                self._process_pool = multiprocessing.Pool(self._num_processes)
+
+            pool = multiprocessing.pool.ThreadPool(self.num_workers)
+            try:
+                results = pool.map(self.run_scene, log_dirs)
+            finally:
+                pool.close()
+                pool.join()
+                if self._process_pool is not None:
+                    self._process_pool.close()
+                    self._process_pool.join()
+                    self._process_pool = None
+        else:
+            results = map(self.run_scene, log_dirs)
+
+        self.print_summary(time.time() - start_time, num_scenes=len(log_dirs))
+        return dict(zip(log_dirs, results))
+
+    def print_summary(self, total_elapsed=None, num_scenes=None):
+        """
+        Prints the per stage counts and timings. Throughputs are in scenes per
+        hour of wall clock time of the whole run, so they account for scenes
+        running in parallel, and are 0 if total_elapsed isn't given.
+        """
+        print "\nPIPELINE SUMMARY:"
+        print "%-12s %6s %10s %7s %8s %12s %14s" %("stage", "ran", "up_to_date", "failed", "blocked",
+                                                  "avg time (s)", "scenes / hour")
+        for stage in self.stages:
+            s = self.stats[stage.name]
+            avg_time = 0.0
+            throughput = 0.0
+            if s[StageStatus.RAN] > 0:
+                avg_time = s['elapsed'] / s[StageStatus.RAN]
+            if total_elapsed:
+                throughput = 3600.0 * s[StageStatus.RAN] / total_elapsed
+
+            print "%-12s %6d %10d %7d %8d %12.1f %14.1f" %(stage.name, s[StageStatus.RAN], s[StageStatus.UP_TO_DATE],
+                                                           s[StageStatus.FAILED], s[StageStatus.BLOCKED],
+                                                           avg_time, throughput)
+
+        if total_elapsed is not None:
+            print "total wall clock time: %.1f seconds" %(total_elapsed)
+            if num_scenes is not None and total_elapsed > 0:
+                print "%d scenes, %.1f scenes / hour" %(num_scenes, 3600.0 * num_scenes / total_elapsed)
@@ -4,11 +4,11 @@ import subprocess
 import shutil
 import numpy as np
 import math
-import yaml
 import time
+import multiprocessing.pool
+import cv2
 from skimage import measure
 from plyfile import PlyData, PlyElement
-import array
 
 import spartan.utils.utils as spartan_utils
 
@@ -40,20 +40,12 @@ def format_data_for_tsdf(image_folder):
 
     ### HANDLE POSES
 
-    pose_data_yaml = os.path.join(image_folder, "pose_data.yaml")
-    with open(pose_data_yaml, 'r') as stream:
-        try:
-            pose_data_dict = yaml.load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
+    pose_data = spartan_utils.load_pose_data(image_folder)
+    camera_to_world = spartan_utils.homogenous_transforms_from_poses(pose_data['pose'])
 
-    print pose_data_dict[0]
-
-    for i in pose_data_dict:
-        # print i
-        # print pose_data_dict[i]
-        pose4 = spartan_utils.homogenous_transform_from_dict(pose_data_dict[i]['camera_to_world'])
-        depth_image_filename = pose_data_dict[i]['depth_image_filename']
+    for j in xrange(len(pose_data['index'])):
+        pose4 = camera_to_world[j]
+        depth_image_filename = str(pose_data['depth_image_filename'][j])
         prefix = depth_image_filename.split("depth")[0]
         print prefix
         pose_file_name = prefix+"pose.txt"
@@ -123,102 +115,370 @@ def run_tsdf_fusion_cuda(image_folder, output_dir=None, voxel_grid_origin_x=0.4,
 
 
 
-def convert_tsdf_to_ply(tsdf_bin_filename, tsdf_mesh_filename):
+def tsdf_fusion_cuda_available():
     """
-    Converts the tsdf binary file to a mesh file in ply format
+    Returns True if the tsdf-fusion CUDA executable has been compiled
+    """
+    spartan_source_dir = spartan_utils.getSpartanSourceDir()
+    tsdf_executable = os.path.join(spartan_source_dir, "src", "tsdf-fusion", 'demo')
+    return os.path.isfile(tsdf_executable)
 
-    The indexing in the tsdf is
-    (x,y,z) <--> (x + y * dim_x + z * dim_x * dim_y)
+
+def _integrate_depth_image_into_slab(tsdf, weights, z_start, z_end, depth_im, K, world_to_camera,
+    voxel_x, voxel_y, voxel_z, trunc_margin, max_depth):
     """
+    Integrates a single depth image into the voxels tsdf[:,:,z_start:z_end], following
+    the update rule of the tsdf-fusion CUDA kernel. Slabs don't overlap so this can be
+    run concurrently for different slabs.
+    """
+    R = world_to_camera[0:3, 0:3]
+    t = world_to_camera[0:3, 3]
+
+    x = voxel_x[:, np.newaxis, np.newaxis]
+    y = voxel_y[np.newaxis, :, np.newaxis]
+    z = voxel_z[np.newaxis, np.newaxis, z_start:z_end]
+
+    # voxel centers in camera frame, each (dim_x, dim_y, z_end - z_start)
+    pt_cam_x = R[0, 0] * x + R[0, 1] * y + R[0, 2] * z + t[0]
+    pt_cam_y = R[1, 0] * x + R[1, 1] * y + R[1, 2] * z + t[1]
+    pt_cam_z = R[2, 0] * x + R[2, 1] * y + R[2, 2] * z + t[2]
+
+    in_front = pt_cam_z > 0
+    safe_z = np.where(in_front, pt_cam_z, 1.0)
+
+    # same rounding as roundf for the in-image (positive) pixel coordinates
+    pix_x = np.floor(K[0, 0] * (pt_cam_x / safe_z) + K[0, 2] + 0.5).astype(np.int64)
+    pix_y = np.floor(K[1, 1] * (pt_cam_y / safe_z) + K[1, 2] + 0.5).astype(np.int64)
+
+    height, width = depth_im.shape
+    mask = in_front & (pix_x >= 0) & (pix_x < width) & (pix_y >= 0) & (pix_y < height)
+
+    depth_val = np.zeros(mask.shape, dtype=np.float32)
+    depth_val[mask] = depth_im[pix_y[mask], pix_x[mask]]
+
+    diff = depth_val - pt_cam_z
+    mask &= (depth_val > 0) & (depth_val <= max_depth) & (diff > -trunc_margin)
+
+    if not np.any(mask):
+        return
+
+    dist = np.minimum(1.0, diff[mask] / trunc_margin)
+
+    tsdf_slab = tsdf[:, :, z_start:z_end]
+    weights_slab = weights[:, :, z_start:z_end]
+
+    weight_old = weights_slab[mask]
+    weight_new = weight_old + 1.0
+    tsdf_slab[mask] = (tsdf_slab[mask] * weight_old + dist) / weight_new
+    weights_slab[mask] = weight_new
+
+
+def run_tsdf_fusion_cpu(image_folder, output_dir=None, voxel_grid_origin_x=0.4,
+    voxel_grid_origin_y=-0.3, voxel_grid_origin_z=-0.2, voxel_size=0.0025,
+    voxel_grid_dim_x=240, voxel_grid_dim_y=320, voxel_grid_dim_z=280, fast_tsdf_settings=False,
+    num_threads=4, slab_size=8, max_depth=6.0):
+    """
+    In-process NumPy alternative to run_tsdf_fusion_cuda, for machines without a GPU.
+
+    Reads the pose data, camera_info.yaml and the depth images directly, so
+    format_data_for_tsdf doesn't need to be run first. Writes tsdf.bin and
+    fusion_pointcloud.ply to output_dir in the same format as the CUDA version.
+
+    The volume is split into slabs of slab_size z-layers which are integrated
+    by num_threads threads.
+    """
+    if output_dir is None:
+        output_dir = os.path.dirname(image_folder)
+        print "output_dir: ", output_dir
+
+    if fast_tsdf_settings:
+        voxel_size = 0.005
+        voxel_grid_dim_x = 200
+        voxel_grid_dim_y = 200
+        voxel_grid_dim_z = 150
+
+    # same truncation margin as the CUDA implementation
+    trunc_margin = voxel_size * 5
+
+    camera_info = spartan_utils.getDictFromYamlFilename(os.path.join(image_folder, "camera_info.yaml"))
+    K = np.asarray(camera_info['camera_matrix']['data'], dtype=np.float64).reshape(3, 3)
+
+    pose_data = spartan_utils.load_pose_data(image_folder)
+    camera_to_world_all = spartan_utils.homogenous_transforms_from_poses(pose_data['pose'])
+
+    origin = np.array([voxel_grid_origin_x, voxel_grid_origin_y, voxel_grid_origin_z])
+    dim = np.array([voxel_grid_dim_x, voxel_grid_dim_y, voxel_grid_dim_z])
+
+    voxel_x = (origin[0] + voxel_size * np.arange(dim[0])).astype(np.float32)
+    voxel_y = (origin[1] + voxel_size * np.arange(dim[1])).astype(np.float32)
+    voxel_z = (origin[2] + voxel_size * np.arange(dim[2])).astype(np.float32)
+
+    # Fortran order so that tsdf[x,y,z] has the same memory layout as tsdf.bin
+    tsdf = np.ones(dim, dtype=np.float32, order='F')
+    weights = np.zeros(dim, dtype=np.float32, order='F')
+
+    slabs = [(z, min(z + slab_size, dim[2])) for z in xrange(0, dim[2], slab_size)]
+
+    pool = None
+    if num_threads > 1:
+        pool = multiprocessing.pool.ThreadPool(num_threads)
+
     start_time = time.time()
-    fin = open(tsdf_bin_filename, "rb")
+    num_frames = len(pose_data['index'])
+    for counter in xrange(num_frames):
+        depth_image_filename = os.path.join(image_folder, str(pose_data['depth_image_filename'][counter]))
+        depth_im = cv2.imread(depth_image_filename, cv2.IMREAD_ANYDEPTH).astype(np.float32) / 1000.0
 
-    tsdfHeader = array.array("f")  # f is the typecode for float32
-    tsdfHeader.fromfile(fin, 8)
-    # print tsdfHeader
-    # print type(tsdfHeader)
+        world_to_camera = np.linalg.inv(camera_to_world_all[counter])
 
-    voxelGridDim = tsdfHeader[0:3]
-    voxelGridDim = np.asarray(voxelGridDim, dtype=np.int)
-    voxelGridOrigin = tsdfHeader[3:6]
-    voxelSize = tsdfHeader[6]
-    truncMargin = tsdfHeader[7]
+        def integrate_slab(slab):
+            _integrate_depth_image_into_slab(tsdf, weights, slab[0], slab[1], depth_im, K, world_to_camera,
+                                             voxel_x, voxel_y, voxel_z, trunc_margin, max_depth)
 
-    dim_x = voxelGridDim[0]
-    dim_y = voxelGridDim[1]
-    dim_z = voxelGridDim[2]
+        if pool is None:
+            map(integrate_slab, slabs)
+        else:
+            pool.map(integrate_slab, slabs)
 
+        if counter % 100 == 0:
+            print "fused frame %d of %d" %(counter, num_frames)
 
-    headerSize = 8
-    tsdf_vec = np.fromfile(tsdf_bin_filename, np.float32)
-    tsdf_vec = tsdf_vec[headerSize:]
-    tsdf = np.reshape(tsdf_vec, voxelGridDim, order='F') # reshape using Fortran order
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-    # for loop version of the above reshape operation
-    # for x in xrange(0, dim_x):
-    #     for y in xrange(0, dim_y):
-    #         for z in xrange(0, dim_z):
-    #             idx = x + y * dim_x + z * dim_x * dim_y
-    #             tsdf[x,y,z] = tsdf_vec[idx]
+    elapsed = time.time() - start_time
+    print "cpu tsdf fusion of %d frames took %.2f seconds" %(num_frames, elapsed)
 
+    # write the volume in the same format as the CUDA version
+    tsdf_bin = os.path.join(output_dir, 'tsdf.bin')
+    header = np.array([dim[0], dim[1], dim[2], origin[0], origin[1], origin[2],
+                       voxel_size, trunc_margin], dtype=np.float32)
+    with open(tsdf_bin, 'wb') as f:
+        header.tofile(f)
+        tsdf.ravel(order='F').tofile(f)
 
-    print "tsdf.shape:", tsdf.shape
-    print "voxelGridDim: ", voxelGridDim
-    print "voxeGridOrigin: ", voxelGridOrigin
-    print "tsdf.shape:", tsdf.shape
+    # surface point cloud, same thresholds as the CUDA version
+    surface_idx = np.nonzero((np.abs(tsdf) < 0.2) & (weights > 0))
+    surface_points = origin + voxel_size * np.column_stack(surface_idx)
+    write_ply_binary(os.path.join(output_dir, 'fusion_pointcloud.ply'), surface_points)
 
-    verts, faces, normals, values = measure.marching_cubes_lewiner(tsdf, spacing=[voxelSize]*3, level=0)
 
+def write_ply_binary(filename, verts, faces=None):
+    """
+    Writes a triangle mesh to a binary little endian ply file. The output has the
+    same layout as writing the mesh with plyfile, but avoids its per-element overhead.
 
-    print "type(verts): ", type(verts)
-    print "verts.shape: ", verts.shape
-    print "faces.shape:", faces.shape
+    :param verts: N x 3 array of vertex positions
+    :param faces: M x 3 array of vertex indices, if None only the vertices are written
+    """
+    verts = np.ascontiguousarray(verts, dtype='<f4')
 
-    print "np.max(verts[:,0]): ", np.max(verts[:,0])
-    print "np.min(verts[:,0]): ", np.min(verts[:, 0])
+    header = "ply\n"
+    header += "format binary_little_endian 1.0\n"
+    header += "element vertex %d\n" %(verts.shape[0])
+    header += "property float x\n"
+    header += "property float y\n"
+    header += "property float z\n"
 
+    if faces is not None:
+        faces_data = np.empty((faces.shape[0],), dtype=[('n', 'u1'), ('vertex_indices', '<i4', (3,))])
+        faces_data['n'] = 3
+        faces_data['vertex_indices'] = faces
 
-    print "verts[0,:] = ", verts[0,:]
-    print "faces[0,:] = ", faces[0,:]
+        header += "element face %d\n" %(faces.shape[0])
+        header += "property list uchar int vertex_indices\n"
 
-    # transform from voxel coordinates to camera coordinates
-    # note x and y are flipped in the output of marching_cubes
-    mesh_points = np.zeros_like(verts)
-    # mesh_points = verts
-    mesh_points[:,0] = voxelGridOrigin[0] + verts[:,0]
-    mesh_points[:,1] = voxelGridOrigin[1] + verts[:,1]
-    mesh_points[:,2] = voxelGridOrigin[2] + verts[:,2]
+    header += "end_header\n"
 
-    # permute faces to get visualization
-    # faces = np.flip(faces, 1)
+    with open(filename, 'wb') as f:
+        f.write(header)
+        verts.tofile(f)
+        if faces is not None:
+            faces_data.tofile(f)
 
 
+class TSDFVolume(object):
+    """
+    Read-only view of a tsdf.bin file produced by tsdf-fusion. The voxel grid is
+    memory-mapped rather than read into memory, so cropping to a region of
+    interest before meshing only touches the voxels in that region.
+
+    The file is an 8 float header (dim_x, dim_y, dim_z, origin_x, origin_y,
+    origin_z, voxel_size, trunc_margin) followed by the tsdf values with indexing
+    (x,y,z) <--> (x + y * dim_x + z * dim_x * dim_y), i.e. Fortran order.
+    """
+
+    HEADER_SIZE = 8
+
+    def __init__(self, tsdf_bin_filename):
+        self.filename = tsdf_bin_filename
+
+        header = np.fromfile(tsdf_bin_filename, dtype=np.float32, count=TSDFVolume.HEADER_SIZE)
+        self.dim = header[0:3].astype(np.int64)
+        self.origin = header[3:6].astype(np.float64)
+        self.voxel_size = float(header[6])
+        self.trunc_margin = float(header[7])
+
+        # the Fortran ordered memmap maps tsdf[x,y,z] directly onto the file, no copy is made
+        self.tsdf = np.memmap(tsdf_bin_filename, dtype=np.float32, mode='r',
+                              offset=TSDFVolume.HEADER_SIZE * np.dtype(np.float32).itemsize,
+                              shape=tuple(self.dim), order='F')
+
+    def get_bounding_box_voxel_range(self, bbox_min, bbox_max):
+        """
+        Converts a world frame axis aligned bounding box to a range of voxel indices,
+        clipped to the grid
+
+        :param bbox_min: (x,y,z) lower corner in world frame
+        :param bbox_max: (x,y,z) upper corner in world frame
+        :return: voxel_min, voxel_max such that the box is covered by
+        tsdf[voxel_min[0]:voxel_max[0], ...]
+        """
+        voxel_min = np.floor((np.asarray(bbox_min) - self.origin) / self.voxel_size).astype(np.int64)
+        voxel_max = np.ceil((np.asarray(bbox_max) - self.origin) / self.voxel_size).astype(np.int64) + 1
+
+        voxel_min = np.clip(voxel_min, 0, self.dim)
+        voxel_max = np.clip(voxel_max, 0, self.dim)
+        return voxel_min, voxel_max
+
+    def get_truncation_band_voxel_range(self, padding=1, slab_size=16):
+        """
+        Range of voxel indices containing all the voxels inside the truncation band,
+        i.e. with |tsdf| < 1. Voxels that were never observed keep the initial value of 1.
+
+        The grid is scanned in slabs of slab_size z planes, which are contiguous in
+        the file, accumulating the occupancy along each axis. Only one slab is held
+        in memory at a time.
+
+        :param padding: number of voxels to pad the range by on each side
+        :param slab_size: number of z planes read at a time
+        :return: voxel_min, voxel_max
+        """
+        occupancy = [np.zeros(self.dim[axis], dtype=bool) for axis in xrange(3)]
+        for z_start in xrange(0, self.dim[2], slab_size):
+            z_end = min(z_start + slab_size, self.dim[2])
+            in_band = np.abs(self.tsdf[:, :, z_start:z_end]) < 1.0
+
+            occupancy[0] |= np.any(in_band, axis=(1, 2))
+            occupancy[1] |= np.any(in_band, axis=(0, 2))
+            occupancy[2][z_start:z_end] = np.any(in_band, axis=(0, 1))
+
+        voxel_min = np.zeros(3, dtype=np.int64)
+        voxel_max = np.zeros(3, dtype=np.int64)
+        for axis in xrange(3):
+            occupied = np.flatnonzero(occupancy[axis])
+            if occupied.size == 0:
+                raise ValueError("tsdf volume %s has no voxels inside the truncation band" %(self.filename))
+
+            voxel_min[axis] = occupied[0] - padding
+            voxel_max[axis] = occupied[-1] + 1 + padding
+
+        voxel_min = np.clip(voxel_min, 0, self.dim)
+        voxel_max = np.clip(voxel_max, 0, self.dim)
+        return voxel_min, voxel_max
+
+    def crop(self, voxel_min, voxel_max):
+        """
+        Returns a view (no copy) of the voxels in [voxel_min, voxel_max)
+        """
+        return self.tsdf[voxel_min[0]:voxel_max[0], voxel_min[1]:voxel_max[1], voxel_min[2]:voxel_max[2]]
+
+    def extract_mesh(self, bbox_min=None, bbox_max=None, crop_to_truncation_band=False):
+        """
+        Runs marching cubes on the volume, optionally cropped to a world frame
+        bounding box and/or to the voxels in the truncation band.
+
+        :return: verts, faces. verts are in world frame
+        """
+        voxel_min = np.zeros(3, dtype=np.int64)
+        voxel_max = np.copy(self.dim)
+
+        if (bbox_min is not None) or (bbox_max is not None):
+            if bbox_min is None:
+                bbox_min = self.origin
+            if bbox_max is None:
+                bbox_max = self.origin + self.dim * self.voxel_size
+            voxel_min, voxel_max = self.get_bounding_box_voxel_range(bbox_min, bbox_max)
+
+        if crop_to_truncation_band:
+            band_min, band_max = self.get_truncation_band_voxel_range()
+            voxel_min = np.maximum(voxel_min, band_min)
+            voxel_max = np.minimum(voxel_max, band_max)
+
+        if np.any(voxel_max - voxel_min < 2):
+            raise ValueError("cropped tsdf volume is too small to mesh, voxel range %s to %s" %(voxel_min, voxel_max))
+
+        tsdf = self.crop(voxel_min, voxel_max)
+        print "meshing tsdf voxels %s to %s, shape %s" %(voxel_min, voxel_max, tsdf.shape)
+
+        verts, faces, normals, values = measure.marching_cubes_lewiner(tsdf, spacing=[self.voxel_size]*3, level=0)
+
+        # transform from voxel coordinates to world coordinates
+        verts = verts + self.origin + voxel_min * self.voxel_size
+        return verts, faces
+
+
+def convert_tsdf_to_ply(tsdf_bin_filename, tsdf_mesh_filename, use_plyfile=True, bbox_min=None,
+    bbox_max=None, crop_to_truncation_band=False):
+    """
+    Converts the tsdf binary file to a mesh file in ply format
+
+    The indexing in the tsdf is
+    (x,y,z) <--> (x + y * dim_x + z * dim_x * dim_y)
+
+    If use_plyfile is False the mesh is written with write_ply_binary instead
+    of plyfile, which is considerably faster for large meshes.
+
+    The volume can be cropped before meshing to the world frame bounding box
+    [bbox_min, bbox_max] and/or to the voxels inside the truncation band, see
+    TSDFVolume.extract_mesh
+    """
+    start_time = time.time()
+
+    tsdf_volume = TSDFVolume(tsdf_bin_filename)
+
+    print "voxelGridDim: ", tsdf_volume.dim
+    print "voxeGridOrigin: ", tsdf_volume.origin
+
+    marching_cubes_start_time = time.time()
+    mesh_points, faces = tsdf_volume.extract_mesh(bbox_min=bbox_min, bbox_max=bbox_max,
+                                                  crop_to_truncation_band=crop_to_truncation_band)
+    marching_cubes_elapsed = time.time() - marching_cubes_start_time
+
+    print "mesh_points.shape: ", mesh_points.shape
+    print "faces.shape:", faces.shape
+
     # try writing to the ply file
     print "converting numpy arrays to format for ply file"
     ply_conversion_start_time = time.time()
 
-    num_verts = verts.shape[0]
+    num_verts = mesh_points.shape[0]
     num_faces = faces.shape[0]
 
-    verts_tuple = np.zeros((num_verts,), dtype=[('x', 'f4'), ('y', 'f4'),
-                                                ('z', 'f4')])
-    faces_tuple = np.zeros((num_faces,), dtype=[('vertex_indices', 'i4', (3,))])
-
-    for i in xrange(0, num_verts):
-        verts_tuple[i] = tuple(mesh_points[i, :])
+    print "saving mesh to %s" %(tsdf_mesh_filename)
 
-    for i in xrange(0, num_faces):
-        faces_tuple[i] = faces[i, :].tolist()
+    if use_plyfile:
+        verts_tuple = np.zeros((num_verts,), dtype=[('x', 'f4'), ('y', 'f4'),
+                                                    ('z', 'f4')])
+        faces_tuple = np.zeros((num_faces,), dtype=[('vertex_indices', 'i4', (3,))])
 
+        verts_tuple['x'] = mesh_points[:, 0]
+        verts_tuple['y'] = mesh_points[:, 1]
+        verts_tuple['z'] = mesh_points[:, 2]
+        faces_tuple['vertex_indices'] = faces
 
+        # save it out
+        el_verts = PlyElement.describe(verts_tuple, 'vertex')
+        el_faces = PlyElement.describe(faces_tuple, 'face')
 
-    # save it out
-    # try to save it
-    el_verts = PlyElement.describe(verts_tuple, 'vertex')
-    el_faces = PlyElement.describe(faces_tuple, 'face')
+        ply_data = PlyData([el_verts, el_faces])
+        ply = ply_data.write(tsdf_mesh_filename)
+    else:
+        write_ply_binary(tsdf_mesh_filename, mesh_points, faces)
 
-    ply_data = PlyData([el_verts, el_faces])
-    print "saving mesh to %s" %(tsdf_mesh_filename)
-    ply = ply_data.write(tsdf_mesh_filename)
+    ply_write_elapsed = time.time() - ply_conversion_start_time
 
-    print "converting to ply format and writing to file took", time.time() - start_time
+    print "marching cubes took %.2f seconds" %(marching_cubes_elapsed)
+    print "converting to ply format and writing to file took %.2f seconds" %(ply_write_elapsed)
+    print "convert_tsdf_to_ply took %.2f seconds in total" %(time.time() - start_time)
@@ -1,5 +1,6 @@
 import argparse
 import math
+import multiprocessing
 import numpy as np
 import os
 import re
@@ -7,7 +8,8 @@ import time
 import yaml
 
 # For physical simulation
-#import pybullet as p
+import pybullet as p
+from rlg_simulation.rest_detector import RestDetector, save_settle_stats
 
 # For projection into nonpenetration
 # (pre-processing for simulation)
@@ -37,6 +39,130 @@ class ObjectInstance:
         return {"model": str(self.model), 
                 "q0": [float(x) for x in self.q0], "fixed": self.fixed}
 
+class ArrangementSimulator:
+    '''
+    Simulates arrangements one after the other in the current pybullet
+    client without reloading any URDFs. The ground and a pool of bodies per
+    (model, fixed) are kept loaded, an arrangement picks bodies out of the
+    pools and moves them into place. Pool bodies it doesn't use are parked
+    with collisions disabled.
+
+    The world is reset to the same saved state before every arrangement.
+    If max_instances_per_model covers every arrangement that will be
+    simulated, the pools never grow, and the result of simulating an
+    arrangement doesn't depend on what was simulated before it.
+    '''
+    # parked bodies are spread out far above the scene
+    PARK_POSITION = [0., 0., 100.]
+    PARK_SPACING = 5.
+
+    def __init__(self, timestep=0.01, max_instances_per_model=None):
+        self.timestep = timestep
+        self.body_pools = {}
+        self.saved_state_id = None
+
+        p.resetSimulation()
+        p.setGravity(0,0,-9.81)
+        p.setTimeStep(timestep)
+
+        # Load in a ground
+        self.ground_id = p.loadURDF(os.environ["SPARTAN_SOURCE_DIR"] + "/build/bullet3/data/plane.urdf")
+
+        if max_instances_per_model is not None:
+            for (model, fixed), count in max_instances_per_model.items():
+                self.get_pool(model, fixed, count)
+
+    def get_pool(self, model, fixed, count):
+        pool = self.body_pools.setdefault((model, fixed), [])
+        if len(pool) < count:
+            drake_resource_root = os.environ["DRAKE_RESOURCE_ROOT"]
+            urdf = drake_resource_root + "/" + models[model]
+            while len(pool) < count:
+                pool.append(p.loadURDF(urdf, self.PARK_POSITION, [0, 0, 0, 1], fixed))
+            # the world changed, save it again
+            self.saved_state_id = None
+        return pool
+
+    @staticmethod
+    def set_collisions_enabled(body_id, enabled):
+        # group 1 / mask -1 are pybullet's defaults for dynamic bodies
+        group, mask = (1, -1) if enabled else (0, 0)
+        for link in range(-1, p.getNumJoints(body_id)):
+            p.setCollisionFilterGroupMask(body_id, link, group, mask)
+
+    def place_instances(self, instances):
+        ''' Returns the body id used for each instance. '''
+        counts = {}
+        for instance in instances:
+            key = (instance.model, instance.fixed)
+            counts[key] = counts.get(key, 0) + 1
+        for key, count in counts.items():
+            self.get_pool(key[0], key[1], count)
+
+        if self.saved_state_id is None:
+            self.park_all()
+            self.saved_state_id = p.saveState()
+        p.restoreState(stateId=self.saved_state_id)
+
+        ids = []
+        used = set()
+        next_index = {}
+        for instance in instances:
+            key = (instance.model, instance.fixed)
+            index = next_index.get(key, 0)
+            next_index[key] = index + 1
+            body_id = self.body_pools[key][index]
+
+            q0 = instance.q0
+            position = q0[0:3]
+            quaternion = p.getQuaternionFromEuler(q0[3:8])
+            p.resetBasePositionAndOrientation(body_id, position, quaternion)
+            p.resetBaseVelocity(body_id, [0., 0., 0.], [0., 0., 0.])
+            self.set_collisions_enabled(body_id, True)
+            ids.append(body_id)
+            used.add(body_id)
+
+        for pool in self.body_pools.values():
+            for body_id in pool:
+                if body_id not in used:
+                    self.set_collisions_enabled(body_id, False)
+        return ids
+
+    def park_all(self):
+        k = 0
+        for key in sorted(self.body_pools.keys()):
+            for body_id in self.body_pools[key]:
+                position = [self.PARK_POSITION[0] + k*self.PARK_SPACING, self.PARK_POSITION[1], self.PARK_POSITION[2]]
+                p.resetBasePositionAndOrientation(body_id, position, [0, 0, 0, 1])
+                p.resetBaseVelocity(body_id, [0., 0., 0.], [0., 0., 0.])
+                self.set_collisions_enabled(body_id, False)
+                k += 1
+
+    def simulate(self, instances, n_secs, **rest_kwargs):
+        '''
+        Simulates the instances for up to n_secs, stopping early once the
+        non-fixed bodies are at rest, see RestDetector for rest_kwargs.
+
+        Returns the body id used for each instance and the RestDetector stats,
+        with body_settle_times replaced by one entry per instance (None for
+        the fixed ones).
+        '''
+        ids = self.place_instances(instances)
+        dynamic_ids = [body_id for body_id, instance in zip(ids, instances) if not instance.fixed]
+
+        rest_detector = RestDetector(dynamic_ids, self.timestep, **rest_kwargs)
+        num_steps = int(n_secs / self.timestep)
+        for i in range(num_steps):
+            p.stepSimulation()
+            if rest_detector.step():
+                break
+
+        stats = rest_detector.get_stats()
+        body_settle_times = iter(stats["body_settle_times"])
+        stats["body_settle_times"] = [None if instance.fixed else next(body_settle_times) for instance in instances]
+        return ids, stats
+
+
 def load_rbt_from_urdf_rel_drake_root(model_name, rbt, weld_frame = None):
     urdf_filename = models[model_name]
     drake_root = os.getenv("DRAKE_RESOURCE_ROOT")
@@ -127,38 +253,30 @@ class DishrackArrangement:
             instance.q0 = q0[ind:(ind+num_states)]
             ind += num_states
 
-    def simulate_instance(self, n_secs, timestep=0.01):
-        # Assumes physics client already set up
-        p.resetSimulation()
-        p.setGravity(0,0,-9.81)
-        p.setTimeStep(timestep)
-
-        # Load in a ground
-        p.loadURDF(os.environ["SPARTAN_SOURCE_DIR"] + "/build/bullet3/data/plane.urdf")
+    def simulate_instance(self, n_secs, timestep=0.01, simulator=None, **rest_kwargs):
+        '''
+        Simulates the arrangement for up to n_secs, or until it comes to rest,
+        and updates the instance poses. Returns the settle stats, see
+        ArrangementSimulator.simulate.
 
-        # Add each model as requested
-        drake_resource_root = os.environ["DRAKE_RESOURCE_ROOT"]
-        ids = []
-        for instance in self.instances:
-            urdf = drake_resource_root + "/" + models[instance.model]
-            q0 = instance.q0
-            position = q0[0:3]
-            quaternion = p.getQuaternionFromEuler(q0[3:8])
-            fixed = instance.fixed
-            ids.append(p.loadURDF(urdf, position, quaternion, fixed))
+        Assumes physics client already set up. Pass an ArrangementSimulator to
+        reuse its loaded bodies, otherwise the world is reset and reloaded.
+        '''
+        if simulator is None:
+            simulator = ArrangementSimulator(timestep)
 
-        # Simulate it
-        for i in range(int(n_secs / timestep)):
-            p.stepSimulation()
+        ids, settle_stats = simulator.simulate(self.instances, n_secs, **rest_kwargs)
 
         # Extract model states
-        for i, instance in enumerate(self.instances):
-            pos, quat = p.getBasePositionAndOrientation(i+1)
+        for body_id, instance in zip(ids, self.instances):
+            pos, quat = p.getBasePositionAndOrientation(body_id)
             instance.q0[0:3] = pos
             instance.q0[3:7] = p.getEulerFromQuaternion(quat)
 
+        return settle_stats
+
 
-    def save_to_file(self, filename):
+    def save_to_file(self, filename, settle_stats=None):
         data = {}
         data["models"] = models
         data["with_ground"] = True
@@ -168,6 +286,9 @@ class DishrackArrangement:
         with open(filename, 'w') as outfile:
             yaml.dump(data, outfile, default_flow_style=False)
 
+        if settle_stats is not None:
+            save_settle_stats(filename, settle_stats)
+
     @staticmethod
     def load_from_file(filename):
         arrangement = DishrackArrangement()
@@ -187,10 +308,10 @@ plate_11in_params = {
     "upper_bound_y": -0.017,
     "height": 0.3
 }
-def place_plate_11in():
-    center_location_x = np.random.uniform(plate_11in_params["lower_bound_x"], plate_11in_params["upper_bound_x"])
-    center_location_y = np.random.uniform(plate_11in_params["lower_bound_y"], plate_11in_params["upper_bound_y"])
-    yaw = float(np.random.randint(0, 4))*math.pi/2.
+def place_plate_11in(rng=np.random):
+    center_location_x = rng.uniform(plate_11in_params["lower_bound_x"], plate_11in_params["upper_bound_x"])
+    center_location_y = rng.uniform(plate_11in_params["lower_bound_y"], plate_11in_params["upper_bound_y"])
+    yaw = float(rng.randint(0, 4))*math.pi/2.
     return [center_location_x, center_location_y, plate_11in_params["height"],
             0, 0, yaw]
 
@@ -199,19 +320,19 @@ placement_generators = {
     "plate_11in": place_plate_11in
 }
 # Hand-written data generation script
-def generate_dishrack_arrangement(max_num_dishes, allowable_dish_types):
+def generate_dishrack_arrangement(max_num_dishes, allowable_dish_types, rng=np.random):
     arrangement = DishrackArrangement()
 
-    num_dishes = np.random.randint(0, max_num_dishes)
+    num_dishes = rng.randint(0, max_num_dishes)
 
     for k in range(num_dishes):
         # Pick dish type
-        dish_type = allowable_dish_types[np.random.randint(0, len(allowable_dish_types))]
+        dish_type = allowable_dish_types[rng.randint(0, len(allowable_dish_types))]
         if dish_type not in placement_generators.keys():
             print("Error: generator not defined for dish type %s" % (dish_type))
             exit(-1)
         # Generate a placement and add it to the arrangement
-        arrangement.add_instance(ObjectInstance(dish_type, placement_generators[dish_type](), False))
+        arrangement.add_instance(ObjectInstance(dish_type, placement_generators[dish_type](rng), False))
 
     return arrangement
 
@@ -230,29 +351,93 @@ def load_arrangements_from_folder(folder_name, filename_regex=".*\.yaml"):
     print "Loaded %d arrangements." % len(all_arrangements)
     return all_arrangements
 
+# Per worker process state, see init_generation_worker
+_worker_simulator = None
+
+def init_generation_worker(timestep, max_instances_per_model, use_gui=False):
+    global _worker_simulator
+    p.connect(p.GUI if use_gui else p.DIRECT)
+    _worker_simulator = ArrangementSimulator(timestep, max_instances_per_model)
+
+def generate_and_simulate_sample(sample_args):
+    '''
+    Generates, simulates and saves sample i. Its arrangement only depends on
+    (seed, i), not on which worker runs it or in which order.
+    '''
+    folder, i, seed, max_num_dishes, allowable_dish_types, n_secs = sample_args
+    start_time = time.time()
+
+    rng = np.random.RandomState([seed, i])
+    arrangement = generate_dishrack_arrangement(max_num_dishes, allowable_dish_types, rng)
+    arrangement.save_to_file(folder + "/" + "%03d_1_pre_projection.yaml" % i)
+    #arrangement.project_instance_to_nonpenetration()
+    #arrangement.save_to_file(folder + "/" + "%03d_2_post_projection.yaml" % i)
+    settle_stats = arrangement.simulate_instance(n_secs, simulator=_worker_simulator)
+    arrangement.save_to_file(folder + "/" + "%03d_3_post_simulation.yaml" % i, settle_stats=settle_stats)
+
+    return i, settle_stats, time.time() - start_time
+
+def generate_arrangements(folder, num_samples, max_num_dishes, allowable_dish_types, seed,
+                          n_secs=2., timestep=0.01, num_workers=1, use_gui=False):
+    '''
+    Generates num_samples arrangements into folder, with num_workers
+    processes that each simulate in their own pybullet client.
+    '''
+    # Load enough bodies up front that the worlds never change, see ArrangementSimulator
+    max_instances_per_model = {("dish_rack", True): 1}
+    for dish_type in allowable_dish_types:
+        max_instances_per_model[(dish_type, False)] = max_num_dishes
+
+    sample_args = [(folder, i, seed, max_num_dishes, allowable_dish_types, n_secs)
+                   for i in range(num_samples)]
+    init_args = (timestep, max_instances_per_model, use_gui)
+
+    start_time = time.time()
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=init_generation_worker, initargs=init_args)
+        results = pool.imap_unordered(generate_and_simulate_sample, sample_args)
+    else:
+        init_generation_worker(*init_args)
+        results = (generate_and_simulate_sample(x) for x in sample_args)
+
+    settle_times = []
+    for k, (i, settle_stats, sample_time) in enumerate(results):
+        if settle_stats["settled"]:
+            settle_string = "settled in %.2f s" % settle_stats["settle_time"]
+            settle_times.append(settle_stats["settle_time"])
+        else:
+            settle_string = "didn't settle in %.2f s" % n_secs
+        print "[%d/%d] sample %03d %s (%.2f s wall)" % (k+1, num_samples, i, settle_string, sample_time)
+
+    if num_workers > 1:
+        pool.close()
+        pool.join()
+
+    print "Generated %d arrangements in %.2f s" % (num_samples, time.time() - start_time)
+    print "%d of %d settled within %.2f s" % (len(settle_times), num_samples, n_secs)
+    if len(settle_times) > 0:
+        print "Settle time (p50, p90, max): (%.2f, %.2f, %.2f) s" % (np.percentile(settle_times, 50),
+            np.percentile(settle_times, 90), np.max(settle_times))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("folder", help="Folder to put generated files in.", type=str)
     parser.add_argument("-n", "--max_num_dishes", help="Max # of dishes to generate", type=int, default=20)
     parser.add_argument("-m", "--num_samples", help="# of arrangements to generate", type=int, default=1)
+    parser.add_argument("-j", "--num_workers", help="# of simulation processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("-t", "--max_sim_time", help="Max sim time to let each arrangement settle", type=float, default=2.)
+    parser.add_argument("--gui", help="Show the simulation (uses a single worker)", action="store_true")
 
     parser.add_argument("-s", "--seed", help="Random seed", type=int)
     args = parser.parse_args()
 
-    # Set up a simulation with a ground plane and desired timestep
-    physicsClient = p.connect(p.GUI)#or p.DIRECT for non-graphical version
+    seed = args.seed
+    if seed is None:
+        seed = np.random.randint(0, 2**31 - 1)
+        print "Using seed %d" % seed
 
-    if args.seed is not None:
-        np.random.seed(args.seed)
+    num_workers = 1 if args.gui else max(1, min(args.num_workers, args.num_samples))
 
     os.system("mkdir -p " + args.folder)
-    for i in range(args.num_samples):
-        arrangement = generate_dishrack_arrangement(args.max_num_dishes, ["plate_11in",])
-        arrangement.save_to_file(args.folder + "/" + "%03d_1_pre_projection.yaml" % i)
-        #arrangement.project_instance_to_nonpenetration()
-        #arrangement.save_to_file(args.folder + "/" + "%03d_2_post_projection.yaml" % i)
-        arrangement.simulate_instance(2.)
-        arrangement.save_to_file(args.folder + "/" + "%03d_3_post_simulation.yaml" % i)
-
-
-
+    generate_arrangements(args.folder, args.num_samples, args.max_num_dishes, ["plate_11in",], seed,
+                          n_secs=args.max_sim_time, num_workers=num_workers, use_gui=args.gui)
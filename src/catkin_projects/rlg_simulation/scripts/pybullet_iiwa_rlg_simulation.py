@@ -21,9 +21,11 @@
 # Arguments:
 #   config: Configuration file
 #   rate: Desired real-time rate (will not run faster, might run slower)
+#   lockstep: Run headless as fast as possible, see IiwaRlgSimulator.
 # Press q to quit and r to restart the simulation.
 
 import argparse
+from collections import namedtuple
 from copy import deepcopy
 import math
 import numpy as np
@@ -31,6 +33,8 @@ import os
 import re
 import rospy
 import pybullet
+import Queue
+import random
 import threading
 import time
 import yaml
@@ -43,11 +47,13 @@ from drake import lcmt_iiwa_command, lcmt_iiwa_status ,lcmt_robot_state
 import spartan.utils.utils as spartanUtils
 import spartan.utils.ros_utils as rosUtils
 import spartan.utils.cv_utils as cvUtils
+import spartan.perception.depth_sensor_model as depthSensorModel
 import wsg_50_common.msg
 
 # Comms from camera
 import std_msgs.msg
 import sensor_msgs.msg
+import rosgraph_msgs.msg
 import cv2
 from cv_bridge import CvBridge, CvBridgeError
 
@@ -223,6 +229,7 @@ class RgbdCameraMetaInfo():
         topics['DEPTH_TOPIC'] = "/camera_%s/depth/image_raw" % camera_serial_number
         topics['RGB_INFO_TOPIC'] = "/camera_%s/rgb/camera_info" % camera_serial_number
         topics['DEPTH_INFO_TOPIC'] = "/camera_%s/depth/camera_info" % camera_serial_number
+        topics['SEGMENTATION_TOPIC'] = "/camera_%s/segmentation/image_raw" % camera_serial_number
         return topics
 
     @staticmethod
@@ -235,6 +242,132 @@ class RgbdCameraMetaInfo():
 
     
 
+# One camera tick worth of rendered images, see IiwaRlgSimulator.DoRgbdRendering
+RgbdFrame = namedtuple('RgbdFrame', ['stamp', 'rgb_image', 'rgb_frame', 'rgb_info_msg',
+                                     'depth_image', 'depth_frame', 'depth_info_msg', 'segmentation_image'])
+
+class RgbdImagePublisher():
+    '''
+    Corrupts, converts and publishes rendered RGBD frames on a background
+    thread, so that the sim loop only pays for the render itself.
+
+    Holds at most max_pending frames. If the thread falls behind, the oldest
+    pending frame is dropped (and counted in num_dropped) rather than
+    blocking the sim, unless drop_frames is False.
+    '''
+
+    def __init__(self, topics, depth_sensor_model_kwargs, max_pending=1, drop_frames=True):
+        self.drop_frames = drop_frames
+        self.depth_sensor_model_kwargs = depth_sensor_model_kwargs
+        # built on the first frame, once the camera intrinsics are known
+        self.depth_sensor_model = None
+        self.cv_bridge = CvBridge()
+
+        self.rgb_publisher = rospy.Publisher(topics['RGB_TOPIC'], sensor_msgs.msg.Image, queue_size=1)
+        self.depth_publisher = rospy.Publisher(topics['DEPTH_TOPIC'], sensor_msgs.msg.Image, queue_size=1)
+        self.rgb_info_publisher = rospy.Publisher(topics['RGB_INFO_TOPIC'], sensor_msgs.msg.CameraInfo, queue_size=1)
+        self.depth_info_publisher = rospy.Publisher(topics['DEPTH_INFO_TOPIC'], sensor_msgs.msg.CameraInfo, queue_size=1)
+        self.segmentation_publisher = rospy.Publisher(topics['SEGMENTATION_TOPIC'], sensor_msgs.msg.Image, queue_size=1)
+
+        self.queue = Queue.Queue(maxsize=max_pending)
+        self.num_published = 0
+        self.num_dropped = 0
+
+        self.thread = threading.Thread(target=self.Run, name="RgbdImagePublisher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Submit(self, frame):
+        if not self.drop_frames:
+            self.queue.put(frame)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(frame)
+                return
+            except Queue.Full:
+                pass
+
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.num_dropped += 1
+            except Queue.Empty:
+                pass
+
+    def Flush(self):
+        ''' Blocks until every submitted frame has been published. '''
+        self.queue.join()
+
+    def Close(self):
+        ''' Publishes whatever is still pending and stops the thread. '''
+        self.queue.put(None)
+        self.thread.join()
+
+    def Run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                self.queue.task_done()
+                return
+
+            try:
+                self.Publish(frame)
+                self.num_published += 1
+            except Exception as e:
+                print "Exception ", e, " while publishing rgbd images"
+            finally:
+                self.queue.task_done()
+
+    def Publish(self, frame):
+        # Shadowing, normal limiting and noise
+        height, width = frame.depth_image.shape
+        self.depth_sensor_model = depthSensorModel.getDepthSensorModel(
+            self.depth_sensor_model, frame.depth_info_msg.K, width, height, **self.depth_sensor_model_kwargs)
+        depthImage = self.depth_sensor_model.corrupt(frame.depth_image)
+
+        #im = cvUtils.generateGridOfImages(
+        #    [
+        #        cvUtils.generateColorMap(frame.depth_image),
+        #        cvUtils.generateColorMap(self.depth_sensor_model.normal_dx, -0.1, .1),
+        #        cvUtils.generateColorMap(self.depth_sensor_model.shadow_mask.astype(np.float32)),
+        #        cvUtils.generateColorMap(depthImage)
+        #    ], 3, 10)
+        #cv2.imshow("depthcorruption", im)
+        #cv2.waitKey(1)
+
+        # Convert and publish!
+        depthMsg = self.cv_bridge.cv2_to_imgmsg((depthImage*1000).astype('uint16'), "passthrough")
+        depthMsg.header = self.MakeHeader(frame.stamp, frame.depth_frame)
+        self.depth_publisher.publish(depthMsg)
+        self.PublishCameraInfo(self.depth_info_publisher, frame.depth_info_msg, depthMsg.header)
+
+        rgbMsg = self.cv_bridge.cv2_to_imgmsg(cv2.cvtColor(frame.rgb_image, cv2.COLOR_BGRA2BGR), "rgb8")
+        rgbMsg.header = self.MakeHeader(frame.stamp, frame.rgb_frame)
+        self.rgb_publisher.publish(rgbMsg)
+        self.PublishCameraInfo(self.rgb_info_publisher, frame.rgb_info_msg, rgbMsg.header)
+
+        if frame.segmentation_image is not None:
+            segmentationMsg = self.cv_bridge.cv2_to_imgmsg(frame.segmentation_image.astype(np.int32), "32SC1")
+            segmentationMsg.header = self.MakeHeader(frame.stamp, frame.depth_frame)
+            self.segmentation_publisher.publish(segmentationMsg)
+
+    @staticmethod
+    def MakeHeader(stamp, frame_id):
+        header = std_msgs.msg.Header()
+        header.stamp = stamp
+        header.frame_id = frame_id
+        return header
+
+    @staticmethod
+    def PublishCameraInfo(publisher, info_msg, header):
+        # the info msgs are shared with the sim thread, publish a copy
+        info_msg = deepcopy(info_msg)
+        info_msg.header = header
+        publisher.publish(info_msg)
+
+
 class IiwaRlgSimulator():
     ''' 
     This class implements a simulation of the Kuka IIWA + Schunk WSG 50
@@ -249,19 +382,42 @@ class IiwaRlgSimulator():
     ResetSimulation() sets up the simulation.
 
     RunSim run a sim until (R)eset or (Q)uit from the sim gui.
+
+    In lockstep mode the sim doesn't follow the wall clock, it steps as fast
+    as it can and everything it publishes is stamped with the sim time
+    (also published on /clock). Commands only take effect on the status
+    ticks: after publishing IIWA_STATUS the sim waits (up to lockstep_timeout
+    s of wall time) for the IIWA_COMMAND answering it, i.e. with the same
+    utime, and then latches that and the latest Schunk command. Until the
+    first command arrives the sim doesn't wait, so it can run without a
+    controller. Rendered images are never dropped, the sim waits for the
+    image publisher instead. With a seed, the noise and physics are
+    reproducible from run to run.
     '''
 
-    def __init__(self, config, timestep, rate, rgbd_noise=0.005, rgbd_normal_limit=0.05, rgbd_projector_baseline=0.1, camera_serial_number="carmine_1"):
+    def __init__(self, config, timestep, rate, rgbd_noise=0.005, rgbd_normal_limit=0.05, rgbd_projector_baseline=0.1, rgbd_fidelity='high', rgbd_shared_render=False, rgbd_segmentation=False, camera_serial_number="carmine_1", lockstep=False, lockstep_timeout=1.0, seed=None, duration=None):
         self.config = config
         self.timestep = timestep
         self.rate = rate
         self.camera_serial_number = camera_serial_number
+        self.lockstep = lockstep
+        self.lockstep_timeout = lockstep_timeout
+        self.seed = seed
+        # sim seconds after which RunSim stops, None to run until quit
+        self.duration = duration
+        self.sim_time = 0.0
+        self.num_lockstep_timeouts = 0
+
+        if self.seed is not None:
+            random.seed(self.seed)
+            np.random.seed(self.seed)
 
         self.packageMap = PackageMap()
         self.packageMap.populateFromEnvironment(["ROS_PACKAGE_PATH"])
 
         self.iiwa_command_lock = threading.Lock()
         self.last_iiwa_position_command = [0.] * len(IIWA_CONTROLLED_JOINTS)
+        self.last_iiwa_command_utime = None
 
         self.schunk_command_lock = threading.Lock()
         self.last_schunk_position_command = [0.] * len(SCHUNK_CONTROLLED_JOINTS)
@@ -280,17 +436,18 @@ class IiwaRlgSimulator():
             "/wsg50_driver/wsg50/status",
             wsg_50_common.msg.Status, queue_size=1)
 
-        # Set up image publishing
+        # Set up image rendering and publishing
+        self.rgbd_shared_render = rgbd_shared_render
+        self.rgbd_segmentation = rgbd_segmentation
+        self.projection_matrix_cache = {}
         camera_topics = RgbdCameraMetaInfo.getCameraPublishTopics(self.camera_serial_number)
-        self.rgb_publisher = rospy.Publisher(camera_topics['RGB_TOPIC'], sensor_msgs.msg.Image, queue_size=1)
-        self.depth_publisher = rospy.Publisher(camera_topics['DEPTH_TOPIC'], sensor_msgs.msg.Image, queue_size=1)
-        self.rgb_info_publisher = rospy.Publisher(camera_topics['RGB_INFO_TOPIC'], sensor_msgs.msg.CameraInfo, queue_size=1)
-        self.depth_info_publisher = rospy.Publisher(camera_topics['DEPTH_INFO_TOPIC'], sensor_msgs.msg.CameraInfo, queue_size=1)
-        self.cv_bridge = CvBridge()
+        self.image_publisher = RgbdImagePublisher(camera_topics, dict(
+            noise=rgbd_noise, normal_limit=rgbd_normal_limit,
+            projector_baseline=rgbd_projector_baseline, fidelity=rgbd_fidelity, seed=seed),
+            max_pending=4 if self.lockstep else 1, drop_frames=not self.lockstep)
 
-        self.rgbd_projector_baseline = rgbd_projector_baseline
-        self.rgbd_normal_limit = rgbd_normal_limit
-        self.rgbd_noise = rgbd_noise
+        if self.lockstep:
+            self.clock_publisher = rospy.Publisher("/clock", rosgraph_msgs.msg.Clock, queue_size=1)
 
         # Set up a Remote Tree Viewer wrapper to publish
         # object states
@@ -301,6 +458,11 @@ class IiwaRlgSimulator():
 
         pybullet.setGravity(0,0,-9.81)
         pybullet.setTimeStep(self.timestep)
+        if self.seed is not None:
+            try:
+                pybullet.setPhysicsEngineParameter(deterministicOverlappingPairs=1)
+            except TypeError:
+                print "This pybullet doesn't support deterministicOverlappingPairs, contact ordering may vary between runs"
 
         # Read in configuration file
         config = yaml.load(open(self.config))
@@ -376,6 +538,7 @@ class IiwaRlgSimulator():
             msg = lcmt_iiwa_command.decode(data)
             for i in range(msg.num_joints):
                 self.last_iiwa_position_command[i] = msg.joint_position[i]
+            self.last_iiwa_command_utime = msg.utime
         except Exception as e:
             print "Exception ", e, " in lcm iiwa command handler"
         self.iiwa_command_lock.release()
@@ -386,9 +549,41 @@ class IiwaRlgSimulator():
         self.iiwa_command_lock.release()
         return command
 
+    def GetUtime(self):
+        if self.lockstep:
+            return int(round(self.sim_time * 1E6))
+        return int(time.time() * 1E6)
+
+    def GetRosStamp(self):
+        if self.lockstep:
+            return rospy.Time.from_sec(self.sim_time)
+        return rospy.Time.now()
+
+    def PublishClock(self):
+        msg = rosgraph_msgs.msg.Clock()
+        msg.clock = self.GetRosStamp()
+        self.clock_publisher.publish(msg)
+
+    def WaitForIiwaCommand(self, utime):
+        ''' Handles LCM until the IIWA command for the status with this utime
+            arrives. Returns False if it timed out. '''
+        if self.last_iiwa_command_utime is None:
+            # No controller yet, don't hold up the sim
+            self.lc.handle_timeout(0)
+            return True
+
+        deadline = time.time() + self.lockstep_timeout
+        while self.last_iiwa_command_utime < utime:
+            remaining = deadline - time.time()
+            if remaining <= 0.:
+                self.num_lockstep_timeouts += 1
+                return False
+            self.lc.handle_timeout(max(int(remaining * 1000), 1))
+        return True
+
     def PublishIiwaStatus(self):
         status_msg = lcmt_iiwa_status()
-        status_msg.utime = time.time() * 1E6
+        status_msg.utime = self.GetUtime()
         status_msg.num_joints = len(IIWA_CONTROLLED_JOINTS)
         # Get joint state info
         states = pybullet.getJointStates(self.kuka_id, self.iiwa_motor_id_list)
@@ -407,6 +602,7 @@ class IiwaRlgSimulator():
         self.iiwa_command_lock.release()
 
         self.lc.publish("IIWA_STATUS", status_msg.encode())
+        return status_msg.utime
 
 
     def HandleSchunkCommand(self, msg):
@@ -437,18 +633,18 @@ class IiwaRlgSimulator():
         msg.current_force = (-states[0][3] + states[1][3])/2.
         self.schunk_status_publisher.publish(msg)
 
-    def DoDepthRendering(self):
+    def ComputeCameraViewMatrix(self, extrinsics):
         # Get the state of the camera link
         linkState = pybullet.getLinkState(self.kuka_id, 
-            self.rgbd_info.depth_extrinsics["parent_joint_id"],
+            extrinsics["parent_joint_id"],
             computeLinkVelocity=0)
         
         # Compute the camera's eye position
         cameraWorldPosition, cameraWorldOrientation = \
             pybullet.multiplyTransforms(
                 linkState[0], linkState[1],
-                self.rgbd_info.depth_extrinsics["pose_xyz"], 
-                self.rgbd_info.depth_extrinsics["pose_quat"])
+                extrinsics["pose_xyz"], 
+                extrinsics["pose_quat"])
 
         # Use that to form Forward and Up vectors for the camera
         cameraRotationMatrix = np.reshape(np.array(pybullet.getMatrixFromQuaternion(cameraWorldOrientation)), [3, 3])
@@ -456,137 +652,84 @@ class IiwaRlgSimulator():
         cameraUp = cameraRotationMatrix.dot(np.array(CAMERA_UP_VEC))
 
         # Assemble a view matrix
-        viewMatrix = pybullet.computeViewMatrix(cameraWorldPosition, cameraWorldPosition+cameraForward, cameraUp)
-
-        # Compute the FOV and aspect from the camera intrinsics
-        camera_width = self.rgbd_info.depth_info_msg.width
-        camera_height = self.rgbd_info.depth_info_msg.height
-        camera_fov_x = 2 * math.atan2(camera_height, 2 * self.rgbd_info.depth_info_msg.P[0]) * 180. / math.pi
-        camera_fov_y = 2 * math.atan2(camera_width, 2 * self.rgbd_info.depth_info_msg.P[5]) * 180. / math.pi
-        camera_aspect = float(camera_width) / float(camera_height)
-        # Use the computed FOV to produce a projection matrix
-        # (Note: I'm sure you can directly compute a projection Matrix
-        # from the intrinsics, but I'm not sure what the mapping is --
-        # OpenCV makes a lot of assumptions about their projection matrix
-        # details and scaling. It's not exactly a camera intrinsic matrix...
-        # So this is easier.)
-        min_range = self.rgbd_info.depth_min_range
-        max_range = self.rgbd_info.depth_max_range
-        projectionMatrix = pybullet.computeProjectionMatrixFOV(camera_fov_x, camera_aspect,min_range, max_range)
-
-        images = pybullet.getCameraImage(camera_width, camera_height, viewMatrix, projectionMatrix, shadow=0,lightDirection=[1,1,1],renderer=pybullet.ER_BULLET_HARDWARE_OPENGL)
+        return pybullet.computeViewMatrix(cameraWorldPosition, cameraWorldPosition+cameraForward, cameraUp)
+
+    def GetProjectionMatrix(self, info_msg, min_range, max_range):
+        ''' Projection matrix for the given intrinsics and clipping range,
+            cached since the intrinsics don't change between renders. '''
+        key = (info_msg.width, info_msg.height, info_msg.P[0], info_msg.P[5], min_range, max_range)
+        if key not in self.projection_matrix_cache:
+            # Compute the FOV and aspect from the camera intrinsics
+            camera_fov_x = 2 * math.atan2(info_msg.height, 2 * info_msg.P[0]) * 180. / math.pi
+            camera_aspect = float(info_msg.width) / float(info_msg.height)
+            # Use the computed FOV to produce a projection matrix
+            # (Note: I'm sure you can directly compute a projection Matrix
+            # from the intrinsics, but I'm not sure what the mapping is --
+            # OpenCV makes a lot of assumptions about their projection matrix
+            # details and scaling. It's not exactly a camera intrinsic matrix...
+            # So this is easier.)
+            self.projection_matrix_cache[key] = pybullet.computeProjectionMatrixFOV(camera_fov_x, camera_aspect, min_range, max_range)
+        return self.projection_matrix_cache[key]
+
+    def RenderCamera(self, extrinsics, info_msg, min_range, max_range):
+        ''' Renders from the given camera, returns the RGBA image, the metric
+            depth image and the segmentation mask (None unless
+            rgbd_segmentation is set). '''
+        viewMatrix = self.ComputeCameraViewMatrix(extrinsics)
+        projectionMatrix = self.GetProjectionMatrix(info_msg, min_range, max_range)
+
+        flags = 0
+        if not self.rgbd_segmentation:
+            flags = getattr(pybullet, "ER_NO_SEGMENTATION_MASK", 0)
+
+        images = pybullet.getCameraImage(info_msg.width, info_msg.height, viewMatrix, projectionMatrix, shadow=0,lightDirection=[1,1,1],renderer=pybullet.ER_BULLET_HARDWARE_OPENGL, flags=flags)
 
         # Rescale depth buffer from [0, 1] to real depth following
         # formula from https://stackoverflow.com/questions/6652253/getting-the-true-z-value-from-the-depth-buffer
-        gtDepthImage = (max_range * min_range) / (max_range + images[3] * (min_range - max_range))
-
-        # Calculate normals before adding noise
-        if self.rgbd_normal_limit > 0.:
-            gtNormalImage = np.absolute(cv2.Scharr(gtDepthImage, cv2.CV_32F, 1, 0)) +  np.absolute(cv2.Scharr(gtDepthImage, cv2.CV_32F, 0, 1))
-            _, normalThresh = cv2.threshold(gtNormalImage, self.rgbd_normal_limit, 1., cv2.THRESH_BINARY_INV)
-
-        if self.rgbd_noise > 0.0:
-            noiseMat = np.random.randn(camera_height, camera_width)*self.rgbd_noise
-            gtDepthImage += noiseMat
-
-        depthImage = gtDepthImage
-
-        if self.rgbd_projector_baseline > 0.0:
-            K = np.reshape(np.array(self.rgbd_info.depth_info_msg.K), [3, 3])
-
-            # How much does each depth point project laterally (in the axis of the camera-projector pair?)
-            x_indices_im = np.tile(np.arange(camera_width), [camera_height,1])
-            x_projection = (x_indices_im - K[0, 2]) * gtDepthImage / K[0, 0]
-
-            # For a fixed shift...
-            for shift_amt in range(-50, -5, 5):
-                imshift_tf_matrix = np.array([[1., 0., shift_amt], [0., 1., 0.]])
-                shifted_x_projection = cv2.warpAffine(x_projection, imshift_tf_matrix, (camera_width, camera_height), borderMode=cv2.BORDER_REPLICATE)
-                shifted_gt_depth = cv2.warpAffine(gtDepthImage, imshift_tf_matrix, (camera_width, camera_height), borderMode=cv2.BORDER_CONSTANT, borderValue=float(np.max(gtDepthImage)))
-
-                # (projected test point - projected original point) dot producted with vector perpendicular to sample point and projector origin
-                error_im = (shifted_x_projection - x_projection)*(-gtDepthImage) + \
-                       (shifted_gt_depth - gtDepthImage)*(x_projection - self.rgbd_projector_baseline)
-                _, error_thresh = cv2.threshold(error_im, 0., 1., cv2.THRESH_BINARY_INV)
-                depthImage = depthImage * error_thresh
-
-        # Apply normal limiting
-        if self.rgbd_normal_limit > 0.:
-            depthImage *= normalThresh
-
-        #im = cvUtils.generateGridOfImages(
-        #    [
-        #        cvUtils.generateColorMap(gtDepthImage),
-        #        cvUtils.generateColorMap(gtNormalImage, -0.1, .1),
-        #        cvUtils.generateColorMap(normalThresh),
-        #        cvUtils.generateColorMap(depthImage)
-        #    ], 3, 10)
-        #cv2.imshow("depthcorruption", im)
-        #cv2.waitKey(1)
-
-        # Convert and publish!        
-        depthMsg = self.cv_bridge.cv2_to_imgmsg((depthImage*1000).astype('uint16'), "passthrough")
-
-        # Construct a header with the current timestamp and the RGB
-        # frame, and publish RGB camera info and the RGB camera image
-        now_header = std_msgs.msg.Header()
-        now_header.stamp = rospy.Time.now()
-        now_header.frame_id = self.rgbd_info.frames['DEPTH_FRAME']
-        self.rgbd_info.depth_info_msg.header = now_header
-        self.depth_info_publisher.publish(self.rgbd_info.depth_info_msg)
-        depthMsg.header = now_header
-        self.depth_publisher.publish(depthMsg)
+        depthImage = (max_range * min_range) / (max_range + np.asarray(images[3]) * (min_range - max_range))
+
+        segmentationImage = None
+        if self.rgbd_segmentation:
+            segmentationImage = np.asarray(images[4])
+
+        return np.asarray(images[2]), depthImage, segmentationImage
+
+    def DoRgbdRendering(self):
+        ''' Renders the RGB and depth images for this camera tick and hands
+            them to the image publisher.
+
+            By default depth and RGB are rendered in two passes, each from its
+            own camera with its own extrinsics, intrinsics and clipping range.
+            With rgbd_shared_render set (and matching image sizes) the scene
+            is rendered once from the depth camera with the depth clipping
+            range, and the RGB image is published registered to the depth
+            camera: with its frame and camera info. '''
+        depth_info_msg = self.rgbd_info.depth_info_msg
+        rgb_info_msg = self.rgbd_info.rgb_info_msg
+        min_range = self.rgbd_info.depth_min_range
+        max_range = self.rgbd_info.depth_max_range
+        stamp = self.GetRosStamp()
 
-    def DoRgbRendering(self):
-        # Get the state of the camera link
-        linkState = pybullet.getLinkState(self.kuka_id, 
-            self.rgbd_info.rgb_extrinsics["parent_joint_id"],
-            computeLinkVelocity=0)
-        
-        # Compute the camera's eye position
-        cameraWorldPosition, cameraWorldOrientation = \
-            pybullet.multiplyTransforms(
-                linkState[0], linkState[1],
-                self.rgbd_info.rgb_extrinsics["pose_xyz"], 
-                self.rgbd_info.rgb_extrinsics["pose_quat"])
+        shared = self.rgbd_shared_render and \
+            (rgb_info_msg.width, rgb_info_msg.height) == (depth_info_msg.width, depth_info_msg.height)
 
-        # Use that to form Forward and Up vectors for the camera
-        cameraRotationMatrix = np.reshape(np.array(pybullet.getMatrixFromQuaternion(cameraWorldOrientation)), [3, 3])
-        cameraForward = cameraRotationMatrix.dot(np.array(CAMERA_FORWARD_VEC))
-        cameraUp = cameraRotationMatrix.dot(np.array(CAMERA_UP_VEC))
+        if shared:
+            rgbImage, depthImage, segmentationImage = self.RenderCamera(
+                self.rgbd_info.depth_extrinsics, depth_info_msg, min_range, max_range)
+            rgb_frame = self.rgbd_info.frames['DEPTH_FRAME']
+            rgb_info_msg = depth_info_msg
+        else:
+            _, depthImage, segmentationImage = self.RenderCamera(
+                self.rgbd_info.depth_extrinsics, depth_info_msg, min_range, max_range)
+            rgbImage, _, _ = self.RenderCamera(
+                self.rgbd_info.rgb_extrinsics, rgb_info_msg,
+                IIWA_RGB_CAMERA_MIN_DISTANCE, IIWA_RGB_CAMERA_MAX_DISTANCE)
+            rgb_frame = self.rgbd_info.frames['RGB_FRAME']
 
-        # Assemble a view matrix
-        viewMatrix = pybullet.computeViewMatrix(cameraWorldPosition, cameraWorldPosition+cameraForward, cameraUp)
-
-        # Compute the FOV and aspect from the camera intrinsics
-        camera_width = self.rgbd_info.rgb_info_msg.width
-        camera_height = self.rgbd_info.rgb_info_msg.height
-        camera_fov_x = 2 * math.atan2(camera_height, 2 * self.rgbd_info.rgb_info_msg.P[0]) * 180. / math.pi
-        camera_fov_y = 2 * math.atan2(camera_width, 2 * self.rgbd_info.rgb_info_msg.P[5]) * 180. / math.pi
-        camera_aspect = float(camera_width) / float(camera_height)
-        # Use the computed FOV to produce a projection matrix
-        # (Note: I'm sure you can directly compute a projection Matrix
-        # from the intrinsics, but I'm not sure what the mapping is --
-        # OpenCV makes a lot of assumptions about their projection matrix
-        # details and scaling. It's not exactly a camera intrinsic matrix...
-        # So this is easier.)
-        projectionMatrix = pybullet.computeProjectionMatrixFOV(camera_fov_x, camera_aspect, IIWA_RGB_CAMERA_MIN_DISTANCE, IIWA_RGB_CAMERA_MAX_DISTANCE)
-
-        images = pybullet.getCameraImage(camera_width, camera_height, viewMatrix, projectionMatrix, shadow=0,lightDirection=[1,1,1],renderer=pybullet.ER_BULLET_HARDWARE_OPENGL)
-
-        rgbImage = images[2]
-        # Convert and publish!        
-        rgbMsg = self.cv_bridge.cv2_to_imgmsg(cv2.cvtColor(rgbImage, cv2.COLOR_BGRA2BGR), "rgb8")
-
-        # Construct a header with the current timestamp and the RGB
-        # frame, and publish RGB camera info and the RGB camera image
-        now_header = std_msgs.msg.Header()
-        now_header.stamp = rospy.Time.now()
-        now_header.frame_id = self.rgbd_info.frames['RGB_FRAME']
-        self.rgbd_info.rgb_info_msg.header = now_header
-        self.rgb_info_publisher.publish(self.rgbd_info.rgb_info_msg)
-        rgbMsg.header = now_header
-        self.rgb_publisher.publish(rgbMsg)
+        self.image_publisher.Submit(RgbdFrame(
+            stamp=stamp, rgb_image=rgbImage, rgb_frame=rgb_frame, rgb_info_msg=rgb_info_msg,
+            depth_image=depthImage, depth_frame=self.rgbd_info.frames['DEPTH_FRAME'], depth_info_msg=depth_info_msg,
+            segmentation_image=segmentationImage))
 
 
     #def UpdateRtv(self):
@@ -613,7 +756,7 @@ class IiwaRlgSimulator():
     def RunSim(self):
         # Run simulation with time control
         start_time = time.time()
-        sim_time = 0.0
+        self.sim_time = 0.0
         avg_sim_rate = -1.
         sim_rate_RC = 0.01 # RC time constant for estimating sim rate
         sim_rate_alpha = self.timestep / (sim_rate_RC + self.timestep) 
@@ -622,23 +765,31 @@ class IiwaRlgSimulator():
         last_status_send = 0
         last_render = 0
 
+        # In lockstep mode these are only updated on status ticks
+        iiwa_position_command = self.GetIiwaPositionCommand()
+        schunk_position_command, schunk_torque_command = self.GetSchunkCommand()
+
         keep_going = True
         while 1:
             start_step_time = time.time()
 
-            # Resolve new commands for the IIWA
-            self.lc.handle_timeout(1)
+            if not self.lockstep:
+                # Resolve new commands for the IIWA
+                self.lc.handle_timeout(1)
+                iiwa_position_command = self.GetIiwaPositionCommand()
+
+                # Resolve new commands for the gripper
+                # ROS spinonce?
+                schunk_position_command, schunk_torque_command = self.GetSchunkCommand()
+
             pybullet.setJointMotorControlArray(
                 self.kuka_id,
                 self.iiwa_motor_id_list,
                 controlMode=pybullet.POSITION_CONTROL,
-                targetPositions=self.GetIiwaPositionCommand(),
+                targetPositions=iiwa_position_command,
                 forces=IIWA_MAX_JOINT_FORCES
                 )
 
-            # Resolve new commands for the gripper
-            # ROS spinonce?
-            schunk_position_command, schunk_torque_command = self.GetSchunkCommand()
             pybullet.setJointMotorControlArray(
                 self.kuka_id,
                 self.schunk_motor_id_list,
@@ -650,44 +801,63 @@ class IiwaRlgSimulator():
 
             # Do a sim step
             pybullet.stepSimulation()
-            sim_time += self.timestep
+            self.sim_time += self.timestep
+            sim_time = self.sim_time
 
             # Publish state
             if (sim_time - last_status_send) > 0.033:
-                self.PublishIiwaStatus()
+                status_utime = self.PublishIiwaStatus()
                 self.PublishSchunkStatus()
                 last_status_send = sim_time
                 #self.UpdateRtv()
 
+                if self.lockstep:
+                    self.PublishClock()
+                    self.WaitForIiwaCommand(status_utime)
+                    iiwa_position_command = self.GetIiwaPositionCommand()
+                    schunk_position_command, schunk_torque_command = self.GetSchunkCommand()
+
             # Render
             if (sim_time - last_render) > 0.333:
-                self.DoDepthRendering()
-                self.DoRgbRendering()
+                self.DoRgbdRendering()
                 last_render = sim_time
 
-            events = pybullet.getKeyboardEvents()
-            for key in events.keys():
-                if events[key] & pybullet.KEY_WAS_TRIGGERED:
-                    if key == ord('q'):
-                        return False
-                    elif key == ord('r'):
-                        print("Restarting")
-                        return True
+            if self.duration is not None and sim_time >= self.duration:
+                self.image_publisher.Flush()
+                print("Simulated %f s in %f s" % (sim_time, time.time() - start_time))
+                return False
+
+            if not self.lockstep:
+                events = pybullet.getKeyboardEvents()
+                for key in events.keys():
+                    if events[key] & pybullet.KEY_WAS_TRIGGERED:
+                        if key == ord('q'):
+                            return False
+                        elif key == ord('r'):
+                            print("Restarting")
+                            return True
 
             end_step_time = time.time()
 
             # THINGS BELOW HERE MUST HAPPEN QUICKLY FOR TIME ESTIMATION TO BE ACCURATE
 
             # Estimate sim rate
-            this_sim_step_rate = self.timestep / (end_step_time - start_step_time)
+            this_sim_step_rate = self.timestep / max(end_step_time - start_step_time, 1E-9)
             if avg_sim_rate < 0:
                 # Initialization case
                 avg_sim_rate = this_sim_step_rate
             else:
                 avg_sim_rate = this_sim_step_rate * sim_rate_alpha + (1. - sim_rate_alpha) * avg_sim_rate
 
-            # Sleep if we're running too fast
             elapsed = end_step_time - start_time
+            if self.lockstep:
+                if time.time() - last_print_time > 1.0:
+                    last_print_time = time.time()
+                    print("Overall sim rate: ", sim_time / elapsed, ", current sim rate: ", avg_sim_rate, " at time ", sim_time,
+                          ", command timeouts: ", self.num_lockstep_timeouts, ", images: ", self.image_publisher.num_published)
+                continue
+
+            # Sleep if we're running too fast
             target_sim_time = elapsed * self.rate
             if sim_time > target_sim_time:
                 time.sleep(sim_time - target_sim_time)
@@ -705,7 +875,14 @@ if __name__ == "__main__":
     parser.add_argument("--rgbd_noise", help="Normal noise injected to RGBD depth returns", type=float, default=0.001)
     parser.add_argument("--rgbd_projector_baseline", help="RGBD projector baseline used to calculate depth shadowing", type=float, default=0.1)
     parser.add_argument("--rgbd_normal_limit", help="Threshold for rejecting high-normal depth returns. (Smaller is more stringent, 0.0 to turn off.)", type=float, default=0.05)
+    parser.add_argument("--rgbd_fidelity", help="Accuracy of the RGBD depth shadowing, lower is faster.", type=str, default="high", choices=sorted(depthSensorModel.DEPTH_SENSOR_FIDELITY.keys()))
+    parser.add_argument("--rgbd_shared_render", help="Render RGB and depth in a single pass from the depth camera, publishing RGB registered to depth.", action="store_true")
+    parser.add_argument("--rgbd_segmentation", help="Also publish the segmentation mask (body ids) of the depth camera.", action="store_true")
     parser.add_argument("--headless", help="Run without GUI.", action="store_true")
+    parser.add_argument("--lockstep", help="Run headless as fast as possible, stamping everything with sim time and advancing commands only on status ticks. Implies --headless.", action="store_true")
+    parser.add_argument("--lockstep_timeout", help="Wall time (s) to wait for the controller to answer each status in lockstep mode", type=float, default=1.0)
+    parser.add_argument("--seed", help="Seed for a reproducible run", type=int, default=None)
+    parser.add_argument("--duration", help="Sim time (s) after which to exit", type=float, default=None)
     parser.add_argument("--camera_serial_number", type=str, default="carmine_1", )
     args = parser.parse_args()
 
@@ -714,7 +891,7 @@ if __name__ == "__main__":
     #cv2.namedWindow("depthcorruption")
 
     # Set up a simulation with a ground plane and desired timestep
-    if args.headless:
+    if args.headless or args.lockstep:
         physicsClient = pybullet.connect(pybullet.DIRECT)
     else:
         physicsClient = pybullet.connect(pybullet.GUI)
@@ -723,10 +900,19 @@ if __name__ == "__main__":
             rgbd_projector_baseline = args.rgbd_projector_baseline,
             rgbd_noise = args.rgbd_noise,
             rgbd_normal_limit = args.rgbd_normal_limit,
-            camera_serial_number=args.camera_serial_number)
+            rgbd_fidelity = args.rgbd_fidelity,
+            rgbd_shared_render = args.rgbd_shared_render,
+            rgbd_segmentation = args.rgbd_segmentation,
+            camera_serial_number=args.camera_serial_number,
+            lockstep = args.lockstep,
+            lockstep_timeout = args.lockstep_timeout,
+            seed = args.seed,
+            duration = args.duration)
 
     keep_simulating = True
     while keep_simulating:
         sim.ResetSimulation()
         keep_simulating = sim.RunSim()
 
+    sim.image_publisher.Close()
+
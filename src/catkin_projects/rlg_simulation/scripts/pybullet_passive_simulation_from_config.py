@@ -6,6 +6,8 @@
 # Arguments:
 #   config: Configuration file
 #   rate: Desired real-time rate (will not run faster, might run slower)
+#   stop_at_rest: Exit once the scene has come to rest
+#   output: Where to save the config with the settled poses
 # Press q to quit and r to restart the simulation.
 
 import argparse
@@ -14,15 +16,39 @@ import pybullet as p
 import time
 import yaml
 
+from rlg_simulation.rest_detector import RestDetector, save_settle_stats
+
+def save_settled_config(filename, config, ids, settle_stats):
+    ''' Writes config with the current poses of the bodies, and the settle stats next to it '''
+    config = dict(config)
+    config["instances"] = [dict(instance) for instance in config["instances"]]
+    for body_id, instance in zip(ids, config["instances"]):
+        pos, quat = p.getBasePositionAndOrientation(body_id)
+        instance["q0"] = [float(x) for x in list(pos) + list(p.getEulerFromQuaternion(quat))]
+    with open(filename, 'w') as outfile:
+        yaml.dump(config, outfile, default_flow_style=False)
+    save_settle_stats(filename, settle_stats)
+    print("Saved settled config to %s" % filename)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("config", help="Configuration file to simulate.", type=str)
     parser.add_argument("-r", "--rate", help="Desired simulation rate (fraction of realtime)", type=float, default=1.0)
     parser.add_argument("-t", "--timestep", help="Simulation timestep", type=float, default=0.001)
+    parser.add_argument("--headless", help="Run without GUI.", action="store_true")
+    parser.add_argument("--stop_at_rest", help="Exit once the scene has come to rest.", action="store_true")
+    parser.add_argument("-o", "--output", help="Save the config with the poses at rest (or at exit) here, and the settle stats next to it.", type=str, default=None)
+    parser.add_argument("--rest_linear_velocity", help="Bodies slower than this (m/s) are at rest", type=float, default=0.01)
+    parser.add_argument("--rest_angular_velocity", help="Bodies slower than this (rad/s) are at rest", type=float, default=0.05)
+    parser.add_argument("--rest_check_interval", help="# of steps between rest checks", type=int, default=10)
+    parser.add_argument("--rest_dwell_time", help="Sim time the scene has to stay at rest", type=float, default=0.2)
     args = parser.parse_args()
 
     # Set up a simulation with a ground plane and desired timestep
-    physicsClient = p.connect(p.GUI)#or p.DIRECT for non-graphical version
+    if args.headless:
+        physicsClient = p.connect(p.DIRECT)
+    else:
+        physicsClient = p.connect(p.GUI)
         
     keep_simulating = True
     while keep_simulating:
@@ -52,6 +78,11 @@ if __name__ == "__main__":
             fixed = instance["fixed"]
             print("URDF ", urdf, " q0", q0)
             ids.append(p.loadURDF(urdf, position, quaternion, fixed))
+
+        rest_detector = RestDetector(
+            [body_id for body_id, instance in zip(ids, config["instances"]) if not instance["fixed"]],
+            args.timestep, linear_velocity=args.rest_linear_velocity, angular_velocity=args.rest_angular_velocity,
+            check_interval=args.rest_check_interval, dwell_time=args.rest_dwell_time)
             
         # Run simulation with time control
         start_time = time.time()
@@ -69,6 +100,16 @@ if __name__ == "__main__":
             end_step_time = time.time()
             sim_time += args.timestep
 
+            if not rest_detector.settled and rest_detector.step():
+                settle_stats = rest_detector.get_stats()
+                print("At rest since %f s (detected at %f s)" % (settle_stats["settle_time"], settle_stats["stop_time"]))
+                if args.output is not None:
+                    save_settled_config(args.output, config, ids, settle_stats)
+                if args.stop_at_rest:
+                    keep_going = False
+                    keep_simulating = False
+                    continue
+
             # Estimate sim rate
             this_sim_step_rate = args.timestep / (end_step_time - start_step_time)
             if avg_sim_rate < 0:
@@ -94,6 +135,8 @@ if __name__ == "__main__":
                         print("Quitting")
                         keep_going = False
                         keep_simulating = False
+                        if args.output is not None and not rest_detector.settled:
+                            save_settled_config(args.output, config, ids, rest_detector.get_stats())
                     elif key == ord('r'):
                         print("Restarting")
                         keep_going = False
@@ -0,0 +1,154 @@
+import numpy as np
+import os
+import pybullet as p
+import yaml
+
+
+class RestDetector:
+    '''
+    Decides when the bodies of a pybullet scene have come to rest, so a
+    simulation can stop instead of running for a fixed horizon.
+
+    Call step() after every p.stepSimulation(). Every check_interval steps
+    it queries the base velocities of all of the bodies and the contact
+    pairs they're part of. The scene is at rest when all base linear and
+    angular velocities are below the thresholds and the set of contact
+    pairs hasn't changed since the previous check. step() returns True once
+    the scene has been at rest for dwell_time.
+
+    get_stats() summarizes when the scene and each body came to rest, to
+    help tune simulation horizons.
+    '''
+
+    def __init__(self, body_ids, timestep, linear_velocity=0.01, angular_velocity=0.05,
+                 check_interval=10, dwell_time=0.2, check_contacts=True, physics_client_id=0):
+        '''
+        :param body_ids: the (non-fixed) bodies to watch
+        :param linear_velocity: threshold on the base linear velocity, in m/s
+        :param angular_velocity: threshold on the base angular velocity, in rad/s
+        :param check_interval: number of steps between checks
+        :param dwell_time: sim time the scene has to stay at rest
+        :param check_contacts: also require the contact pairs to stay the same
+        '''
+        self.body_ids = list(body_ids)
+        self.timestep = timestep
+        self.linear_velocity = linear_velocity
+        self.angular_velocity = angular_velocity
+        self.check_interval = max(int(check_interval), 1)
+        self.dwell_time = dwell_time
+        self.check_contacts = check_contacts
+        self.physics_client_id = physics_client_id
+        self.reset()
+
+    def reset(self):
+        self.num_steps = 0
+        self.num_checks = 0
+        self.num_contact_changes = 0
+        self.rest_start_time = None
+        self.settled = False
+        self.last_contact_pairs = None
+        self.last_velocities = np.zeros((len(self.body_ids), 6))
+        # sim time of the last check at which each body was still moving
+        self.body_last_moving_times = np.zeros(len(self.body_ids))
+
+    def get_sim_time(self):
+        return self.num_steps * self.timestep
+
+    def step(self):
+        self.num_steps += 1
+        if not self.settled and self.num_steps % self.check_interval == 0:
+            self.check()
+        return self.settled
+
+    def get_velocities(self):
+        '''
+        :return: num_bodies x 6 array, base linear then angular velocity
+        '''
+        velocities = np.zeros((len(self.body_ids), 6))
+        for i, body_id in enumerate(self.body_ids):
+            linear, angular = p.getBaseVelocity(body_id, physicsClientId=self.physics_client_id)
+            velocities[i, 0:3] = linear
+            velocities[i, 3:6] = angular
+        return velocities
+
+    def get_contact_pairs(self):
+        '''
+        :return: set of ((bodyA, linkA), (bodyB, linkB)) in contact, with at least one
+        of the bodies being watched
+        '''
+        watched = set(self.body_ids)
+        pairs = set()
+        for contact in p.getContactPoints(physicsClientId=self.physics_client_id):
+            body_a, body_b, link_a, link_b = contact[1], contact[2], contact[3], contact[4]
+            if body_a not in watched and body_b not in watched:
+                continue
+            pair = ((body_a, link_a), (body_b, link_b))
+            pairs.add((min(pair), max(pair)))
+        return pairs
+
+    def check(self):
+        self.num_checks += 1
+        sim_time = self.get_sim_time()
+
+        velocities = self.get_velocities()
+        self.last_velocities = velocities
+        moving = (np.linalg.norm(velocities[:, 0:3], axis=1) >= self.linear_velocity) | \
+                 (np.linalg.norm(velocities[:, 3:6], axis=1) >= self.angular_velocity)
+        self.body_last_moving_times[moving] = sim_time
+        at_rest = not np.any(moving)
+
+        if self.check_contacts:
+            contact_pairs = self.get_contact_pairs()
+            # the first check has nothing to compare to, so it's never at rest
+            if contact_pairs != self.last_contact_pairs:
+                if self.last_contact_pairs is not None:
+                    self.num_contact_changes += 1
+                at_rest = False
+            self.last_contact_pairs = contact_pairs
+
+        if not at_rest:
+            self.rest_start_time = None
+            return
+
+        if self.rest_start_time is None:
+            self.rest_start_time = sim_time
+
+        if sim_time - self.rest_start_time >= self.dwell_time:
+            self.settled = True
+
+    def get_stats(self):
+        '''
+        :return: dict with
+            settled: whether the scene came to rest
+            settle_time: sim time from which the scene stayed at rest (None if it didn't)
+            stop_time: sim time simulated so far
+            body_settle_times: for each body, the sim time from which it stayed below the
+                velocity thresholds, i.e. the last check at which it was moving
+            max_linear_velocity, max_angular_velocity: at the last check
+            num_steps, num_checks, num_contact_changes
+        '''
+        stats = {}
+        stats["settled"] = bool(self.settled)
+        stats["settle_time"] = float(self.rest_start_time) if self.settled else None
+        stats["stop_time"] = float(self.get_sim_time())
+        stats["body_settle_times"] = [float(x) for x in self.body_last_moving_times]
+        stats["max_linear_velocity"] = float(np.max(np.linalg.norm(self.last_velocities[:, 0:3], axis=1))) \
+            if len(self.body_ids) > 0 else 0.
+        stats["max_angular_velocity"] = float(np.max(np.linalg.norm(self.last_velocities[:, 3:6], axis=1))) \
+            if len(self.body_ids) > 0 else 0.
+        stats["num_steps"] = int(self.num_steps)
+        stats["num_checks"] = int(self.num_checks)
+        stats["num_contact_changes"] = int(self.num_contact_changes)
+        return stats
+
+
+def settle_stats_filename(config_filename):
+    # .yml rather than .yaml, so it isn't picked up when loading a folder of configs
+    return os.path.splitext(config_filename)[0] + ".settle_stats.yml"
+
+def save_settle_stats(config_filename, settle_stats):
+    '''
+    Writes the RestDetector stats next to the config they were simulated from
+    '''
+    with open(settle_stats_filename(config_filename), 'w') as outfile:
+        yaml.dump(settle_stats, outfile, default_flow_style=False)
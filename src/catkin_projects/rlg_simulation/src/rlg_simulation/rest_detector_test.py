@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import unittest
+import yaml
+
+# the rest detector imports pybullet,
+# the tests are skipped where that isn't available
+try:
+    import rlg_simulation.rest_detector as rest_detector
+    from rlg_simulation.rest_detector import RestDetector
+    SKIP_REASON = None
+except ImportError as e:
+    SKIP_REASON = "needs the spartan environment: %s" %(e)
+
+
+class FakePybullet(object):
+    '''
+    Stands in for the pybullet calls RestDetector makes, the test sets the
+    base velocities and contact points directly.
+    '''
+
+    def __init__(self):
+        self.velocities = dict()
+        self.contacts = []
+
+    def getBaseVelocity(self, body_id, physicsClientId=0):
+        linear, angular = self.velocities.get(body_id, ([0., 0., 0.], [0., 0., 0.]))
+        return tuple(linear), tuple(angular)
+
+    def getContactPoints(self, physicsClientId=0):
+        # only the fields RestDetector reads: bodyA, bodyB, linkA, linkB
+        return [(0, body_a, body_b, link_a, link_b) for (body_a, body_b, link_a, link_b) in self.contacts]
+
+
+@unittest.skipIf(SKIP_REASON is not None, SKIP_REASON)
+class RestDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pybullet = rest_detector.p
+        self.fake = FakePybullet()
+        rest_detector.p = self.fake
+
+    def tearDown(self):
+        rest_detector.p = self.pybullet
+
+    def run_steps(self, detector, num_steps):
+        for i in xrange(num_steps):
+            if detector.step():
+                return i + 1
+        return None
+
+    def test_settles_after_dwell_time(self):
+        detector = RestDetector([1, 2], timestep=0.01, check_interval=2, dwell_time=0.1)
+        self.fake.velocities[1] = ([0.5, 0., 0.], [0., 0., 0.])
+        self.fake.contacts = [(1, 0, -1, -1)]
+
+        self.assertIsNone(self.run_steps(detector, 20))
+        self.assertFalse(detector.get_stats()["settled"])
+
+        # body 1 stops at t = 0.2. The scene is at rest from the check at
+        # t = 0.22, and settled at the first check at least dwell_time later
+        self.fake.velocities[1] = ([0.005, 0., 0.], [0., 0., 0.01])
+        num_steps = self.run_steps(detector, 100)
+        self.assertEqual(num_steps, 12)
+
+        stats = detector.get_stats()
+        self.assertTrue(stats["settled"])
+        self.assertAlmostEqual(stats["settle_time"], 0.22)
+        self.assertAlmostEqual(stats["stop_time"], 0.32)
+        self.assertAlmostEqual(stats["body_settle_times"][0], 0.2)
+        self.assertAlmostEqual(stats["body_settle_times"][1], 0.)
+        self.assertAlmostEqual(stats["max_linear_velocity"], 0.005)
+        self.assertEqual(stats["num_checks"], 16)
+
+        # once settled no more checks are made
+        detector.step()
+        self.assertEqual(detector.get_stats()["num_checks"], 16)
+
+    def test_angular_velocity_prevents_rest(self):
+        detector = RestDetector([1], timestep=0.01, check_interval=1, dwell_time=0.05, check_contacts=False)
+        self.fake.velocities[1] = ([0., 0., 0.], [0., 0.1, 0.])
+        self.assertIsNone(self.run_steps(detector, 50))
+
+        self.fake.velocities[1] = ([0., 0., 0.], [0., 0.01, 0.])
+        self.assertIsNotNone(self.run_steps(detector, 50))
+
+    def test_contact_changes_reset_the_dwell_time(self):
+        detector = RestDetector([1], timestep=0.01, check_interval=1, dwell_time=0.05)
+        contact_sets = [[(1, 0, -1, -1)], [(0, 1, -1, -1), (1, 0, 2, -1)]]
+        for i in xrange(10):
+            # the contact pairs are compared regardless of the body order
+            self.fake.contacts = contact_sets[(i // 3) % 2]
+            self.assertFalse(detector.step())
+
+        self.assertEqual(detector.get_stats()["num_contact_changes"], 3)
+
+        # contacts between bodies that aren't watched are ignored
+        self.fake.contacts = contact_sets[1] + [(5, 6, -1, -1)]
+        self.assertIsNotNone(self.run_steps(detector, 10))
+
+    def test_save_settle_stats(self):
+        detector = RestDetector([1], timestep=0.01, check_interval=1, dwell_time=0.)
+        self.run_steps(detector, 5)
+
+        directory = tempfile.mkdtemp()
+        try:
+            config_filename = os.path.join(directory, 'scene.yaml')
+            rest_detector.save_settle_stats(config_filename, detector.get_stats())
+
+            self.assertEqual(rest_detector.settle_stats_filename(config_filename),
+                             os.path.join(directory, 'scene.settle_stats.yml'))
+            with open(rest_detector.settle_stats_filename(config_filename)) as f:
+                self.assertEqual(yaml.safe_load(f), detector.get_stats())
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()